@@ -25,13 +25,24 @@
 
 
 class BundlePart(object):
-    def __init__(self, filename, hexdigest, digest_algorithm, size=None):
+    # Bundles can have tens of thousands of parts, so skip the __dict__
+    __slots__ = ('digest_algorithm', 'filename', 'hexdigest', 'size',
+                 'md5_hexdigest', 'buffer_slot')
+
+    def __init__(self, filename, hexdigest, digest_algorithm, size=None,
+                 md5_hexdigest=None, buffer_slot=None):
         self.digest_algorithm = digest_algorithm
         self.filename = filename
         self.hexdigest = hexdigest
         self.size = size
+        # Not part of the manifest, but handy for uploading
+        self.md5_hexdigest = md5_hexdigest
+        # Set when the part lives in a PartBufferRing instead of a file
+        self.buffer_slot = buffer_slot
 
     def __repr__(self):
-        return 'BundlePart({0}, {1}, {2}, {3})'.format(
-            repr(self.filename), repr(self.hexdigest),
-            repr(self.digest_algorithm), repr(self.size))
+        return ('BundlePart({0}, {1}, {2}, {3}, md5_hexdigest={4}, '
+                'buffer_slot={5})'.format(
+                    repr(self.filename), repr(self.hexdigest),
+                    repr(self.digest_algorithm), repr(self.size),
+                    repr(self.md5_hexdigest), repr(self.buffer_slot)))
@@ -0,0 +1,128 @@
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import logging
+import os
+import os.path
+import threading
+
+
+class BundleJournal(object):
+    """
+    An on-disk record of a bundle's encryption parameters and of which of
+    its parts have been uploaded so far.
+
+    Bundling the same image with the same key, IV, and part size yields
+    the same parts, so this is enough to let an interrupted upload pick
+    up where it left off.  Every part is still checked against its SHA1
+    digest before it is considered to be the same.
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename, loglevel=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        if loglevel is not None:
+            self.log.level = loglevel
+        self.filename = filename
+        self.enc_key = None
+        self.enc_iv = None
+        self.part_size = None
+        self.image_size = None
+        self.parts = {}  # part basename -> {sha1, size, etag}
+        self._lock = threading.Lock()
+        self.__warned_about_mismatch = False
+
+    @classmethod
+    def read_from_file(cls, filename, loglevel=None):
+        with open(filename) as journal_file:
+            data = json.load(journal_file)
+        if data.get('version') != cls.VERSION:
+            raise ValueError("bundle journal '{0}' has unsupported version "
+                             "{1}".format(filename, data.get('version')))
+        journal = cls(filename, loglevel=loglevel)
+        journal.enc_key = data['enc_key']
+        journal.enc_iv = data['enc_iv']
+        journal.part_size = data['part_size']
+        journal.image_size = data['image_size']
+        journal.parts = data.get('parts') or {}
+        return journal
+
+    def save(self):
+        with self._lock:
+            self.__save()
+
+    def get_uploaded_part(self, part):
+        """
+        If a part identical to the one given was uploaded before, return
+        a dict with its sha1, size, and the etag the server gave it (if
+        any).  Otherwise, return None.
+        """
+        with self._lock:
+            record = self.parts.get(os.path.basename(part.filename))
+            if record is None:
+                return None
+            if (record.get('sha1') == part.hexdigest and
+                    record.get('size') == part.size):
+                return dict(record)
+            # Bundling the same image with the same key and IV should
+            # yield identical parts.  When it does not, resuming cannot
+            # work, and the rest of the bundle gets uploaded again.
+            if not self.__warned_about_mismatch:
+                self.log.warn('part %s differs from the one uploaded '
+                              'before, so it will be uploaded again; was '
+                              'the image changed?',
+                              os.path.basename(part.filename))
+                self.__warned_about_mismatch = True
+        return None
+
+    def record_uploaded_part(self, part, etag):
+        with self._lock:
+            self.parts[os.path.basename(part.filename)] = {
+                'sha1': part.hexdigest, 'size': part.size, 'etag': etag}
+            self.__save()
+
+    def delete(self):
+        with self._lock:
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+
+    def __save(self):
+        data = {'version': self.VERSION, 'enc_key': self.enc_key,
+                'enc_iv': self.enc_iv, 'part_size': self.part_size,
+                'image_size': self.image_size, 'parts': self.parts}
+        # Write a new file and move it into place so a crash can never
+        # leave a journal half-written.  It contains the bundle's
+        # encryption key in the clear, so only its owner may read it.
+        tmp_filename = self.filename + '.tmp'
+        tmp_fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+        with os.fdopen(tmp_fd, 'w') as journal_file:
+            json.dump(data, journal_file, indent=1, sort_keys=True)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.rename(tmp_filename, self.filename)
+        self.log.debug('wrote bundle journal %s', self.filename)
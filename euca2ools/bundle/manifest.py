@@ -24,15 +24,19 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import binascii
+import functools
 import hashlib
+import io
 import logging
 import os.path
-import subprocess
 
 import lxml.etree
 import lxml.objectify
 
 import euca2ools.bundle
+import euca2ools.bundle.util
+import euca2ools.crypto
+import euca2ools.util
 
 
 class BundleManifest(object):
@@ -59,58 +63,86 @@ class BundleManifest(object):
 
     @classmethod
     def read_from_file(cls, manifest_filename, privkey_filename=None):
-        with open(manifest_filename) as manifest_fileobj:
+        with open(manifest_filename, 'rb') as manifest_fileobj:
             return cls.read_from_fileobj(manifest_fileobj, privkey_filename)
 
     @classmethod
     def read_from_fileobj(cls, manifest_fileobj, privkey_filename=None):
-        xml = lxml.objectify.parse(manifest_fileobj).getroot()
+        # Manifests for big images can list tens of thousands of parts, so
+        # parse them as a stream instead of building the whole tree.
         manifest = cls()
-        mconfig = xml.machine_configuration
-        manifest.image_arch = mconfig.architecture.text.strip()
-        if hasattr(mconfig, 'kernel_id'):
-            manifest.kernel_id = mconfig.kernel_id.text.strip()
-        if hasattr(mconfig, 'ramdisk_id'):
-            manifest.ramdisk_id = mconfig.ramdisk_id.text.strip()
-        if hasattr(mconfig, 'block_device_mappings'):
-            for xml_mapping in mconfig.block_device_mappings.iter(
-                    tag='block_device_mapping'):
-                device = xml_mapping.device.text.strip()
-                virtual = xml_mapping.virtual.text.strip()
-                manifest.block_device_mappings[virtual] = device
-        if hasattr(mconfig, 'productcodes'):
-            for xml_pcode in mconfig.productcodes.iter(tag='product_code'):
-                manifest.product_codes.append(xml_pcode.text.strip())
-        manifest.image_name = xml.image.name.text.strip()
-        manifest.account_id = xml.image.user.text.strip()
-        manifest.image_type = xml.image.type.text.strip()
-        manifest.image_digest = xml.image.digest.text.strip()
-        manifest.image_digest_algorithm = xml.image.digest.get('algorithm')
-        manifest.image_size = int(xml.image.size.text.strip())
-        manifest.bundled_image_size = int(xml.image.bundled_size.text.strip())
+        enc_algorithm = None
+        encrypted = {}  # element tag -> hex-encoded encrypted key or IV
+        mapping = {}
+        part_info = {}
+        for event, path, elem in euca2ools.util.iterparse_with_paths(
+                manifest_fileobj, events=('start', 'end')):
+            path = path[1:]  # Everything is inside <manifest>
+            if event == 'start':
+                if path == ('image', 'parts'):
+                    manifest.image_parts = [None] * int(elem.get('count'))
+                continue
+            text = elem.text.strip() if elem.text else None
+            if path == ('machine_configuration', 'architecture'):
+                manifest.image_arch = text
+            elif path == ('machine_configuration', 'kernel_id'):
+                manifest.kernel_id = text
+            elif path == ('machine_configuration', 'ramdisk_id'):
+                manifest.ramdisk_id = text
+            elif path[:3] == ('machine_configuration', 'block_device_mappings',
+                              'block_device_mapping'):
+                if len(path) == 4:
+                    mapping[path[3]] = text
+                else:
+                    manifest.block_device_mappings[mapping.get('virtual')] = \
+                        mapping.get('device')
+                    mapping = {}
+            elif path == ('machine_configuration', 'productcodes',
+                          'product_code'):
+                manifest.product_codes.append(text)
+            elif len(path) == 2 and path[0] == 'image':
+                if path[1] in _IMAGE_FIELDS:
+                    setattr(manifest, _IMAGE_FIELDS[path[1]], text)
+                if path[1] == 'digest':
+                    manifest.image_digest_algorithm = elem.get('algorithm')
+                elif path[1] in _ENCRYPTED_FIELDS:
+                    encrypted[path[1]] = text
+                    if path[1] == 'user_encrypted_key':
+                        enc_algorithm = elem.get('algorithm')
+            elif path[:3] == ('image', 'parts', 'part'):
+                if len(path) == 4:
+                    part_info[path[3]] = text
+                    if path[3] == 'digest':
+                        part_info['digest_algorithm'] = elem.get('algorithm')
+                else:
+                    manifest.image_parts[int(elem.get('index'))] = \
+                        euca2ools.bundle.BundlePart(
+                            part_info.get('filename'),
+                            part_info.get('digest'),
+                            part_info.get('digest_algorithm'))
+                    part_info = {}
+        for field in ('image_arch', 'image_name', 'account_id',
+                      'image_type', 'image_digest', 'image_size',
+                      'bundled_image_size'):
+            if getattr(manifest, field) is None:
+                raise ValueError('manifest has no {0}'.format(field))
+        manifest.image_size = int(manifest.image_size)
+        manifest.bundled_image_size = int(manifest.bundled_image_size)
         if privkey_filename is not None:
             try:
                 manifest.enc_key = _decrypt_hex(
-                    xml.image.user_encrypted_key.text.strip(),
-                    privkey_filename)
-            except (AttributeError, ValueError):
+                    encrypted.get('user_encrypted_key'), privkey_filename)
+            except ValueError:
                 manifest.enc_key = _decrypt_hex(
-                    xml.image.ec2_encrypted_key.text.strip(), privkey_filename)
-            manifest.enc_algorithm = xml.image.user_encrypted_key.get(
-                'algorithm')
+                    encrypted.get('ec2_encrypted_key'), privkey_filename)
+            manifest.enc_algorithm = enc_algorithm
             try:
                 manifest.enc_iv = _decrypt_hex(
-                    xml.image.user_encrypted_iv.text.strip(), privkey_filename)
-            except (AttributeError, ValueError):
+                    encrypted.get('user_encrypted_iv'), privkey_filename)
+            except ValueError:
                 manifest.enc_iv = _decrypt_hex(
-                    xml.image.ec2_encrypted_iv.text.strip(), privkey_filename)
+                    encrypted.get('ec2_encrypted_iv'), privkey_filename)
 
-        manifest.image_parts = [None] * int(xml.image.parts.get('count'))
-        for xml_part in xml.image.parts.iter(tag='part'):
-            index = int(xml_part.get('index'))
-            manifest.image_parts[index] = euca2ools.bundle.BundlePart(
-                xml_part.filename.text.strip(), xml_part.digest.text.strip(),
-                xml_part.digest.get('algorithm'))
         for index, part in enumerate(manifest.image_parts):
             if part is None:
                 raise ValueError('part {0} must not be None'.format(index))
@@ -118,6 +150,14 @@ class BundleManifest(object):
 
     def dump_to_str(self, privkey_filename, user_cert_filename,
                     ec2_cert_filename, pretty_print=False):
+        manifest_file = io.BytesIO()
+        self.dump_to_file(manifest_file, privkey_filename, user_cert_filename,
+                          ec2_cert_filename, pretty_print=pretty_print)
+        return manifest_file.getvalue().strip()
+
+    def dump_to_file(self, manifest_file, privkey_filename,
+                     user_cert_filename, ec2_cert_filename,
+                     pretty_print=False):
         if self.enc_key is None:
             raise ValueError('enc_key must not be None')
         if self.enc_iv is None:
@@ -129,6 +169,9 @@ class BundleManifest(object):
         self.log.debug('user certificate: %s', user_cert_filename)
         self.log.debug('user private key: %s', privkey_filename)
 
+        # Everything but the parts is small, so build that the usual way.
+        # The parts get written out one at a time so memory use stays the
+        # same no matter how many there are.
         xml = lxml.objectify.Element('manifest')
 
         # Manifest version
@@ -216,58 +259,79 @@ class BundleManifest(object):
             # Absence results in 400 (InvalidManifest)
             xml.image.user_encrypted_iv = None
 
-        # Bundle parts
-        xml.image.parts = None
-        xml.image.parts.set('count', str(len(self.image_parts)))
-        for index, part in enumerate(self.image_parts):
-            if part is None:
-                raise ValueError('part {0} must not be None'.format(index))
-            part_elem = lxml.objectify.Element('part')
-            part_elem.set('index', str(index))
-            part_elem.filename = os.path.basename(part.filename)
-            part_elem.digest = part.hexdigest
-            part_elem.digest.set('algorithm', part.digest_algorithm)
-            # part_elem.append(lxml.etree.Comment(
-            #     ' size: {0} '.format(part.size)))
-            xml.image.parts.append(part_elem)
-
-        # Cleanup for signature
-        lxml.objectify.deannotate(xml, xsi_nil=True)
-        lxml.etree.cleanup_namespaces(xml)
-        if privkey_filename:
-            to_sign = (lxml.etree.tostring(xml.machine_configuration) +
-                       lxml.etree.tostring(xml.image))
-            signature = _rsa_sha1_sign(to_sign, privkey_filename)
-        else:
-            # Absence yields 400 (InvalidManifest)
-            # Empty contents yield 500 (InternalError)
-            signature = 'UNSIGNED'
-        xml.signature = signature
-        self.log.debug('hex-encoded signature: %s', signature)
         lxml.objectify.deannotate(xml, xsi_nil=True)
         lxml.etree.cleanup_namespaces(xml)
-        self.log.debug('-- manifest content --\n', extra={'append': True})
-        pretty_manifest = lxml.etree.tostring(xml, pretty_print=True).strip()
-        self.log.debug('%s', pretty_manifest, extra={'append': True})
-        self.log.debug('-- end of manifest content --')
-        return lxml.etree.tostring(xml, xml_declaration=True,
-                                   pretty_print=pretty_print).strip()
 
-    def dump_to_file(self, manifest_file, privkey_filename,
-                     user_cert_filename, ec2_cert_filename,
-                     pretty_print=False):
-        manifest_file.write(self.dump_to_str(
-            privkey_filename, user_cert_filename, ec2_cert_filename,
-            pretty_print=pretty_print))
+        # The signature covers the serialized machine_configuration and
+        # image elements, which we hash as they go by.
+        to_sign = hashlib.sha1()
+        write = functools.partial(euca2ools.util.write_xml_element,
+                                  pretty_print=pretty_print)
+        with lxml.etree.xmlfile(manifest_file, encoding='ASCII') as xmlfile:
+            xmlfile.write_declaration()
+            with xmlfile.element('manifest'):
+                write(xmlfile, xml.version)
+                write(xmlfile, xml.bundler)
+                to_sign.update(write(xmlfile, xml.machine_configuration))
+                euca2ools.util.write_xml_indent(xmlfile, 1, pretty_print)
+                with xmlfile.element('image'):
+                    to_sign.update(b'<image>')
+                    for elem in xml.image.iterchildren():
+                        to_sign.update(write(xmlfile, elem, level=2))
+                    self.__write_parts(xmlfile, to_sign, pretty_print)
+                    euca2ools.util.write_xml_indent(xmlfile, 1, pretty_print)
+                    to_sign.update(b'</image>')
+
+                # Signature
+                if privkey_filename:
+                    signature = binascii.hexlify(
+                        euca2ools.crypto.rsa_sign_sha1_digest(
+                            to_sign.digest(), privkey_filename))
+                else:
+                    # Absence yields 400 (InvalidManifest)
+                    # Empty contents yield 500 (InternalError)
+                    signature = 'UNSIGNED'
+                self.log.debug('hex-encoded signature: %s', signature)
+                xml.signature = signature
+                write(xmlfile, xml.signature)
+                euca2ools.util.write_xml_indent(xmlfile, 0, pretty_print)
+        self.log.debug('wrote bundle manifest with %i parts',
+                       len(self.image_parts))
+
+    def __write_parts(self, xmlfile, to_sign, pretty_print):
+        euca2ools.util.write_xml_indent(xmlfile, 2, pretty_print)
+        count = str(len(self.image_parts))
+        with xmlfile.element('parts', count=count):
+            to_sign.update('<parts count="{0}">'.format(count).encode())
+            for index, part in enumerate(self.image_parts):
+                if part is None:
+                    raise ValueError('part {0} must not be None'
+                                     .format(index))
+                part_elem = lxml.objectify.Element('part')
+                part_elem.set('index', str(index))
+                part_elem.filename = os.path.basename(part.filename)
+                part_elem.digest = part.hexdigest
+                part_elem.digest.set('algorithm', part.digest_algorithm)
+                # part_elem.append(lxml.etree.Comment(
+                #     ' size: {0} '.format(part.size)))
+                to_sign.update(euca2ools.util.write_xml_element(
+                    xmlfile, part_elem, level=3, pretty_print=pretty_print))
+            euca2ools.util.write_xml_indent(xmlfile, 2, pretty_print)
+            to_sign.update(b'</parts>')
+
+
+_IMAGE_FIELDS = {'name': 'image_name', 'user': 'account_id',
+                 'type': 'image_type', 'digest': 'image_digest',
+                 'size': 'image_size', 'bundled_size': 'bundled_image_size'}
+_ENCRYPTED_FIELDS = ('user_encrypted_key', 'ec2_encrypted_key',
+                     'user_encrypted_iv', 'ec2_encrypted_iv')
 
 
 def _decrypt_hex(hex_encrypted_key, privkey_filename):
-    popen = subprocess.Popen(['openssl', 'rsautl', '-decrypt', '-pkcs',
-                              '-inkey', privkey_filename],
-                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    binary_encrypted_key = binascii.unhexlify(hex_encrypted_key)
-    (decrypted_key, _) = popen.communicate(binary_encrypted_key)
     try:
+        binary_encrypted_key = binascii.unhexlify(hex_encrypted_key or '')
+        decrypted_key = euca2ools.crypto.rsa_private_decrypt(
+            binary_encrypted_key, privkey_filename)
         # Make sure it might actually be an encryption key.
         # This isn't perfect, but it's still better than nothing.
         int(decrypted_key, 16)
@@ -280,18 +344,5 @@ def _decrypt_hex(hex_encrypted_key, privkey_filename):
 
 
 def _public_encrypt(content, cert_filename):
-    popen = subprocess.Popen(['openssl', 'rsautl', '-encrypt', '-pkcs',
-                              '-inkey', cert_filename, '-certin'],
-                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    (stdout, _) = popen.communicate(content)
-    return binascii.hexlify(stdout)
-
-
-def _rsa_sha1_sign(content, privkey_filename):
-    digest = hashlib.sha1()
-    digest.update(content)
-    popen = subprocess.Popen(['openssl', 'pkeyutl', '-sign', '-inkey',
-                              privkey_filename, '-pkeyopt', 'digest:sha1'],
-                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    (stdout, _) = popen.communicate(digest.digest())
-    return binascii.hexlify(stdout)
+    return binascii.hexlify(
+        euca2ools.crypto.rsa_public_encrypt(content, cert_filename))
@@ -25,69 +25,149 @@
 
 import hashlib
 import multiprocessing
+import os
 import shutil
 import subprocess
 import tarfile
+import threading
+import zlib
+
+import six
 
 import euca2ools.bundle.util
-from euca2ools.bundle.util import close_all_fds
+from euca2ools.bundle.pipes.stats import (finish_stage, get_report_mpconn,
+                                          instrument_reader,
+                                          instrument_writer, start_stage)
+from euca2ools.bundle.util import (close_all_fds, copy_fileobj,
+                                   read_exactly, set_pipe_size)
+from euca2ools.crypto import AESCBCDecryptor, AESCBCEncryptor
+
+
+# The in-process engine does all of its work in one address space, so it
+# can afford much larger chunks than the pipes between processes can.
+_IN_PROCESS_BUFSIZE = 64 * euca2ools.BUFSIZE  # 1 MiB
+
+# gzip wrapper, which is what gzip and pigz write
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
 
 
 def create_bundle_pipeline(infile, outfile, enc_key, enc_iv, tarinfo,
-                           debug=False):
-    pids = []
+                           debug=False, in_process=False,
+                           pipeline_stats=None, decompress=None):
+    """
+    Create a pipeline that tars, digests, compresses, and encrypts the
+    image read from infile, writing the result to outfile.
+
+    When in_process is True the whole pipeline runs in a single child
+    process using zlib and the cryptography library rather than a chain
+    of processes and pipes.  The tarball and its digest are the same
+    either way.
+
+    If decompress names a compression format (gzip, xz, or zstd), the
+    image is decompressed with the matching program on its way into the
+    pipeline.  tarinfo.size must be the decompressed image's size.  If
+    the decompressor fails or its output is not exactly that large,
+    receiving the digest raises RuntimeError.
+
+    If pipeline_stats is given, each stage records its stats there.
+
+    :returns multiprocess pipe to read sha1 digest of the tarball from
+    """
+    stages = []
+
+    if decompress:
+        # infile -> decompressor
+        decompressor = _start_decompressor(infile, decompress)
+        infile = decompressor.stdout
+        # The stage that reads what the decompressor writes reports how
+        # much that was.
+        size_result_r, size_result_w = multiprocessing.Pipe(duplex=False)
+        check = _DecompressionCheck(decompressor.name, tarinfo.size,
+                                    size_result_r)
+        _wait_for_stages([(decompressor.name, decompressor.pid)],
+                         pipeline_stats, status_callback=check.set_status)
+    else:
+        check = None
+        size_result_w = None
+
+    if in_process:
+        digest_result_r, digest_result_w = multiprocessing.Pipe(duplex=False)
+        bundler_p = multiprocessing.Process(
+            target=_bundle_in_process,
+            args=(infile, outfile, enc_key, enc_iv, tarinfo, digest_result_w),
+            kwargs={'debug': debug, 'pipeline_stats': pipeline_stats,
+                    'size_result_w': size_result_w})
+        bundler_p.start()
+        infile.close()
+        digest_result_w.close()
+        if size_result_w is not None:
+            size_result_w.close()
+        stages.append(('bundler', bundler_p.pid))
+        _wait_for_stages(stages, pipeline_stats)
+        if check is not None:
+            return check.wrap(digest_result_r)
+        return digest_result_r
 
     # infile -> tar
     tar_out_r, tar_out_w = euca2ools.bundle.util.open_pipe_fileobjs()
-    tar_p = multiprocessing.Process(target=_create_tarball_from_stream,
-                                    args=(infile, tar_out_w, tarinfo),
-                                    kwargs={'debug': debug})
+    tar_p = multiprocessing.Process(
+        target=_create_tarball_from_stream, args=(infile, tar_out_w, tarinfo),
+        kwargs={'debug': debug, 'pipeline_stats': pipeline_stats,
+                'size_result_w': size_result_w})
     tar_p.start()
-    pids.append(tar_p.pid)
+    stages.append(('tar', tar_p.pid))
     infile.close()
     tar_out_w.close()
+    if size_result_w is not None:
+        size_result_w.close()
 
     # tar -> sha1sum
     digest_out_r, digest_out_w = euca2ools.bundle.util.open_pipe_fileobjs()
     digest_result_r, digest_result_w = multiprocessing.Pipe(duplex=False)
     digest_p = multiprocessing.Process(
-        target=_calc_sha1_for_pipe, kwargs={'debug': debug},
-        args=(tar_out_r, digest_out_w, digest_result_w))
+        target=_calc_sha1_for_pipe,
+        args=(tar_out_r, digest_out_w, digest_result_w),
+        kwargs={'debug': debug, 'pipeline_stats': pipeline_stats})
     digest_p.start()
-    pids.append(digest_p.pid)
+    stages.append(('sha1', digest_p.pid))
     tar_out_r.close()
     digest_out_w.close()
     digest_result_w.close()
 
     # sha1sum -> gzip
+    # -n keeps the input's name and mtime out of the gzip header so the
+    # same image, key, and IV always yield the same bundle, which is
+    # what lets a journal recognize parts it has already uploaded.
     try:
-        gzip = subprocess.Popen(['pigz', '-c'], stdin=digest_out_r,
+        gzip = subprocess.Popen(['pigz', '-c', '-n'], stdin=digest_out_r,
                                 stdout=subprocess.PIPE, close_fds=True,
                                 bufsize=-1)
+        stages.append(('pigz', gzip.pid))
     except OSError:
-        gzip = subprocess.Popen(['gzip', '-c'], stdin=digest_out_r,
+        gzip = subprocess.Popen(['gzip', '-c', '-n'], stdin=digest_out_r,
                                 stdout=subprocess.PIPE, close_fds=True,
                                 bufsize=-1)
+        stages.append(('gzip', gzip.pid))
     digest_out_r.close()
-    pids.append(gzip.pid)
+    set_pipe_size(gzip.stdout)
 
     # gzip -> openssl
-    openssl = subprocess.Popen(['openssl', 'enc', '-e', '-aes-128-cbc',
-                                '-K', enc_key, '-iv', enc_iv],
-                               stdin=gzip.stdout, stdout=outfile,
-                               close_fds=True, bufsize=-1)
+    openssl = _start_openssl_enc(['-e', '-aes-128-cbc', '-K', enc_key,
+                                  '-iv', enc_iv], gzip.stdout, outfile,
+                                 pipeline_stats)
     gzip.stdout.close()
-    pids.append(openssl.pid)
+    stages.append(('openssl', openssl.pid))
 
-    # Make sure something calls wait() on every child process
-    for pid in pids:
-        euca2ools.bundle.util.waitpid_in_thread(pid)
+    _wait_for_stages(stages, pipeline_stats)
 
     # Return the connection the caller can use to obtain the final digest
+    if check is not None:
+        return check.wrap(digest_result_r)
     return digest_result_r
 
 
-def create_unbundle_pipeline(infile, outfile, enc_key, enc_iv, debug=False):
+def create_unbundle_pipeline(infile, outfile, enc_key, enc_iv, debug=False,
+                             in_process=False, pipeline_stats=None):
     """
     Create a pipeline to perform the unbundle operation on infile input.
     The resulting unbundled image will be written to 'outfile'.
@@ -95,59 +175,75 @@ def create_unbundle_pipeline(infile, outfile, enc_key, enc_iv, debug=False):
     :param outfile: file  obj to write unbundled image to
     :param enc_key: the encryption key used to bundle the image
     :param enc_iv: the encyrption initialization vector used in the bundle
+    :param in_process: decrypt, decompress, digest, and untar in a single
+                       child process instead of a chain of them
+    :param pipeline_stats: PipelineStats for each stage to record stats in
     :returns multiprocess pipe to read sha1 digest of written image
     """
-    pids = []
+    if in_process:
+        digest_result_r, digest_result_w = multiprocessing.Pipe(duplex=False)
+        unbundler_p = multiprocessing.Process(
+            target=_unbundle_in_process,
+            args=(infile, outfile, enc_key, enc_iv, digest_result_w),
+            kwargs={'debug': debug, 'pipeline_stats': pipeline_stats})
+        unbundler_p.start()
+        infile.close()
+        digest_result_w.close()
+        _wait_for_stages([('unbundler', unbundler_p.pid)], pipeline_stats)
+        return digest_result_r
+
+    stages = []
 
     # infile -> openssl
-    openssl = subprocess.Popen(['openssl', 'enc', '-d', '-aes-128-cbc',
-                                '-K', enc_key, '-iv', enc_iv],
-                               stdin=infile, stdout=subprocess.PIPE,
-                               close_fds=True, bufsize=-1)
-    pids.append(openssl.pid)
+    openssl = _start_openssl_enc(['-d', '-aes-128-cbc', '-K', enc_key,
+                                  '-iv', enc_iv], infile, subprocess.PIPE,
+                                 pipeline_stats)
+    stages.append(('openssl', openssl.pid))
     infile.close()
+    set_pipe_size(openssl.stdout)
 
     # openssl -> gzip
     try:
         gzip = subprocess.Popen(['pigz', '-c', '-d'], stdin=openssl.stdout,
                                 stdout=subprocess.PIPE, close_fds=True,
                                 bufsize=-1)
+        stages.append(('pigz', gzip.pid))
     except OSError:
         gzip = subprocess.Popen(['gzip', '-c', '-d'], stdin=openssl.stdout,
                                 stdout=subprocess.PIPE, close_fds=True,
                                 bufsize=-1)
-    pids.append(gzip.pid)
+        stages.append(('gzip', gzip.pid))
     openssl.stdout.close()
+    set_pipe_size(gzip.stdout)
 
     # gzip -> sha1sum
     digest_out_r, digest_out_w = euca2ools.bundle.util.open_pipe_fileobjs()
     digest_result_r, digest_result_w = multiprocessing.Pipe(duplex=False)
     digest_p = multiprocessing.Process(
-        target=_calc_sha1_for_pipe, kwargs={'debug': debug},
-        args=(gzip.stdout, digest_out_w, digest_result_w))
+        target=_calc_sha1_for_pipe,
+        args=(gzip.stdout, digest_out_w, digest_result_w),
+        kwargs={'debug': debug, 'pipeline_stats': pipeline_stats})
     digest_p.start()
-    pids.append(digest_p.pid)
+    stages.append(('sha1', digest_p.pid))
     gzip.stdout.close()
     digest_out_w.close()
     digest_result_w.close()
 
     # sha1sum -> tar
     tar_p = multiprocessing.Process(
-        target=_extract_from_tarball_stream,
-        args=(digest_out_r, outfile), kwargs={'debug': debug})
+        target=_extract_from_tarball_stream, args=(digest_out_r, outfile),
+        kwargs={'debug': debug, 'pipeline_stats': pipeline_stats})
     tar_p.start()
     digest_out_r.close()
-    pids.append(tar_p.pid)
+    stages.append(('untar', tar_p.pid))
 
-    # Make sure something calls wait() on every child process
-    for pid in pids:
-        euca2ools.bundle.util.waitpid_in_thread(pid)
+    _wait_for_stages(stages, pipeline_stats)
 
     # Return the connection the caller can use to obtain the final digest
     return digest_result_r
 
 
-def copy_with_progressbar(infile, outfile, progressbar=None):
+def copy_with_progressbar(infile, outfile, progressbar=None, stats=None):
     """
     Synchronously copy data from infile to outfile, updating a progress bar
     with the total number of bytes copied along the way if one was provided,
@@ -159,30 +255,179 @@ def copy_with_progressbar(infile, outfile, progressbar=None):
     :param outfile: file obj to write output to
     :param progressbar: progressbar object to update with i/o information
     :param maxbytes: Int maximum number of bytes to write
+    :param stats: StageStats to record the copy's stats in
     """
     bytes_written = 0
+    if stats is not None:
+        infile = instrument_reader(infile, stats)
+        outfile = instrument_writer(outfile, stats)
+        stats.start()
     if progressbar:
         progressbar.start()
     try:
-        while not infile.closed:
-            chunk = infile.read(euca2ools.BUFSIZE)
-            if chunk:
-                outfile.write(chunk)
-                outfile.flush()
-                bytes_written += len(chunk)
-                if progressbar:
-                    progressbar.update(bytes_written)
-
-            else:
-                break
+        if not infile.closed:
+            bytes_written = copy_fileobj(
+                infile, outfile,
+                progress_callback=(progressbar.update if progressbar
+                                   else None))
+            outfile.flush()
     finally:
         if progressbar:
             progressbar.finish()
         infile.close()
+        if stats is not None:
+            stats.stop()
     return bytes_written
 
 
-def _calc_sha1_for_pipe(infile, outfile, digest_out_pipe_w, debug=False):
+def _start_openssl_enc(args, stdin, stdout, pipeline_stats):
+    """
+    Start ``openssl enc`` with args and return its Popen object.  When
+    collecting stats, also have it count the bytes it reads and writes,
+    since nothing else can count what passes between it and the
+    compressor or decompressor next to it.
+    """
+    command = ['openssl', 'enc'] + list(args)
+    if pipeline_stats is None:
+        return subprocess.Popen(command, stdin=stdin, stdout=stdout,
+                                close_fds=True, bufsize=-1)
+    openssl = subprocess.Popen(command + ['-v'], stdin=stdin, stdout=stdout,
+                               stderr=subprocess.PIPE, close_fds=True,
+                               bufsize=-1)
+    pipeline_stats.watch_byte_counts('openssl', openssl.stderr)
+    return openssl
+
+
+def _start_decompressor(infile, compression):
+    """
+    Start a program that decompresses infile and return its Popen
+    object, with the program's name in its name attribute.
+    """
+    commands = _DECOMPRESSORS[compression]
+    for command in commands:
+        try:
+            proc = subprocess.Popen(command, stdin=infile,
+                                    stdout=subprocess.PIPE, close_fds=True,
+                                    bufsize=-1)
+        except OSError:
+            if command is commands[-1]:
+                raise
+        else:
+            proc.name = command[0]
+            infile.close()
+            set_pipe_size(proc.stdout)
+            return proc
+
+
+# Programs to try, in order, for each compression format
+_DECOMPRESSORS = {'gzip': (('pigz', '-c', '-d'), ('gzip', '-c', '-d')),
+                  'xz': (('xz', '-c', '-d'),),
+                  'zstd': (('zstd', '-c', '-d', '-q'),)}
+
+
+def _wait_for_stages(stages, pipeline_stats, status_callback=None):
+    """
+    Make sure something calls wait() on the process of every (name, pid)
+    pair in stages, recording their stats if pipeline_stats is not None
+    and passing their exit statuses to status_callback if it is given.
+    """
+    for name, pid in stages:
+        if pipeline_stats is not None:
+            pipeline_stats.watch_process(name, pid,
+                                         status_callback=status_callback)
+        else:
+            euca2ools.bundle.util.waitpid_in_thread(
+                pid, status_callback=status_callback)
+
+
+class _DecompressionCheck(object):
+    """
+    Make sure the decompressor at the head of a bundle pipeline exited
+    cleanly and wrote exactly as much data as the tarball holds before
+    anyone gets to use the bundle's digest.  Otherwise the tarball, and
+    thus the bundle, would be truncated or padded without any error.
+    """
+
+    def __init__(self, name, image_size, size_result_r):
+        self.name = name
+        self.image_size = image_size
+        self.__size_result_r = size_result_r
+        self.__status = None
+        self.__exited = threading.Event()
+
+    def set_status(self, status):
+        self.__status = status
+        self.__exited.set()
+
+    def wrap(self, digest_result_r):
+        return _CheckedDigestConnection(digest_result_r, self)
+
+    def check(self):
+        try:
+            # One more than image_size means there was more data left
+            size = self.__size_result_r.recv()
+        except EOFError:
+            size = None
+        finally:
+            self.__size_result_r.close()
+        if size is not None and size > self.image_size:
+            # The decompressor probably died of SIGPIPE after we stopped
+            # reading, so this has to come before checking its status.
+            raise RuntimeError(
+                'corrupt bundle: decompressed image is larger than the '
+                'expected image size of {0}'.format(self.image_size))
+        # Waiting with a timeout keeps this interruptible with ^C
+        while not self.__exited.is_set():
+            self.__exited.wait(0.1)
+        if self.__status:
+            raise RuntimeError(
+                'corrupt bundle: {0} failed while decompressing the image '
+                '(exit status {1})'.format(
+                    self.name, _describe_wait_status(self.__status)))
+        if size is None or size < self.image_size:
+            raise RuntimeError(
+                'corrupt bundle: decompressed image is smaller than the '
+                'expected image size of {0}'.format(self.image_size))
+
+    def close(self):
+        self.__size_result_r.close()
+
+
+class _CheckedDigestConnection(object):
+    """
+    A stand-in for a digest result connection that runs a
+    _DecompressionCheck before handing over the digest
+    """
+
+    def __init__(self, digest_result_r, check):
+        self.__digest_result_r = digest_result_r
+        self.__check = check
+
+    def recv(self):
+        try:
+            digest = self.__digest_result_r.recv()
+        except EOFError:
+            digest = None
+        # The decompressor's problems explain a missing digest better
+        # than the EOFError does.
+        self.__check.check()
+        if digest is None:
+            raise EOFError()
+        return digest
+
+    def close(self):
+        self.__digest_result_r.close()
+        self.__check.close()
+
+
+def _describe_wait_status(status):
+    if os.WIFSIGNALED(status):
+        return 'signal {0}'.format(os.WTERMSIG(status))
+    return os.WEXITSTATUS(status)
+
+
+def _calc_sha1_for_pipe(infile, outfile, digest_out_pipe_w, debug=False,
+                        pipeline_stats=None):
     """
     Read data from infile and write it to outfile, calculating a running SHA1
     digest along the way.  When infile hits end-of-file, send the digest in
@@ -191,18 +436,17 @@ def _calc_sha1_for_pipe(infile, outfile, digest_out_pipe_w, debug=False):
     :param outfile: file obj destination for writing output
     :param digest_out_pipe_w: fileobj to write digest to
     :param debug: boolean used in exception handling
+    :param pipeline_stats: PipelineStats to report this stage's stats to
     """
-    close_all_fds([infile, outfile, digest_out_pipe_w])
+    close_all_fds([infile, outfile, digest_out_pipe_w,
+                   get_report_mpconn(pipeline_stats)])
+    stage = start_stage('sha1', pipeline_stats)
+    infile = instrument_reader(infile, stage)
+    outfile = instrument_writer(outfile, stage)
     digest = hashlib.sha1()
     try:
-        while True:
-            chunk = infile.read(euca2ools.BUFSIZE)
-            if chunk:
-                digest.update(chunk)
-                outfile.write(chunk)
-                outfile.flush()
-            else:
-                break
+        copy_fileobj(infile, outfile, data_callback=digest.update)
+        outfile.flush()
         digest_out_pipe_w.send(digest.hexdigest())
     except IOError:
         # HACK
@@ -213,14 +457,19 @@ def _calc_sha1_for_pipe(infile, outfile, digest_out_pipe_w, debug=False):
         infile.close()
         outfile.close()
         digest_out_pipe_w.close()
+        finish_stage(stage, pipeline_stats)
 
 
-def _create_tarball_from_stream(infile, outfile, tarinfo, debug=False):
-    close_all_fds(except_fds=[infile, outfile])
-    tarball = tarfile.open(mode='w|', fileobj=outfile,
-                           bufsize=euca2ools.BUFSIZE)
+def _create_tarball_from_stream(infile, outfile, tarinfo, debug=False,
+                                pipeline_stats=None, size_result_w=None):
+    close_all_fds(except_fds=[infile, outfile, size_result_w,
+                              get_report_mpconn(pipeline_stats)])
+    stage = start_stage('tar', pipeline_stats)
+    infile = instrument_reader(infile, stage)
+    outfile = instrument_writer(outfile, stage)
     try:
-        tarball.addfile(tarinfo, fileobj=infile)
+        _write_tarball(infile, outfile, tarinfo)
+        _send_input_size(infile, tarinfo, size_result_w)
     except IOError:
         # HACK
         if not debug:
@@ -228,22 +477,116 @@ def _create_tarball_from_stream(infile, outfile, tarinfo, debug=False):
         raise
     finally:
         infile.close()
-        tarball.close()
         outfile.close()
+        if size_result_w is not None:
+            size_result_w.close()
+        finish_stage(stage, pipeline_stats)
 
 
-def _extract_from_tarball_stream(infile, outfile, debug=False):
+def _extract_from_tarball_stream(infile, outfile, debug=False,
+                                 pipeline_stats=None):
     """
     Perform tar extract on infile and write to outfile
     :param infile: file obj providing input for tar
     :param outfile: file obj destination for tar output
     :param debug: boolean used in exception handling
+    :param pipeline_stats: PipelineStats to report this stage's stats to
     """
-    close_all_fds([infile, outfile])
-    tarball = tarfile.open(mode='r|', fileobj=infile)
+    close_all_fds([infile, outfile, get_report_mpconn(pipeline_stats)])
+    stage = start_stage('untar', pipeline_stats)
+    infile = instrument_reader(infile, stage)
+    outfile = instrument_writer(outfile, stage)
     try:
-        tarinfo = next(tarball)
-        shutil.copyfileobj(tarball.extractfile(tarinfo), outfile)
+        header = read_exactly(infile, tarfile.BLOCKSIZE)
+        tarinfo = _parse_regular_file_header(header)
+        if tarinfo is not None:
+            # This is the usual case, so we can copy the image's data
+            # straight through without tarfile's help.
+            if copy_fileobj(infile, outfile, size=tarinfo.size) < \
+                    tarinfo.size:
+                raise tarfile.ReadError('unexpected end of data')
+            outfile.flush()
+            # The digest stage upstream needs to see the padding and the
+            # end-of-archive marker too, so read those as well.
+            while read_exactly(infile, tarfile.RECORDSIZE):
+                pass
+        else:
+            # Something fancier, like a long file name.  Let tarfile
+            # figure it out.
+            tarball = tarfile.open(mode='r|',
+                                   fileobj=_PrefixedReader(header, infile))
+            tarinfo = next(tarball)
+            shutil.copyfileobj(tarball.extractfile(tarinfo), outfile)
+            tarball.close()
+    except IOError:
+        # HACK
+        if not debug:
+            return
+        raise
+    finally:
+        infile.close()
+        outfile.close()
+        finish_stage(stage, pipeline_stats)
+
+
+def _bundle_in_process(infile, outfile, enc_key, enc_iv, tarinfo,
+                       digest_out_pipe_w, debug=False, pipeline_stats=None,
+                       size_result_w=None):
+    """
+    Do the work of the entire bundle pipeline in one process:  wrap the
+    data from infile in a tarball, digest that, compress it, encrypt it,
+    and write the result to outfile.  When that finishes, send the
+    tarball's digest in hex form to digest_out_pipe_w.
+    """
+    close_all_fds([infile, outfile, digest_out_pipe_w, size_result_w,
+                   get_report_mpconn(pipeline_stats)])
+    stage = start_stage('bundler', pipeline_stats)
+    infile = instrument_reader(infile, stage)
+    outfile = instrument_writer(outfile, stage)
+    encoder = _BundleEncoder(outfile, enc_key, enc_iv)
+    try:
+        _write_tarball(infile, encoder, tarinfo)
+        _send_input_size(infile, tarinfo, size_result_w)
+        encoder.close()
+        digest_out_pipe_w.send(encoder.digest.hexdigest())
+    except IOError:
+        # HACK
+        if not debug:
+            return
+        raise
+    finally:
+        infile.close()
+        outfile.close()
+        digest_out_pipe_w.close()
+        if size_result_w is not None:
+            size_result_w.close()
+        finish_stage(stage, pipeline_stats)
+
+
+def _unbundle_in_process(infile, outfile, enc_key, enc_iv, digest_out_pipe_w,
+                         debug=False, pipeline_stats=None):
+    """
+    Do the work of the entire unbundle pipeline in one process:  decrypt
+    and decompress the data from infile, digest it, and extract the image
+    from the resulting tarball to outfile.  When that finishes, send the
+    tarball's digest in hex form to digest_out_pipe_w.
+    """
+    close_all_fds([infile, outfile, digest_out_pipe_w,
+                   get_report_mpconn(pipeline_stats)])
+    stage = start_stage('unbundler', pipeline_stats)
+    infile = instrument_reader(infile, stage)
+    outfile = instrument_writer(outfile, stage)
+    decoder = _BundleDecoder(infile, enc_key, enc_iv)
+    tarball = tarfile.open(mode='r|', fileobj=decoder,
+                           bufsize=_IN_PROCESS_BUFSIZE)
+    try:
+        tarinfo = tarball.next()
+        shutil.copyfileobj(tarball.extractfile(tarinfo), outfile,
+                           _IN_PROCESS_BUFSIZE)
+        # The digest covers the whole tarball, including its padding
+        while decoder.read(_IN_PROCESS_BUFSIZE):
+            pass
+        digest_out_pipe_w.send(decoder.digest.hexdigest())
     except IOError:
         # HACK
         if not debug:
@@ -253,3 +596,157 @@ def _extract_from_tarball_stream(infile, outfile, debug=False):
         infile.close()
         tarball.close()
         outfile.close()
+        digest_out_pipe_w.close()
+        finish_stage(stage, pipeline_stats)
+
+
+def _send_input_size(infile, tarinfo, size_result_w):
+    """
+    After _write_tarball has copied tarinfo.size bytes from infile, send
+    how much data infile had to size_result_w:  tarinfo.size if that was
+    all of it, or one more than that if there was more.
+    """
+    if size_result_w is not None:
+        size_result_w.send(tarinfo.size + len(infile.read(1)))
+
+
+def _write_tarball(infile, outfile, tarinfo):
+    """
+    Write a single-member tarball to outfile the same way tarfile's
+    streaming mode does, but without copying everything through its
+    small internal buffer.
+    """
+    header = tarinfo.tobuf()
+    outfile.write(header)
+    if copy_fileobj(infile, outfile, size=tarinfo.size) < tarinfo.size:
+        raise IOError('end of file reached')
+    offset = len(header) + tarinfo.size
+    remainder = tarinfo.size % tarfile.BLOCKSIZE
+    if remainder:
+        outfile.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        offset += tarfile.BLOCKSIZE - remainder
+    # End-of-archive marker, then fill out the last record
+    outfile.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+    offset += tarfile.BLOCKSIZE * 2
+    remainder = offset % tarfile.RECORDSIZE
+    if remainder:
+        outfile.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+
+
+def _parse_regular_file_header(header):
+    """
+    Return a TarInfo for a tar header block if it describes a regular
+    file and needs no extended headers.  Otherwise, return None.
+    """
+    try:
+        if six.PY2:
+            tarinfo = tarfile.TarInfo.frombuf(header)
+        else:
+            tarinfo = tarfile.TarInfo.frombuf(header, tarfile.ENCODING,
+                                              'surrogateescape')
+    except tarfile.HeaderError:
+        return None
+    if tarinfo.type not in tarfile.REGULAR_TYPES:
+        return None
+    return tarinfo
+
+
+class _PrefixedReader(object):
+    """
+    A read-only file-like object that returns some data that were already
+    read from a file before continuing with the rest of the file
+    """
+
+    def __init__(self, prefix, fileobj):
+        self.__prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.__prefix:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            chunk = self.__prefix + self.fileobj.read()
+            self.__prefix = b''
+        else:
+            chunk = self.__prefix[:size]
+            self.__prefix = self.__prefix[size:]
+        return chunk
+
+
+class _BundleEncoder(object):
+    """
+    A write-only file-like object that digests, gzips, and encrypts
+    everything written to it before passing it along to outfile
+    """
+
+    def __init__(self, outfile, enc_key, enc_iv):
+        self.outfile = outfile
+        self.digest = hashlib.sha1()
+        self.__compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+        self.__encryptor = AESCBCEncryptor(enc_key, enc_iv)
+
+    def write(self, data):
+        self.digest.update(data)
+        compressed = self.__compressor.compress(data)
+        if compressed:
+            self.outfile.write(self.__encryptor.update(compressed))
+
+    def close(self):
+        compressed = self.__compressor.flush()
+        self.outfile.write(self.__encryptor.update(compressed) +
+                           self.__encryptor.finalize())
+        self.outfile.flush()
+
+
+class _BundleDecoder(object):
+    """
+    A read-only file-like object that decrypts and gunzips data from
+    infile, digesting it as it is read
+    """
+
+    def __init__(self, infile, enc_key, enc_iv):
+        self.infile = infile
+        self.digest = hashlib.sha1()
+        self.__decompressor = zlib.decompressobj(_GZIP_WBITS)
+        self.__decryptor = AESCBCDecryptor(enc_key, enc_iv)
+        self.__pending = b''
+        self.__eof = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(_IN_PROCESS_BUFSIZE)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            if not self.__pending:
+                if self.__eof:
+                    break
+                self.__fill()
+                continue
+            # Limiting the output keeps highly-compressible images (e.g.
+            # ones that are mostly zeroes) from eating all of our memory.
+            chunk = self.__decompressor.decompress(self.__pending, remaining)
+            self.__pending = self.__decompressor.unconsumed_tail
+            if self.__decompressor.unused_data:
+                # gzip -d accepts concatenated members, so we do too
+                self.__pending = self.__decompressor.unused_data
+                self.__decompressor = zlib.decompressobj(_GZIP_WBITS)
+            if chunk:
+                chunks.append(chunk)
+                remaining -= len(chunk)
+        data = b''.join(chunks)
+        self.digest.update(data)
+        return data
+
+    def __fill(self):
+        chunk = self.infile.read(_IN_PROCESS_BUFSIZE)
+        if chunk:
+            self.__pending = self.__decryptor.update(chunk)
+        else:
+            self.__pending = self.__decryptor.finalize()
+            self.__eof = True
@@ -23,14 +23,17 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import hashlib
 import itertools
 import multiprocessing
 import os
 import sys
 
 import euca2ools.bundle.pipes
+from euca2ools.bundle.pipes.stats import (finish_stage, get_report_mpconn,
+                                          instrument_reader,
+                                          instrument_writer, start_stage)
 import euca2ools.bundle.util
+from euca2ools.util import MultiDigest
 
 
 def create_bundle_part_deleter(in_mpconn, out_mpconn=None):
@@ -42,17 +45,34 @@ def create_bundle_part_deleter(in_mpconn, out_mpconn=None):
 
 
 def create_bundle_part_writer(infile, part_prefix, part_size,
-                              part_write_sem=None, debug=False):
+                              byte_budget=None, part_buffers=None,
+                              debug=False, pipeline_stats=None):
+    # When given a ByteBudget, the writer acquires a part's worth of bytes
+    # from it before writing each part, and whatever consumes the parts
+    # must release each part's size once it is done with it.
+    #
+    # When given a PartBufferRing as part_buffers, parts go into its slots
+    # instead of files, and the parts this sends out say which slot each
+    # one is in.  Nothing gets written to disk in that case, but part
+    # filenames still determine what they are named on the server.
     partinfo_result_r, partinfo_result_w = multiprocessing.Pipe(duplex=False)
 
     writer_p = multiprocessing.Process(
         target=_write_parts,
         args=(infile, part_prefix, part_size, partinfo_result_w),
-        kwargs={'part_write_sem': part_write_sem, 'debug': debug})
+        kwargs={'byte_budget': byte_budget,
+                'part_buffers': part_buffers, 'debug': debug,
+                'pipeline_stats': pipeline_stats})
     writer_p.start()
     partinfo_result_w.close()
+    if part_buffers is not None:
+        # Only the writer should be able to acquire slots
+        part_buffers.free_slots_r.close()
     infile.close()
-    euca2ools.bundle.util.waitpid_in_thread(writer_p.pid)
+    if pipeline_stats is not None:
+        pipeline_stats.watch_process('part-writer', writer_p.pid)
+    else:
+        euca2ools.bundle.util.waitpid_in_thread(writer_p.pid)
     return partinfo_result_r
 
 
@@ -115,30 +135,63 @@ def _aggregate_mpconn_items(in_mpconn, result_mpconn, out_mpconn=None,
 
 
 def _write_parts(infile, part_prefix, part_size, partinfo_mpconn,
-                 part_write_sem=None, debug=False):
-    except_fds = [infile, partinfo_mpconn]
-    if part_write_sem is not None and sys.platform == 'darwin':
+                 byte_budget=None, part_buffers=None, debug=False,
+                 pipeline_stats=None):
+    except_fds = [infile, partinfo_mpconn, get_report_mpconn(pipeline_stats)]
+    if part_buffers is not None:
+        except_fds.append(part_buffers.free_slots_r)
+    if byte_budget is not None and sys.platform == 'darwin':
         # When I ran close_all_fds on OS X and excluded only the FDs
         # listed above, all attempts to use the semaphore resulted in
         # complaints about bad file descriptors.  The following code
         # is a horrible hack that I stumbled upon while attempting
         # to figure out what FD number I needed to avoid closing to
-        # preserve the semaphore.  It is probably incorrect and reliant
+        # preserve the semaphore.  The byte budget's condition variable
+        # is made of several of them.  It is probably incorrect and reliant
         # on implementation details, so I am happy to take a patch that
         # manages to deal with this problem in a more reasonable way.
         try:
-            except_fds.append(int(part_write_sem._semlock.handle))
+            except_fds.extend(byte_budget.get_semlock_handles())
         except AttributeError:
-            part_write_sem = None
+            byte_budget = None
         except ValueError:
-            part_write_sem = None
+            byte_budget = None
     euca2ools.bundle.util.close_all_fds(except_fds=except_fds)
+    stage = start_stage('part-writer', pipeline_stats)
+    infile = instrument_reader(infile, stage)
+    try:
+        _write_parts_to(infile, part_prefix, part_size, partinfo_mpconn,
+                        byte_budget, part_buffers, stage, debug)
+    finally:
+        finish_stage(stage, pipeline_stats)
+
+
+def _write_parts_to(infile, part_prefix, part_size, partinfo_mpconn,
+                    byte_budget, part_buffers, stage, debug):
     for part_no in itertools.count():
-        if part_write_sem is not None:
-            part_write_sem.acquire()
+        if byte_budget is not None and not byte_budget.acquire(part_size):
+            # Whatever was consuming parts went away
+            infile.close()
+            partinfo_mpconn.close()
+            return
         part_fname = '{0}.part.{1:02}'.format(part_prefix, part_no)
-        part_digest = hashlib.sha1()
-        with open(part_fname, 'w') as part:
+        # The MD5 is what object storage will use as the part's ETag, so
+        # computing it now spares uploaders from doing it again.
+        part_digest = MultiDigest('sha1', 'md5')
+        if part_buffers is not None:
+            try:
+                slot = part_buffers.acquire()
+            except EOFError:
+                # Whatever was consuming parts went away
+                infile.close()
+                partinfo_mpconn.close()
+                return
+            part_cm = _PartBufferSlotWriter(part_buffers, slot)
+        else:
+            slot = None
+            part_cm = open(part_fname, 'w')
+        with part_cm as part:
+            part = instrument_writer(part, stage)
             bytes_written = 0
             bytes_to_write = part_size
             while bytes_to_write > 0:
@@ -158,10 +211,31 @@ def _write_parts(infile, part_prefix, part_size, partinfo_mpconn,
                 else:
                     break
             partinfo = euca2ools.bundle.BundlePart(
-                part_fname, part_digest.hexdigest(), 'SHA1', bytes_written)
+                part_fname, part_digest.hexdigest('sha1'), 'SHA1',
+                bytes_written, md5_hexdigest=part_digest.hexdigest('md5'),
+                buffer_slot=slot)
+            if byte_budget is not None and bytes_written < part_size:
+                byte_budget.return_unused(part_size - bytes_written)
             partinfo_mpconn.send(partinfo)
         if bytes_written < part_size:
             # That's the last part
             infile.close()
             partinfo_mpconn.close()
             return
+
+
+class _PartBufferSlotWriter(object):
+    def __init__(self, part_buffers, slot):
+        self.part_buffers = part_buffers
+        self.slot = slot
+        self.__offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def write(self, data):
+        self.part_buffers.write(self.slot, self.__offset, data)
+        self.__offset += len(data)
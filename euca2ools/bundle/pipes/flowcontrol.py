@@ -0,0 +1,194 @@
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Flow control between a stage that produces data faster than a later
+stage can get rid of it, such as a part writer and the uploader that
+consumes its parts.
+
+A ByteBudget limits how many bytes may be in flight between the two at
+once.  The limit starts out at a minimum that should keep the consumer
+busy and grows or shrinks with how fast the consumer actually drains
+data, so a fast consumer gets a deeper buffer and a slow one does not
+let data pile up.  When the data go to disk, the budget also holds the
+producer back when the file system they go to runs low on free space.
+"""
+
+import ctypes
+import multiprocessing
+import os
+import time
+
+
+_POLL_INTERVAL = 0.5  # seconds between free space checks
+_SPACE_GRACE_TIME = 5  # seconds to wait for space with nothing in flight
+_RATE_WEIGHT = 0.3  # weight of the newest sample in the drain rate
+
+
+class ByteBudget(object):
+    """
+    A limit on the number of bytes in flight between pipeline stages that
+    works across processes as well as threads.  It must be created before
+    any of the processes that use it are forked.
+
+    The producer calls acquire before it produces each item and the
+    consumer calls release once it is done with each one.  The number of
+    bytes allowed in flight at once, the window, is however many bytes
+    the consumer drains in target_time seconds, but never less than
+    min_bytes or more than max_bytes.
+
+    If path is given, acquire also waits for the file system that path
+    is on to have room for the bytes being acquired plus reserve_bytes.
+    Since something else may be using the same file system, this waits
+    only so long when nothing is in flight before it gives up and lets
+    the producer go ahead anyway.
+
+    One item is always allowed in flight, no matter how large it is, so
+    a window smaller than an item cannot stop things altogether.
+    """
+
+    def __init__(self, min_bytes, max_bytes=None, target_time=10,
+                 path=None, reserve_bytes=64 * 2 ** 20):
+        self.min_bytes = min_bytes
+        self.max_bytes = max(min_bytes, max_bytes or min_bytes)
+        self.target_time = target_time
+        self.path = path
+        self.reserve_bytes = reserve_bytes
+        self.__cond = multiprocessing.Condition()
+        self.__in_flight = multiprocessing.Value(ctypes.c_longlong, 0,
+                                                 lock=False)
+        self.__window = multiprocessing.Value(ctypes.c_longlong, min_bytes,
+                                              lock=False)
+        self.__rate = multiprocessing.Value(ctypes.c_double, 0.0,
+                                            lock=False)
+        self.__mark = multiprocessing.Value(ctypes.c_double, 0.0,
+                                            lock=False)
+        self.__closed = multiprocessing.Value(ctypes.c_int, 0, lock=False)
+
+    @property
+    def window(self):
+        with self.__cond:
+            return self.__window.value
+
+    @property
+    def drain_rate(self):
+        """
+        The rate at which the consumer has been draining data, in bytes
+        per second, or None if that is not known yet
+        """
+        with self.__cond:
+            return self.__rate.value or None
+
+    def acquire(self, nbytes, block=True):
+        """
+        Reserve nbytes for an item that is about to be produced and
+        return True.  If the window is full or there is not enough free
+        space for it, wait for that to change unless block is False, in
+        which case return False right away.  Return False as well if the
+        budget has been closed.
+        """
+        started = time.time()
+        with self.__cond:
+            while not self.__closed.value:
+                in_flight = self.__in_flight.value
+                if in_flight == 0 or (in_flight + nbytes <=
+                                      self.__window.value):
+                    if (in_flight == 0 and
+                            time.time() - started >= _SPACE_GRACE_TIME):
+                        break
+                    if self.__has_space_for(nbytes):
+                        break
+                if not block:
+                    return False
+                self.__cond.wait(_POLL_INTERVAL if self.path else None)
+            else:
+                return False
+            if in_flight == 0:
+                # Measure the drain rate only while there is something
+                # to drain.
+                self.__mark.value = time.time()
+            self.__in_flight.value = in_flight + nbytes
+            return True
+
+    def release(self, nbytes):
+        """
+        Give back nbytes for an item the consumer is done with and use
+        how long that took to adjust the window
+        """
+        with self.__cond:
+            now = time.time()
+            elapsed = now - self.__mark.value
+            self.__mark.value = now
+            self.__in_flight.value = max(self.__in_flight.value - nbytes, 0)
+            if elapsed > 0 and nbytes > 0:
+                sample = nbytes / elapsed
+                if self.__rate.value:
+                    self.__rate.value = (_RATE_WEIGHT * sample +
+                                         (1 - _RATE_WEIGHT) *
+                                         self.__rate.value)
+                else:
+                    self.__rate.value = sample
+                self.__window.value = int(min(
+                    max(self.__rate.value * self.target_time,
+                        self.min_bytes), self.max_bytes))
+            self.__cond.notify_all()
+
+    def return_unused(self, nbytes):
+        """
+        Give back part of what was acquired for an item that turned out
+        to be smaller than expected.  This does not count as draining.
+        """
+        with self.__cond:
+            self.__in_flight.value = max(self.__in_flight.value - nbytes, 0)
+            self.__cond.notify_all()
+
+    def close(self):
+        """
+        Make everything waiting to acquire bytes, now or later, give up
+        """
+        with self.__cond:
+            self.__closed.value = 1
+            self.__cond.notify_all()
+
+    def get_semlock_handles(self):
+        """
+        Return the handles of the semaphores underneath this, for
+        platforms where they are file descriptors that close_all_fds
+        must not close.  This relies on implementation details of
+        multiprocessing.Condition.
+        """
+        return [int(sem._semlock.handle) for sem in
+                (self.__cond._lock, self.__cond._sleeping_count,
+                 self.__cond._woken_count, self.__cond._wait_semaphore)]
+
+    def __has_space_for(self, nbytes):
+        if not self.path:
+            return True
+        try:
+            fsstat = os.statvfs(self.path)
+        except OSError:
+            return True
+        return (fsstat.f_bavail * fsstat.f_frsize - nbytes >=
+                self.reserve_bytes)
@@ -0,0 +1,394 @@
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Per-stage statistics for bundle pipelines, so one can tell which stage
+is holding the others up.
+
+Each stage gets a StageStats.  Stages we run in python count the bytes
+they read and write and how long they spend blocked doing so, then send
+their stats to the PipelineStats that the pipeline was built with.  CPU
+time for child processes comes from wait4 as they exit, so it is also
+available for external programs like gzip and openssl.  Of those, only
+openssl can count its own bytes, which also tells us what the
+compressor next to it read or wrote.
+"""
+
+import json
+import multiprocessing
+import resource
+import sys
+import threading
+import time
+
+import euca2ools.bundle.util
+
+
+# What openssl enc -v calls the byte counts it prints
+_OPENSSL_BYTE_COUNTS = {b'bytes read': 'bytes_in',
+                        b'bytes written': 'bytes_out'}
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.bytes_in = None
+        self.bytes_out = None
+        self.read_time = None  # seconds spent in read calls
+        self.write_time = None  # seconds spent in write calls
+        self.wall_time = None
+        self.user_time = None
+        self.system_time = None
+        self.__start_time = None
+        self.__start_rusage = None
+
+    def start(self):
+        self.__start_time = time.time()
+        self.__start_rusage = resource.getrusage(resource.RUSAGE_SELF)
+
+    def stop(self):
+        """
+        Record the wall time and the CPU time this process used since
+        start was called.
+        """
+        if self.__start_time is None:
+            return
+        self.wall_time = time.time() - self.__start_time
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        self.user_time = rusage.ru_utime - self.__start_rusage.ru_utime
+        self.system_time = rusage.ru_stime - self.__start_rusage.ru_stime
+
+    def add_bytes_in(self, nbytes):
+        self.bytes_in = (self.bytes_in or 0) + nbytes
+
+    def add_bytes_out(self, nbytes):
+        self.bytes_out = (self.bytes_out or 0) + nbytes
+
+    def update(self, other):
+        """
+        Fill in anything this does not know yet that another StageStats
+        for the same stage does
+        """
+        for attr in ('bytes_in', 'bytes_out', 'read_time', 'write_time',
+                     'wall_time', 'user_time', 'system_time'):
+            if getattr(self, attr) is None:
+                setattr(self, attr, getattr(other, attr))
+
+    @property
+    def throughput(self):
+        """
+        Bytes per second moving through the stage
+        """
+        nbytes = self.bytes_in if self.bytes_in is not None else \
+            self.bytes_out
+        if nbytes is None or not self.wall_time:
+            return None
+        return nbytes / self.wall_time
+
+    def as_dict(self):
+        return {'stage': self.name, 'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out, 'read_time': self.read_time,
+                'write_time': self.write_time, 'wall_time': self.wall_time,
+                'user_time': self.user_time,
+                'system_time': self.system_time,
+                'throughput': self.throughput}
+
+
+class PipelineStats(object):
+    """
+    Stats for all of the stages in a pipeline, in pipeline order.
+
+    This must be created before any of the processes that report to it
+    are forked.  Stages running in other processes report to it through
+    mpconn, and collect must be called after the pipeline finishes to
+    gather everything up.
+
+    Stats get a pipe of their own rather than riding along on the pipes
+    stages already send results through:  those carry digests, sizes,
+    and part info to consumers that know nothing about stats, and some
+    stages have no result pipe at all.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.__stages_by_name = {}
+        self.__lock = threading.Lock()
+        self.__exited = []
+        self.__counted = []
+        self.__mpconn_r, self.mpconn = multiprocessing.Pipe(duplex=False)
+
+    def add_stage(self, name):
+        with self.__lock:
+            if name not in self.__stages_by_name:
+                stage = StageStats(name)
+                self.stages.append(stage)
+                self.__stages_by_name[name] = stage
+            return self.__stages_by_name[name]
+
+    def watch_process(self, name, pid, status_callback=None):
+        """
+        Reap a pipeline stage's process when it exits, the way
+        euca2ools.bundle.util.waitpid_in_thread does, and record how much
+        CPU time it used.  status_callback, if given, gets the process's
+        exit status.
+        """
+        stage = self.add_stage(name)
+        exited = threading.Event()
+        self.__exited.append(exited)
+
+        def record_rusage(rusage):
+            # This counts everything the process did, so it wins over
+            # whatever the process measured for itself.
+            if rusage is not None:
+                with self.__lock:
+                    stage.user_time = rusage.ru_utime
+                    stage.system_time = rusage.ru_stime
+            exited.set()
+        euca2ools.bundle.util.waitpid_in_thread(
+            pid, rusage_callback=record_rusage,
+            status_callback=status_callback)
+
+    def watch_byte_counts(self, name, stderr):
+        """
+        Record the byte counts that ``openssl enc -v`` writes to stderr
+        when it finishes, passing anything else it writes, such as error
+        messages, along to our own stderr.
+        """
+        # Only add the stage at collect time so stages stay in the order
+        # the pipeline runs them in.
+        stage = StageStats(name)
+        finished = threading.Event()
+        self.__exited.append(finished)
+        self.__counted.append(stage)
+
+        def read_counts():
+            try:
+                for line in iter(stderr.readline, b''):
+                    label, _, value = line.partition(b':')
+                    attr = _OPENSSL_BYTE_COUNTS.get(label.strip())
+                    if attr is not None and value.strip().isdigit():
+                        setattr(stage, attr, int(value))
+                    elif not line.startswith(b'bufsize='):
+                        sys.stderr.write(line.decode('utf-8', 'replace'))
+            finally:
+                stderr.close()
+                finished.set()
+        thread = threading.Thread(target=read_counts)
+        thread.daemon = True
+        thread.start()
+
+    def report(self, stage):
+        """
+        Send a finished stage's stats to whatever process is collecting
+        them.  This works from any process the pipeline created.
+        """
+        try:
+            self.mpconn.send(stage)
+        except IOError:
+            # Stats are not worth failing over
+            pass
+
+    def collect(self, timeout=10):
+        """
+        Wait for every stage to finish reporting and return the stages.
+        Bytes in and out for external programs, which cannot report
+        them, are filled in from the stages next to them.
+        """
+        self.mpconn.close()
+        for reported in euca2ools.bundle.util.iter_mpconn(self.__mpconn_r):
+            stage = self.add_stage(reported.name)
+            with self.__lock:
+                stage.update(reported)
+        self.__mpconn_r.close()
+        deadline = time.time() + timeout
+        for exited in self.__exited:
+            exited.wait(max(deadline - time.time(), 0))
+        for counted in self.__counted:
+            stage = self.add_stage(counted.name)
+            with self.__lock:
+                stage.update(counted)
+        with self.__lock:
+            for prev_stage, stage in zip(self.stages, self.stages[1:]):
+                if stage.bytes_in is None:
+                    stage.bytes_in = prev_stage.bytes_out
+                if prev_stage.bytes_out is None:
+                    prev_stage.bytes_out = stage.bytes_in
+            return list(self.stages)
+
+    def as_json(self):
+        return json.dumps({'stages': [stage.as_dict() for stage in
+                                      self.stages]}, indent=2, sort_keys=True)
+
+    def as_table(self):
+        headers = ('STAGE', 'BYTES IN', 'BYTES OUT', 'READ WAIT',
+                   'WRITE WAIT', 'CPU USER', 'CPU SYS', 'WALL', 'MiB/s')
+        rows = [headers]
+        for stage in self.stages:
+            throughput = stage.throughput
+            if throughput is not None:
+                throughput /= 2 ** 20
+            rows.append((stage.name, _fmt(stage.bytes_in),
+                         _fmt(stage.bytes_out), _fmt(stage.read_time),
+                         _fmt(stage.write_time), _fmt(stage.user_time),
+                         _fmt(stage.system_time), _fmt(stage.wall_time),
+                         _fmt(throughput)))
+        widths = [max(len(row[col]) for row in rows)
+                  for col in range(len(headers))]
+        return '\n'.join('  '.join(cell.ljust(width) if col == 0 else
+                                   cell.rjust(width)
+                                   for col, (cell, width) in
+                                   enumerate(zip(row, widths))).rstrip()
+                         for row in rows)
+
+
+def get_report_mpconn(pipeline_stats):
+    """
+    Return the connection a child process must keep open to report to
+    pipeline_stats, or None if there is nothing to report to.
+    """
+    if pipeline_stats is None:
+        return None
+    return pipeline_stats.mpconn
+
+
+def start_stage(name, pipeline_stats):
+    """
+    Return a started StageStats for a stage if pipeline_stats is not
+    None.  Otherwise, return None.
+    """
+    if pipeline_stats is None:
+        return None
+    stage = StageStats(name)
+    stage.start()
+    return stage
+
+
+def finish_stage(stage, pipeline_stats):
+    if stage is not None and pipeline_stats is not None:
+        stage.stop()
+        pipeline_stats.report(stage)
+
+
+def instrument_reader(fileobj, stage):
+    """
+    If stage is not None, return a wrapper around a file object that
+    counts what is read from it in stage.  Otherwise, return the file
+    object itself.
+    """
+    if stage is None:
+        return fileobj
+    stage.bytes_in = stage.bytes_in or 0
+    stage.read_time = stage.read_time or 0.0
+    return _InstrumentedReader(fileobj, stage)
+
+
+def instrument_writer(fileobj, stage):
+    """
+    If stage is not None, return a wrapper around a file object that
+    counts what is written to it in stage.  Otherwise, return the file
+    object itself.
+    """
+    if stage is None:
+        return fileobj
+    stage.bytes_out = stage.bytes_out or 0
+    stage.write_time = stage.write_time or 0.0
+    return _InstrumentedWriter(fileobj, stage)
+
+
+def instrument_iter(iterable, stage):
+    """
+    If stage is not None, return a generator that counts the time spent
+    waiting for each item from an iterable as reading time in stage.
+    Otherwise, return the iterable itself.
+    """
+    if stage is None:
+        return iterable
+    stage.read_time = stage.read_time or 0.0
+    return _instrumented_iter(iterable, stage)
+
+
+def _instrumented_iter(iterable, stage):
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            stage.read_time += time.time() - start
+        yield item
+
+
+class _InstrumentedFile(object):
+    def __init__(self, fileobj, stage):
+        self.fileobj = fileobj
+        self.stage = stage
+
+    @property
+    def closed(self):
+        return self.fileobj.closed
+
+    def close(self):
+        self.fileobj.close()
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _InstrumentedReader(_InstrumentedFile):
+    def read(self, size=-1):
+        start = time.time()
+        chunk = self.fileobj.read(size)
+        self.stage.read_time += time.time() - start
+        self.stage.bytes_in += len(chunk)
+        return chunk
+
+
+class _InstrumentedWriter(_InstrumentedFile):
+    def write(self, data):
+        start = time.time()
+        self.fileobj.write(data)
+        self.stage.write_time += time.time() - start
+        self.stage.bytes_out += len(data)
+
+    def flush(self):
+        start = time.time()
+        self.fileobj.flush()
+        self.stage.write_time += time.time() - start
+
+
+def _fmt(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '{0:.2f}'.format(value)
+    return str(value)
@@ -23,10 +23,68 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import io
+import mmap
+import multiprocessing
 import os
+import re
+import stat
 import subprocess
+import sys
 import threading
 
+import euca2ools.crypto
+
+
+# Python 2 does not name the lseek whence values used to find holes in
+# sparse files.  Their numbers differ between platforms (Darwin swaps
+# them), so we fall back to numbers only on Linux and otherwise read
+# sparse files the slow way.
+if hasattr(os, 'SEEK_DATA') and hasattr(os, 'SEEK_HOLE'):
+    SEEK_DATA = os.SEEK_DATA
+    SEEK_HOLE = os.SEEK_HOLE
+elif sys.platform.startswith('linux'):
+    SEEK_DATA = 3
+    SEEK_HOLE = 4
+else:
+    SEEK_DATA = None
+    SEEK_HOLE = None
+
+# Likewise for these, which live in libc
+_POSIX_FADV_DONTNEED = 4
+_SYNC_FILE_RANGE_WAIT_BEFORE = 1
+_SYNC_FILE_RANGE_WRITE = 2
+_SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+_SPLICE_F_MOVE = 1
+_SPLICE_F_MORE = 4
+
+# Python only names these fcntl commands from 3.10 on
+_F_SETPIPE_SZ = 1031
+
+_LIBC = None
+
+# How big to ask for the pipes between bundle stages to be, which is also
+# how much we try to move between them at once.  Unprivileged processes
+# may grow pipes up to /proc/sys/fs/pipe-max-size, which is 1 MiB by
+# default.
+PIPE_SIZE = 1024 * 1024
+
+# File objects whose file descriptors we may use directly
+try:
+    _PLAIN_FILE_TYPES = (file, io.FileIO,  # pylint: disable=undefined-variable
+                         io.BufferedReader, io.BufferedWriter)
+except NameError:  # python 3
+    _PLAIN_FILE_TYPES = (io.FileIO, io.BufferedReader, io.BufferedWriter)
+
+# Part files are read whole, so there is no need to be stingy
+_PART_HASH_BUFSIZE = 1024 * 1024
+
 
 def close_all_fds(except_fds=None):
     except_filenos = [1, 2]
@@ -55,31 +113,681 @@ def close_all_fds(except_fds=None):
 
 
 def get_cert_fingerprint(cert_filename):
-    openssl = subprocess.Popen(('openssl', 'x509', '-in', cert_filename,
-                                '-fingerprint', '-sha1', '-noout'),
-                               stdout=subprocess.PIPE)
-    (fingerprint, _) = openssl.communicate()
-    return fingerprint.strip().rsplit('=', 1)[-1].replace(':', '').lower()
+    return euca2ools.crypto.get_cert_fingerprint(cert_filename)
+
+
+# Compressed image formats that can be bundled without decompressing them
+# to disk first, along with the magic numbers their files start with
+IMAGE_COMPRESSION_MAGIC = (('gzip', b'\x1f\x8b'),
+                           ('xz', b'\xfd7zXZ\x00'),
+                           ('zstd', b'\x28\xb5\x2f\xfd'))
+IMAGE_COMPRESSION_SUFFIXES = {'gzip': '.gz', 'xz': '.xz', 'zstd': '.zst'}
+
+
+def detect_image_compression(filename):
+    """
+    Return the name of the compression format a file uses (one of those
+    in IMAGE_COMPRESSION_MAGIC), or None if it does not look compressed
+    """
+    with open(filename, 'rb') as image:
+        magic = image.read(6)
+    for compression, prefix in IMAGE_COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def get_uncompressed_image_size(filename, compression):
+    """
+    Return how large a compressed image will be once it is decompressed,
+    or None if that cannot be determined without decompressing it.
+
+    xz files always record this, and zstd files usually do.  gzip files
+    record it only modulo 4 GiB, which is too small to trust for disk
+    images, so this always returns None for them.
+    """
+    if compression == 'xz':
+        cmd = ('xz', '--robot', '--list', filename)
+    elif compression == 'zstd':
+        cmd = ('zstd', '--list', '-v', filename)
+    else:
+        return None
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        (stdout, _) = proc.communicate()
+    except OSError:
+        return None
+    if proc.returncode != 0:
+        return None
+    stdout = stdout.decode('ascii', 'replace')
+    if compression == 'xz':
+        # totals  STREAMS  BLOCKS  COMPRESSED  UNCOMPRESSED  ...
+        for line in stdout.splitlines():
+            fields = line.split('\t')
+            if fields[0] == 'totals' and len(fields) > 4:
+                return int(fields[4])
+    else:
+        match = re.search(r'Decompressed Size:.*\((\d+) B\)', stdout)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def find_corrupt_bundle_parts(parts, processes=None):
+    """
+    Hash a bundle's local part files concurrently using a pool of
+    processes and return a list of (part, problem) tuples for every part
+    whose file does not match its digest, where problem is a string that
+    describes what went wrong.
+    """
+    if not parts:
+        return []
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        # Waiting with a timeout keeps this interruptible with ^C
+        results = pool.map_async(
+            _hash_part_file,
+            [(part.filename, part.digest_algorithm) for part in parts],
+            chunksize=1).get(2 ** 31)
+    finally:
+        pool.terminate()
+        pool.join()
+    bad_parts = []
+    for part, (actual_digest, error) in zip(parts, results):
+        if error:
+            bad_parts.append((part, error))
+        elif int(actual_digest, 16) != int(part.hexdigest, 16):
+            bad_parts.append((part, '{0} mismatch (expected: {1}, actual: '
+                              '{2})'.format(part.digest_algorithm,
+                                            part.hexdigest, actual_digest)))
+    return bad_parts
+
+
+def _hash_part_file(filename_and_algorithm):
+    filename, algorithm = filename_and_algorithm
+    try:
+        digest = hashlib.new(algorithm.lower())
+        with open(filename, 'rb') as part_file:
+            while True:
+                chunk = part_file.read(_PART_HASH_BUFSIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        return digest.hexdigest(), None
+    except (IOError, OSError, ValueError) as err:
+        return None, str(err)
+
+
+def iter_mpconn(mpconn):
+    """
+    Generate the items received from a multiprocessing connection until
+    the other end closes it.
+    """
+    try:
+        while True:
+            yield mpconn.recv()
+    except EOFError:
+        return
 
 
 def open_pipe_fileobjs():
     pipe_r, pipe_w = os.pipe()
+    set_pipe_size(pipe_w)
     return os.fdopen(pipe_r), os.fdopen(pipe_w, 'w')
 
 
-def waitpid_in_thread(pid):
+def set_pipe_size(pipe, size=PIPE_SIZE):
+    """
+    Try to enlarge a pipe's buffer so the processes at either end of it
+    can move more data per system call and wait on each other less
+    often.  Return whether that worked.
+    """
+    if hasattr(pipe, 'fileno'):
+        pipe = pipe.fileno()
+    try:
+        fcntl.fcntl(pipe, _F_SETPIPE_SZ, size)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def copy_fileobj(infile, outfile, size=None, data_callback=None,
+                 progress_callback=None):
+    """
+    Copy data from infile to outfile until end-of-file or until size bytes
+    have been copied, and return the number of bytes copied.
+
+    When both are plain files, data move between their file descriptors
+    with splice, or with tee if data_callback needs to see them, so they
+    never pass through python at all.  Where that is not possible they
+    are read into a buffer that gets reused for each chunk.  Nothing may
+    be sitting in infile's read buffer when this is called.
+
+    If data_callback is given it is called with each chunk of data, which
+    may be a memoryview that is only valid during the call.  If
+    progress_callback is given it is called with the number of bytes
+    copied so far after each chunk.
+    """
+    in_fd = _get_plain_fd(infile)
+    out_fd = _get_plain_fd(outfile)
+    if in_fd is None or out_fd is None:
+        return _copy_fileobj_via_read(infile, outfile, size, data_callback,
+                                      progress_callback)
+    outfile.flush()
+    copied = _copy_fd_via_splice(in_fd, out_fd, size, data_callback,
+                                 progress_callback)
+    if copied is None:
+        copied = _copy_fd_via_readinto(in_fd, out_fd, size, data_callback,
+                                       progress_callback)
+    return copied
+
+
+def read_exactly(fileobj, size):
+    """
+    Read size bytes from a file object, or fewer at end-of-file.  Plain
+    files are read through their file descriptors so nothing is left in
+    their read buffers, which keeps copy_fileobj usable on them.
+    """
+    fileno = _get_plain_fd(fileobj)
+    chunks = []
+    while size > 0:
+        if fileno is not None:
+            chunk = os.read(fileno, size)
+        else:
+            chunk = fileobj.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def splice(fd_in, fd_out, length):
+    """
+    Move up to length bytes from one file descriptor to another within
+    the kernel and return the number moved, which is 0 at end-of-file.
+    At least one of them must be a pipe.
+    """
+    return _call_splice_func('splice', fd_in, None, fd_out, None,
+                             ctypes.c_size_t(length),
+                             _SPLICE_F_MOVE | _SPLICE_F_MORE)
+
+
+def tee(fd_in, fd_out, length):
+    """
+    Copy up to length bytes from one pipe to another within the kernel
+    without consuming them, and return the number copied, which is 0 at
+    end-of-file.
+    """
+    return _call_splice_func('tee', fd_in, fd_out, ctypes.c_size_t(length),
+                             0)
+
+
+def _call_splice_func(name, *args):
+    # Like file I/O, these raise IOError
+    func = _get_libc_func(name)
+    if func is None:
+        raise IOError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    func.restype = ctypes.c_ssize_t
+    while True:
+        nbytes = func(*args)
+        if nbytes >= 0:
+            return nbytes
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise IOError(err, os.strerror(err))
+
+
+def _get_plain_fd(fileobj):
+    if isinstance(fileobj, _PLAIN_FILE_TYPES):
+        try:
+            return fileobj.fileno()
+        except (IOError, ValueError):
+            pass
+    return None
+
+
+def _copy_fd_via_splice(in_fd, out_fd, size, data_callback,
+                        progress_callback):
+    # Returns None without having copied anything if the kernel cannot
+    # splice between these file descriptors.
+    if data_callback is not None:
+        buf = memoryview(bytearray(PIPE_SIZE))
+        reader = io.FileIO(in_fd, 'rb', closefd=False)
+    copied = 0
+    while size is None or copied < size:
+        length = PIPE_SIZE if size is None else min(PIPE_SIZE, size - copied)
+        try:
+            if data_callback is None:
+                nbytes = splice(in_fd, out_fd, length)
+            else:
+                nbytes = tee(in_fd, out_fd, length)
+        except IOError as err:
+            if copied == 0 and err.errno in (errno.EINVAL, errno.ENOSYS):
+                return None
+            raise
+        if nbytes == 0:
+            break
+        if data_callback is not None:
+            # tee left the data in the input pipe, so now we consume them
+            # ourselves.  They are already there, so this won't block.
+            consumed = 0
+            while consumed < nbytes:
+                chunk_len = reader.readinto(buf[:nbytes - consumed])
+                data_callback(buf[:chunk_len])
+                consumed += chunk_len
+        copied += nbytes
+        if progress_callback is not None:
+            progress_callback(copied)
+    return copied
+
+
+def _copy_fd_via_readinto(in_fd, out_fd, size, data_callback,
+                          progress_callback):
+    buf = memoryview(bytearray(PIPE_SIZE))
+    reader = io.FileIO(in_fd, 'rb', closefd=False)
+    writer = io.FileIO(out_fd, 'wb', closefd=False)
+    copied = 0
+    while size is None or copied < size:
+        length = PIPE_SIZE if size is None else min(PIPE_SIZE, size - copied)
+        nbytes = reader.readinto(buf[:length])
+        if not nbytes:
+            break
+        chunk = buf[:nbytes]
+        if data_callback is not None:
+            data_callback(chunk)
+        written = 0
+        while written < nbytes:
+            written += writer.write(chunk[written:])
+        copied += nbytes
+        if progress_callback is not None:
+            progress_callback(copied)
+    return copied
+
+
+def _copy_fileobj_via_read(infile, outfile, size, data_callback,
+                           progress_callback):
+    copied = 0
+    while size is None or copied < size:
+        length = PIPE_SIZE if size is None else min(PIPE_SIZE, size - copied)
+        chunk = infile.read(length)
+        if not chunk:
+            break
+        if data_callback is not None:
+            data_callback(chunk)
+        outfile.write(chunk)
+        copied += len(chunk)
+        if progress_callback is not None:
+            progress_callback(copied)
+    return copied
+
+
+class SparseFileReader(object):
+    """
+    A read-only file-like wrapper around a regular file that uses
+    SEEK_DATA and SEEK_HOLE to find the file's holes, returning zeroes for
+    them without reading them from disk.  The data it returns are exactly
+    the same as what reading the file normally would.
+
+    Where the OS or file system cannot find holes this just reads
+    everything.
+
+    This reads from the underlying file descriptor directly, so nothing
+    else should read from the file object it wraps.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.name = getattr(fileobj, 'name', None)
+        self.__fd = fileobj.fileno()
+        self.__pos = os.lseek(self.__fd, 0, os.SEEK_CUR)
+        self.__size = os.fstat(self.__fd).st_size
+        self.__extent_end = self.__pos
+        self.__in_hole = False
+        self.__can_find_holes = SEEK_DATA is not None
+        self.__zeroes = b''
+        self.hole_bytes = 0  # for curious callers
+
+    @property
+    def closed(self):
+        return self.fileobj.closed
+
+    def close(self):
+        self.fileobj.close()
+
+    def fileno(self):
+        return self.__fd
+
+    def tell(self):
+        return self.__pos
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(self.__size - self.__pos, 0)
+        chunks = []
+        while size > 0 and self.__pos < self.__size:
+            if self.__pos >= self.__extent_end:
+                self.__find_next_extent()
+            chunk_size = min(size, self.__extent_end - self.__pos)
+            if self.__in_hole:
+                chunk = self.__get_zeroes(chunk_size)
+                self.hole_bytes += chunk_size
+            else:
+                os.lseek(self.__fd, self.__pos, os.SEEK_SET)
+                chunk = os.read(self.__fd, chunk_size)
+                if not chunk:
+                    # The file shrank out from under us
+                    self.__size = self.__pos
+                    break
+            chunks.append(chunk)
+            self.__pos += len(chunk)
+            size -= len(chunk)
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def __find_next_extent(self):
+        if self.__can_find_holes:
+            try:
+                data_start = os.lseek(self.__fd, self.__pos, SEEK_DATA)
+            except OSError as err:
+                if err.errno == errno.ENXIO:
+                    # There is no more data, so the rest is one big hole.
+                    self.__in_hole = True
+                    self.__extent_end = self.__size
+                    return
+                # Anything else means we can't look for holes here.
+                self.__can_find_holes = False
+            else:
+                if data_start > self.__pos:
+                    self.__in_hole = True
+                    self.__extent_end = min(data_start, self.__size)
+                else:
+                    self.__in_hole = False
+                    self.__extent_end = os.lseek(self.__fd, self.__pos,
+                                                 SEEK_HOLE)
+                return
+        self.__in_hole = False
+        self.__extent_end = self.__size
+
+    def __get_zeroes(self, size):
+        # Readers tend to ask for the same amount each time, so we can
+        # usually hand back the same (immutable) string of zeroes.
+        if len(self.__zeroes) != size:
+            self.__zeroes = b'\0' * size
+        return self.__zeroes
+
+
+class ImageFileWriter(object):
+    """
+    A write-only file-like wrapper around an image's destination that
+    writes in large blocks aligned to the destination's offsets, which is
+    kinder to both disks and the page cache than lots of small writes.
+
+    If sparse is True, blocks that are entirely zeroes are skipped rather
+    than written.  For regular files that leaves holes; block devices are
+    assumed to already read back zeroes (e.g. they were just discarded).
+
+    If drop_cache is True, data behind the write cursor are flushed and
+    dropped from the page cache as we go so writing a large image does not
+    evict everything else from memory.  When that is combined with a known
+    size and sparse is False, a regular file is also preallocated.
+
+    Only whole blocks are written until finish is called, which writes
+    the rest and sets the final size.  That does not close the destination.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+    DROP_CACHE_WINDOW = 16 * BLOCK_SIZE
+
+    def __init__(self, fileobj, sparse=False, drop_cache=False, size=None):
+        fileobj.flush()
+        self.fileobj = fileobj
+        self.__fd = fileobj.fileno()
+        mode = os.fstat(self.__fd).st_mode
+        self.__is_regular = stat.S_ISREG(mode)
+        if self.__is_regular or stat.S_ISBLK(mode):
+            self.__pos = os.lseek(self.__fd, 0, os.SEEK_CUR)
+            self.sparse = sparse
+            self.drop_cache = drop_cache
+        else:
+            # Pipes and the like can't do any of this
+            self.__pos = 0
+            self.sparse = False
+            self.drop_cache = False
+        self.__fd_pos = self.__pos
+        self.__buf = bytearray()
+        self.__zeroes = b'\0' * self.BLOCK_SIZE
+        self.__cache_marks = [self.__pos, self.__pos]
+        if (self.drop_cache and not self.sparse and self.__is_regular and
+                size):
+            fallocate(self.__fd, self.__pos, size)
+
+    def write(self, data):
+        self.__buf.extend(data)
+        # Finish whatever block we are in the middle of first so all of
+        # the writes after that are aligned.
+        to_write = self.BLOCK_SIZE - self.__pos % self.BLOCK_SIZE
+        while len(self.__buf) >= to_write:
+            self.__write_block(bytes(self.__buf[:to_write]))
+            del self.__buf[:to_write]
+            to_write = self.BLOCK_SIZE
+
+    def flush(self):
+        # Partial blocks wait for more data or for finish
+        pass
+
+    def finish(self):
+        if self.__buf:
+            self.__write_block(bytes(self.__buf))
+            del self.__buf[:]
+        if self.__is_regular and self.__fd_pos != self.__pos:
+            # We skipped some zeroes at the end, so the file might not be
+            # big enough yet.
+            if os.fstat(self.__fd).st_size < self.__pos:
+                os.ftruncate(self.__fd, self.__pos)
+            os.lseek(self.__fd, self.__pos, os.SEEK_SET)
+            self.__fd_pos = self.__pos
+        if self.drop_cache:
+            start = self.__cache_marks[0]
+            sync_file_range(self.__fd, start, self.__pos - start)
+            drop_from_page_cache(self.__fd, start, self.__pos - start)
+            self.__cache_marks = [self.__pos, self.__pos]
+
+    def __write_block(self, block):
+        if self.sparse and block == self.__zeroes[:len(block)]:
+            self.__pos += len(block)
+        else:
+            if self.__fd_pos != self.__pos:
+                os.lseek(self.__fd, self.__pos, os.SEEK_SET)
+            view = memoryview(block)
+            while view:
+                written = os.write(self.__fd, view)
+                view = view[written:]
+            self.__pos += len(block)
+            self.__fd_pos = self.__pos
+        if self.drop_cache:
+            self.__drop_cache_behind()
+
+    def __drop_cache_behind(self):
+        prev_mark, mark = self.__cache_marks
+        if self.__pos - mark < self.DROP_CACHE_WINDOW:
+            return
+        # Start writing back the window we just finished, then wait for
+        # the one before it, which has had a while to finish writing back
+        # by now, and drop that one.  Dirty pages can't be dropped.
+        sync_file_range(self.__fd, mark, self.__pos - mark, wait=False)
+        if mark > prev_mark:
+            sync_file_range(self.__fd, prev_mark, mark - prev_mark)
+            drop_from_page_cache(self.__fd, prev_mark, mark - prev_mark)
+        self.__cache_marks = [mark, self.__pos]
+
+
+class PartBufferRing(object):
+    """
+    A fixed number of part-sized slots in a block of anonymous shared
+    memory, for handing bundle parts from a part writer process to an
+    uploader without writing them to disk.
+
+    The free slots' numbers travel through a pipe, so a writer that calls
+    acquire blocks until an uploader releases a slot, much as it would
+    with a semaphore.  Once every end of the releasing side is closed
+    acquire raises EOFError, which lets the writer exit if the uploader
+    goes away.
+
+    This must be created before the processes that use it are forked.
+    """
+
+    def __init__(self, num_slots, slot_size):
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.buffer = mmap.mmap(-1, num_slots * slot_size)
+        self.free_slots_r, self.free_slots_w = \
+            multiprocessing.Pipe(duplex=False)
+        for slot in range(num_slots):
+            self.free_slots_w.send(slot)
+
+    def acquire(self):
+        return self.free_slots_r.recv()
+
+    def release(self, slot):
+        try:
+            self.free_slots_w.send(slot)
+        except IOError as err:
+            # Once the writer is done it stops listening for free slots
+            if err.errno != errno.EPIPE:
+                raise
+
+    def write(self, slot, offset, data):
+        start = slot * self.slot_size + offset
+        if offset + len(data) > self.slot_size:
+            raise ValueError('data do not fit in a buffer slot')
+        self.buffer[start:start + len(data)] = data
+
+    def open_slot(self, slot, size, name=None):
+        """
+        Return a read-only file-like object that reads the first size
+        bytes of a slot.
+        """
+        return _BufferExtentReader(self.buffer, slot * self.slot_size, size,
+                                   name=name)
+
+
+class _BufferExtentReader(object):
+    def __init__(self, buf, offset, size, name=None):
+        self.closed = False
+        self.name = name
+        self.__buf = buf
+        self.__start = offset
+        self.__size = size
+        self.__pos = 0
+
+    def close(self):
+        self.closed = True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.__size - self.__pos
+        size = max(0, min(size, self.__size - self.__pos))
+        start = self.__start + self.__pos
+        self.__pos += size
+        return self.__buf[start:start + size]
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.__pos
+        elif whence == os.SEEK_END:
+            pos += self.__size
+        self.__pos = max(0, pos)
+
+    def tell(self):
+        return self.__pos
+
+
+def fallocate(fd, offset, length):
+    """
+    Try to preallocate space for a file and return whether that worked.
+    """
+    func = _get_libc_func('fallocate64', 'fallocate')
+    if func is None:
+        return False
+    return func(fd, 0, ctypes.c_int64(offset), ctypes.c_int64(length)) == 0
+
+
+def drop_from_page_cache(fd, offset, length):
+    """
+    Advise the kernel that we won't need part of a file again soon so it
+    can drop it from the page cache.  Dirty pages are not dropped.
+    """
+    func = _get_libc_func('posix_fadvise64', 'posix_fadvise')
+    if func is not None:
+        func(fd, ctypes.c_int64(offset), ctypes.c_int64(length),
+             _POSIX_FADV_DONTNEED)
+
+
+def sync_file_range(fd, offset, length, wait=True):
+    """
+    Write part of a file back to disk, optionally waiting for that to
+    finish.  Where that is not possible this does nothing.
+    """
+    func = _get_libc_func('sync_file_range')
+    if func is not None:
+        flags = _SYNC_FILE_RANGE_WRITE
+        if wait:
+            flags |= _SYNC_FILE_RANGE_WAIT_BEFORE | _SYNC_FILE_RANGE_WAIT_AFTER
+        func(fd, ctypes.c_int64(offset), ctypes.c_int64(length), flags)
+
+
+def _get_libc_func(*names):
+    global _LIBC  # pylint: disable=global-statement
+    if _LIBC is None:
+        try:
+            _LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except OSError:
+            _LIBC = False
+    if _LIBC:
+        for name in names:
+            if hasattr(_LIBC, name):
+                return getattr(_LIBC, name)
+    return None
+
+
+def waitpid_in_thread(pid, rusage_callback=None, status_callback=None):
     """
     Start a thread that calls os.waitpid on a particular PID to prevent
     zombie processes from hanging around after they have finished.
+
+    If rusage_callback is given, it is called with the resource usage of
+    the process once it exits, or with None if that could not be found.
+    Likewise, status_callback is called with the process's exit status
+    as os.waitpid returns it, or with None.
     """
-    pid_thread = threading.Thread(target=_wait_for_pid, args=(pid,))
+    pid_thread = threading.Thread(target=_wait_for_pid, args=(pid,),
+                                  kwargs={'rusage_callback': rusage_callback,
+                                          'status_callback': status_callback})
     pid_thread.daemon = True
     pid_thread.start()
 
 
-def _wait_for_pid(pid):
+def _wait_for_pid(pid, rusage_callback=None, status_callback=None):
+    status = None
+    rusage = None
     if pid:
         try:
-            os.waitpid(pid, 0)
+            if rusage_callback is not None:
+                _, status, rusage = os.wait4(pid, 0)
+            else:
+                status = os.waitpid(pid, 0)[1]
         except OSError:
             pass
+    if rusage_callback is not None:
+        rusage_callback(rusage)
+    if status_callback is not None:
+        status_callback(status)
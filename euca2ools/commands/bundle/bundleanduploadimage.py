@@ -26,33 +26,67 @@
 import multiprocessing
 import os.path
 import tarfile
+import time
 
 from requestbuilder import Arg
-from requestbuilder.exceptions import ClientError
+from requestbuilder.exceptions import ArgumentError, ClientError
 from requestbuilder.mixins import FileTransferProgressBarMixin
 
+from euca2ools.bundle.journal import BundleJournal
 from euca2ools.bundle.pipes.core import create_bundle_pipeline
+from euca2ools.bundle.pipes.flowcontrol import ByteBudget
 from euca2ools.bundle.pipes.fittings import (create_bundle_part_deleter,
                                              create_bundle_part_writer,
                                              create_mpconn_aggregator)
 import euca2ools.bundle.manifest
 import euca2ools.bundle.util
 from euca2ools.commands.bundle.mixins import (BundleCreatingMixin,
+                                              BundleDestination,
+                                              PipelineStatsMixin,
                                               BundleUploadingMixin)
 from euca2ools.commands.bootstrap import BootstrapRequest
 from euca2ools.commands.s3 import S3Request
+from euca2ools.exceptions import AWSError
 from euca2ools.util import mkdtemp_for_large_files
 
 
+# How far bundling may get ahead of uploads when they are fast enough to
+# keep up with it
+_MAX_PENDING_BYTES = 2 ** 30  # 1 GiB
+
+
 class BundleAndUploadImage(S3Request, BundleCreatingMixin,
                            BundleUploadingMixin,
-                           FileTransferProgressBarMixin):
+                           FileTransferProgressBarMixin, PipelineStatsMixin):
     DESCRIPTION = 'Prepare and upload an image for use in the cloud'
     ARGS = [Arg('--preserve-bundle', action='store_true',
                 help='do not delete the bundle as it is being uploaded'),
             Arg('--max-pending-parts', type=int, default=2,
-                help='''pause the bundling process when more than this number
-                of parts are waiting to be uploaded (default: 2)''')]
+                help='''allow at least this number of parts to wait to be
+                uploaded before pausing the bundling process.  More are
+                allowed when uploads are fast enough to use them, as long
+                as there is free disk space for them.  (default: 2, or the
+                number of upload threads if that is larger)'''),
+            Arg('--resume', action='store_true', help='''resume an
+                interrupted upload of the same image using the journal it
+                left in the -d/--destination directory.  The image is
+                bundled again, but parts that are already on the server
+                are not uploaded again.'''),
+            Arg('--stage-parts-in-memory', action='store_true',
+                help='''hold bundle parts in memory until they are uploaded
+                instead of writing them to disk.  This needs enough memory
+                for as many parts as --max-pending-parts or the number of
+                upload threads allows, whichever is larger, all of which
+                is allocated at the start.  Unless --part-size is given,
+                parts are kept small enough for that to stay within 512
+                MiB where possible.  Cannot be used with
+                --preserve-bundle.'''),
+            Arg('--also-upload-to', metavar='[REGION:]BUCKET[/PREFIX]',
+                action='append', default=[], help='''also upload the bundle
+                to another bucket, optionally in another region.  The image
+                is bundled only once, and each destination gets a manifest
+                of its own that uses that region's cloud certificate.  This
+                may be used more than once.''')]
 
     # noinspection PyExceptionInherit
     def configure(self):
@@ -74,11 +108,94 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
             self.log.debug('bootstrap setup failed; auto cert fetching '
                            'will be unavailable', exc_info=True)
 
+        if (self.args.get('stage_parts_in_memory') and
+                self.args.get('preserve_bundle')):
+            raise ArgumentError('argument --stage-parts-in-memory: not '
+                                'allowed with argument --preserve-bundle')
+
         self.configure_bundle_creds()
         self.configure_bundle_properties()
         self.configure_bundle_output()
+        self.configure_extra_destinations()
+        if self.args.get('resume'):
+            self.configure_resume_from_journal()
         self.generate_encryption_keys()
 
+    def configure_extra_destinations(self):
+        destinations = []
+        for dest_str in self.args.get('also_upload_to') or []:
+            if self.args.get('upload_policy'):
+                raise ArgumentError('argument --also-upload-to: not allowed '
+                                    'with an upload policy')
+            region, _, bucket = dest_str.rpartition(':')
+            if not bucket:
+                raise ArgumentError("argument --also-upload-to: '{0}' does "
+                                    "not name a bucket".format(dest_str))
+            destination = BundleDestination(self, bucket, region=region)
+            if region:
+                destination.ec2cert = self.__get_region_ec2cert(destination)
+            else:
+                destination.ec2cert = self.args['ec2cert']
+            self.log.debug('extra destination %s uses cloud certificate %s',
+                           destination, destination.ec2cert)
+            destinations.append(destination)
+        self.args['extra_destinations'] = destinations
+
+    def __get_region_ec2cert(self, destination):
+        # Every region has its own cloud certificate, so the one from
+        # --ec2cert will not do here.
+        ec2cert = destination.config.get_region_option('certificate')
+        if not ec2cert and self.args.get('bootstrap_auth'):
+            try:
+                bootstrap_service = \
+                    BootstrapRequest.SERVICE_CLASS.from_other(
+                        destination.service, region=destination.region)
+                ec2cert = self.fetch_bundle_certificate(
+                    bootstrap_service, self.args['bootstrap_auth'])
+            except (AWSError, ClientError):
+                self.log.debug('failed to fetch ec2cert for region %s',
+                               destination.region, exc_info=True)
+        if not ec2cert:
+            raise ArgumentError(
+                "argument --also-upload-to: no cloud certificate for "
+                "region '{0}'; add one to its configuration or make its "
+                "bootstrap service available".format(destination.region))
+        ec2cert = os.path.expanduser(os.path.expandvars(ec2cert))
+        if not os.path.isfile(ec2cert):
+            raise ArgumentError("cloud certificate file '{0}' for region "
+                                "'{1}' does not exist".format(
+                                    ec2cert, destination.region))
+        return ec2cert
+
+    def configure_resume_from_journal(self):
+        if not self.args.get('destination'):
+            raise ArgumentError('argument --resume: -d/--destination is '
+                                'required to find the bundle journal')
+        journal_filename = _get_journal_filename(
+            os.path.join(self.args['destination'], self.args['prefix']))
+        if not os.path.isfile(journal_filename):
+            raise ArgumentError("argument --resume: bundle journal '{0}' "
+                                "does not exist".format(journal_filename))
+        journal = BundleJournal.read_from_file(journal_filename,
+                                               loglevel=self.log.level)
+        if journal.image_size != self.args['image_size']:
+            raise ArgumentError(
+                'argument --resume: image size does not match the one in '
+                'the bundle journal (expected: {0}, actual: {1})'
+                .format(journal.image_size, self.args['image_size']))
+        for argname in ('enc_key', 'enc_iv'):
+            journal_val = int(getattr(journal, argname), 16)
+            if self.args.get(argname) not in (None, journal_val):
+                raise ArgumentError(
+                    'argument --{0}: does not match the one in the bundle '
+                    'journal'.format(argname.replace('_', '-')))
+            self.args[argname] = journal_val
+        self.args['part_size'] = journal.part_size
+        self.args['journal'] = journal
+        self.log.info('resuming upload using bundle journal %s (%i parts '
+                      'already uploaded)', journal_filename,
+                      len(journal.parts))
+
     def main(self):
         if self.args.get('destination'):
             path_prefix = os.path.join(self.args['destination'],
@@ -91,61 +208,125 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
         self.log.debug('bundle path prefix: %s', path_prefix)
 
         key_prefix = self.get_bundle_key_prefix()
+        # Checking the bucket takes about one round trip to the server,
+        # which helps decide how large parts should be.
+        bucket_check_start = time.time()
         self.ensure_dest_bucket_exists()
+        if self.args.get('upload_policy'):
+            self.configure_part_size()
+        else:
+            self.configure_part_size(rtt=(time.time() - bucket_check_start))
+        extra_destinations = self.args.get('extra_destinations') or []
+        for destination in extra_destinations:
+            self.ensure_dest_bucket_exists(destination=destination)
+
+        # Keep track of what we upload so we can resume later if needed
+        journal = self.args.get('journal')
+        if journal is None:
+            journal = BundleJournal(_get_journal_filename(path_prefix),
+                                    loglevel=self.log.level)
+            journal.enc_key = self.args['enc_key']
+            journal.enc_iv = self.args['enc_iv']
+            journal.part_size = self.args['part_size']
+            journal.image_size = self.args['image_size']
+            journal.save()
+        self.log.debug('bundle journal: %s', journal.filename)
 
         # First create the bundle and upload it to the server
-        digest, partinfo = self.create_and_upload_bundle(path_prefix,
-                                                         key_prefix)
+        digest, partinfo = self.create_and_upload_bundle(
+            path_prefix, key_prefix, journal=journal)
+        self.print_pipeline_stats()
 
-        # All done; now build the manifest, write it to disk, and upload it.
+        # All done; now build the manifests, write them to disk, and upload
+        # them.  Each destination gets its own because the bundle's key and
+        # IV are encrypted with each cloud's certificate.
         manifest = self.build_manifest(digest, partinfo)
-        manifest_filename = '{0}.manifest.xml'.format(path_prefix)
-        with open(manifest_filename, 'w') as manifest_file:
-            manifest.dump_to_file(manifest_file, self.args.get('privatekey'),
-                                  self.args.get('cert'), self.args['ec2cert'])
-        manifest_dest = key_prefix + os.path.basename(manifest_filename)
-        self.upload_bundle_file(manifest_filename, manifest_dest,
-                                show_progress=self.args.get('show_progress'))
+        manifest_basename = '{0}.manifest.xml'.format(self.args['prefix'])
+        manifests = []
+        for index, destination in enumerate([None] + extra_destinations):
+            if destination is None:
+                manifest_filename = '{0}.manifest.xml'.format(path_prefix)
+                ec2cert = self.args['ec2cert']
+                dest_key_prefix = key_prefix
+            else:
+                manifest_filename = '{0}.{1}.manifest.xml'.format(
+                    path_prefix, index)
+                ec2cert = destination.ec2cert
+                dest_key_prefix = self.get_bundle_key_prefix(destination)
+            with open(manifest_filename, 'w') as manifest_file:
+                manifest.dump_to_file(
+                    manifest_file, self.args.get('privatekey'),
+                    self.args.get('cert'), ec2cert)
+            manifest_dest = dest_key_prefix + manifest_basename
+            self.upload_bundle_file(
+                manifest_filename, manifest_dest, destination=destination,
+                show_progress=self.args.get('show_progress'))
+            if not self.args.get('preserve_bundle', False):
+                os.remove(manifest_filename)
+            manifests.append({'filename': manifest_filename,
+                              'key': manifest_dest})
         if not self.args.get('preserve_bundle', False):
-            os.remove(manifest_filename)
+            journal.delete()
 
-        # Then we just inform the caller of all the files we wrote.
-        # Manifests are returned in a tuple for future expansion, where we
-        # bundle for more than one region at a time.
+        # Then we just inform the caller of all the files we wrote.  The
+        # manifest for -b/--bucket always comes first.
         return {'parts': tuple({'filename': part.filename,
                                 'key': (key_prefix +
                                         os.path.basename(part.filename))}
                                for part in manifest.image_parts),
-                'manifests': ({'filename': manifest_filename,
-                               'key': manifest_dest},)}
+                'manifests': tuple(manifests)}
 
     def print_result(self, result):
         if self.debug:
             for part in result['parts']:
                 print 'Uploaded', part['key']
-        if result['manifests'][0]['key'] is not None:
-            print 'Uploaded', result['manifests'][0]['key']
+        for manifest in result['manifests']:
+            if manifest['key'] is not None:
+                print 'Uploaded', manifest['key']
 
-    def create_and_upload_bundle(self, path_prefix, key_prefix):
-        part_write_sem = multiprocessing.Semaphore(
-            max(1, self.args['max_pending_parts']))
+    def create_and_upload_bundle(self, path_prefix, key_prefix,
+                                 journal=None):
+        max_pending_parts = max(1, self.args['max_pending_parts'],
+                                self.args.get('upload_threads') or 1)
+        if self.args.get('stage_parts_in_memory'):
+            # Parts wait for their uploads in memory instead of on disk.
+            # Since there are only so many slots for them this also takes
+            # care of pausing the part writer.
+            part_buffers = euca2ools.bundle.util.PartBufferRing(
+                max_pending_parts, self.args['part_size'])
+            byte_budget = None
+        else:
+            # Parts wait on disk, so how many of them we allow depends on
+            # how fast they get uploaded and how much room there is.
+            part_buffers = None
+            byte_budget = ByteBudget(
+                max_pending_parts * self.args['part_size'],
+                max_bytes=max(_MAX_PENDING_BYTES,
+                              max_pending_parts * self.args['part_size']),
+                path=os.path.dirname(os.path.abspath(path_prefix)))
 
         # Fill out all the relevant info needed for a tarball
         tarinfo = tarfile.TarInfo(self.args['prefix'])
         tarinfo.size = self.args['image_size']
 
+        pipeline_stats = self.get_pipeline_stats()
+
         # disk --(bytes)-> bundler
         partwriter_in_r, partwriter_in_w = \
             euca2ools.bundle.util.open_pipe_fileobjs()
         digest_result_mpconn = create_bundle_pipeline(
             self.args['image'], partwriter_in_w, self.args['enc_key'],
-            self.args['enc_iv'], tarinfo, debug=self.debug)
+            self.args['enc_iv'], tarinfo, debug=self.debug,
+            in_process=self.args.get('in_process'),
+            pipeline_stats=pipeline_stats,
+            decompress=self.args.get('image_compression'))
         partwriter_in_w.close()
 
         # bundler --(bytes)-> part writer
         bundle_partinfo_mpconn = create_bundle_part_writer(
             partwriter_in_r, path_prefix, self.args['part_size'],
-            part_write_sem=part_write_sem, debug=self.debug)
+            byte_budget=byte_budget, part_buffers=part_buffers,
+            debug=self.debug, pipeline_stats=pipeline_stats)
         partwriter_in_r.close()
 
         # part writer --(part info)-> part uploader
@@ -156,7 +337,8 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
             multiprocessing.Pipe(duplex=False)
 
         # part uploader --(part info)-> part deleter
-        if not self.args.get('preserve_bundle', False):
+        if not (self.args.get('preserve_bundle', False) or
+                self.args.get('stage_parts_in_memory')):
             deleted_partinfo_mpconn_r, deleted_partinfo_mpconn_w = \
                 multiprocessing.Pipe(duplex=False)
             create_bundle_part_deleter(uploaded_partinfo_mpconn_r,
@@ -164,7 +346,7 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
             uploaded_partinfo_mpconn_r.close()
             deleted_partinfo_mpconn_w.close()
         else:
-            # Bypass this stage
+            # Bypass this stage, since there is nothing on disk to delete
             deleted_partinfo_mpconn_r = uploaded_partinfo_mpconn_r
 
         # part deleter --(part info)-> part info aggregator
@@ -174,15 +356,24 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
         deleted_partinfo_mpconn_r.close()
 
         # Now drive the pipeline by uploading parts.
+        if pipeline_stats is not None:
+            upload_stats = pipeline_stats.add_stage('upload')
+        else:
+            upload_stats = None
         try:
             self.upload_bundle_parts(
                 bundle_partinfo_mpconn, key_prefix,
                 partinfo_out_mpconn=uploaded_partinfo_mpconn_w,
-                part_write_sem=part_write_sem,
+                byte_budget=byte_budget, part_buffers=part_buffers,
+                journal=journal, stats=upload_stats,
+                destinations=self.args.get('extra_destinations'),
                 show_progress=self.args.get('show_progress'))
         finally:
             # Make sure the writer gets a chance to exit
-            part_write_sem.release()
+            if byte_budget is not None:
+                byte_budget.close()
+            if part_buffers is not None:
+                part_buffers.free_slots_w.close()
 
         # All done; now grab info about the bundle we just created
         try:
@@ -199,3 +390,7 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
                       self.args['bucket'])
         self.log.debug('bundle digest: %s', digest)
         return digest, partinfo
+
+
+def _get_journal_filename(path_prefix):
+    return '{0}.journal.json'.format(path_prefix)
@@ -38,13 +38,14 @@ from euca2ools.bundle.pipes.fittings import (create_bundle_part_writer,
                                              create_mpconn_aggregator)
 import euca2ools.bundle.util
 from euca2ools.commands import Euca2ools
-from euca2ools.commands.bundle.mixins import BundleCreatingMixin
+from euca2ools.commands.bundle.mixins import (BundleCreatingMixin,
+                                              PipelineStatsMixin)
 from euca2ools.commands.bootstrap import BootstrapRequest
 from euca2ools.util import mkdtemp_for_large_files
 
 
 class BundleImage(BaseCommand, BundleCreatingMixin,
-                  FileTransferProgressBarMixin,
+                  FileTransferProgressBarMixin, PipelineStatsMixin,
                   RegionConfigurableMixin):
     SUITE = Euca2ools
     DESCRIPTION = 'Prepare an image for use in the cloud'
@@ -101,9 +102,11 @@ class BundleImage(BaseCommand, BundleCreatingMixin,
             tempdir = mkdtemp_for_large_files(prefix='bundle-')
             path_prefix = os.path.join(tempdir, self.args['prefix'])
         self.log.debug('bundle path prefix: %s', path_prefix)
+        self.configure_part_size()
 
         # First create the bundle
         digest, partinfo = self.create_bundle(path_prefix)
+        self.print_pipeline_stats()
 
         # All done; now build the manifest and write it to disk
         manifest = self.build_manifest(digest, partinfo)
@@ -131,6 +134,11 @@ class BundleImage(BaseCommand, BundleCreatingMixin,
         # The pipeline begins with self.args['image'] feeding a bundling pipe
         # segment through a progress meter, which has to happen on the main
         # thread, so we add that to the pipeline last.
+        pipeline_stats = self.get_pipeline_stats()
+        if pipeline_stats is not None:
+            read_stats = pipeline_stats.add_stage('read')
+        else:
+            read_stats = None
 
         # meter --(bytes)--> bundler
         bundle_in_r, bundle_in_w = euca2ools.bundle.util.open_pipe_fileobjs()
@@ -138,14 +146,17 @@ class BundleImage(BaseCommand, BundleCreatingMixin,
             euca2ools.bundle.util.open_pipe_fileobjs()
         digest_result_mpconn = create_bundle_pipeline(
             bundle_in_r, partwriter_in_w, self.args['enc_key'],
-            self.args['enc_iv'], tarinfo, debug=self.debug)
+            self.args['enc_iv'], tarinfo, debug=self.debug,
+            in_process=self.args.get('in_process'),
+            pipeline_stats=pipeline_stats,
+            decompress=self.args.get('image_compression'))
         bundle_in_r.close()
         partwriter_in_w.close()
 
         # bundler --(bytes)-> part writer
         bundle_partinfo_mpconn = create_bundle_part_writer(
             partwriter_in_r, path_prefix, self.args['part_size'],
-            debug=self.debug)
+            debug=self.debug, pipeline_stats=pipeline_stats)
         partwriter_in_r.close()
 
         # part writer --(part info)-> part info aggregator
@@ -156,13 +167,19 @@ class BundleImage(BaseCommand, BundleCreatingMixin,
 
         # disk --(bytes)-> bundler
         # (synchronous)
+        if self.args.get('image_compression'):
+            # What we read is still compressed at this point, and the
+            # pipeline checks the decompressed size itself
+            read_size_expected = self.args.get('compressed_image_size')
+        else:
+            read_size_expected = self.args['image_size']
         label = self.args.get('progressbar_label') or 'Bundling image'
-        pbar = self.get_progressbar(label=label,
-                                    maxval=self.args['image_size'])
+        pbar = self.get_progressbar(label=label, maxval=read_size_expected)
         with self.args['image'] as image:
             try:
                 read_size = copy_with_progressbar(image, bundle_in_w,
-                                                  progressbar=pbar)
+                                                  progressbar=pbar,
+                                                  stats=read_stats)
             except ValueError:
                 self.log.debug('error from copy_with_progressbar',
                                exc_info=True)
@@ -170,11 +187,12 @@ class BundleImage(BaseCommand, BundleCreatingMixin,
                                    'than expected image size of {0}'
                                    .format(self.args['image_size']))
         bundle_in_w.close()
-        if read_size != self.args['image_size']:
+        if (read_size_expected is not None and
+                read_size != read_size_expected):
             raise RuntimeError('corrupt bundle: input size did not match '
                                'expected image size  (expected size: {0}, '
                                'read: {1})'
-                               .format(self.args['image_size'], read_size))
+                               .format(read_size_expected, read_size))
 
         # All done; now grab info about the bundle we just created
         try:
@@ -45,6 +45,7 @@ from euca2ools.commands.argtypes import (delimited_list, filesize,
                                          manifest_block_device_mappings)
 from euca2ools.commands.bootstrap import BootstrapRequest
 from euca2ools.commands.bundle.bundleimage import BundleImage
+from euca2ools.commands.bundle.mixins import PipelineStatsMixin
 
 
 ALLOWED_FILESYSTEM_TYPES = ['btrfs', 'ext2', 'ext3', 'ext4', 'jfs', 'xfs']
@@ -53,7 +54,7 @@ FSTAB_TEMPLATE_FILE = os.path.join(SYSCONFDIR, 'bundle-vol', 'fstab')
 
 
 class BundleVolume(BaseCommand, FileTransferProgressBarMixin,
-                   RegionConfigurableMixin):
+                   PipelineStatsMixin, RegionConfigurableMixin):
     SUITE = Euca2ools
     DESCRIPTION = ("Prepare this machine's filesystem for use in the cloud\n\n"
                    "This command must be run as the superuser.")
@@ -136,9 +137,13 @@ class BundleVolume(BaseCommand, FileTransferProgressBarMixin,
             Arg('--productcodes', metavar='CODE1,CODE2,...',
                 type=delimited_list(','), default=[],
                 help='comma-separated list of product codes for the image'),
+            Arg('--in-process', action='store_true', help='''do all of the
+                bundling work in a single process instead of a chain of
+                external programs (requires the python cryptography
+                library)'''),
 
             # Overrides for debugging and other entertaining uses
-            Arg('--part-size', type=filesize, default=10485760,  # 10MB
+            Arg('--part-size', type=filesize,  # default: automatic
                 help=argparse.SUPPRESS),
             Arg('--enc-key', type=(lambda s: int(s, 16)),
                 help=argparse.SUPPRESS),  # a hex string
@@ -231,7 +236,8 @@ class BundleVolume(BaseCommand, FileTransferProgressBarMixin,
                        'block_device_mappings', 'productcodes', 'part_size',
                        'enc_key', 'enc_iv', 'show_progress', 'key_id',
                        'secret_key', 'security_token', 'bootstrap_url',
-                       'bootstrap_service', 'bootstrap_auth', 'region')
+                       'bootstrap_service', 'bootstrap_auth', 'region',
+                       'in_process', 'show_stats')
         bundle_args_dict = dict((key, self.args.get(key))
                                 for key in bundle_args)
         return BundleImage.from_other(self, image=image_filename,
@@ -23,55 +23,181 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import fnmatch
+import posixpath
+
 from requestbuilder import Arg
-from requestbuilder.exceptions import ServerError
+from requestbuilder.exceptions import ArgumentError, ServerError
 
 from euca2ools.commands.bundle.mixins import BundleDownloadingMixin
 from euca2ools.commands.s3 import S3Request
 from euca2ools.commands.s3.deletebucket import DeleteBucket
 from euca2ools.commands.s3.deleteobject import DeleteObject
+from euca2ools.commands.s3.deleteobjects import (DeleteObjects,
+                                                 DELETE_OBJECTS_MAX_KEYS)
+from euca2ools.commands.s3.listbucket import ListBucket
+import euca2ools.util
+
+
+_DEFAULT_DELETE_THREADS = 8
 
 
 class DeleteBundle(S3Request, BundleDownloadingMixin):
-    DESCRIPTION = 'Delete a previously-uploaded bundle'
+    DESCRIPTION = ('Delete a previously-uploaded bundle\n\nTo delete '
+                   'several bundles at once, give -m or -p a shell-style '
+                   'wildcard pattern, such as -p "nightly-*".  -p "*" '
+                   'deletes every bundle directly under the bucket and '
+                   'prefix given with -b, but not those in deeper '
+                   '"directories."')
     ARGS = [Arg('--clear', dest='clear', action='store_true',
-                help='attempt to delete the bucket as well')]
+                help='attempt to delete the bucket as well'),
+            Arg('--delete-threads', metavar='N', type=int, route_to=None,
+                help='''number of objects to delete at the same time when
+                the server cannot delete them in batches (default: 8)''')]
+
+    def __init__(self, **kwargs):
+        S3Request.__init__(self, **kwargs)
+        # Whether the server can delete objects in batches, which we do
+        # not know until we try
+        self.__can_delete_in_batches = None
+
+    # noinspection PyExceptionInherit
+    def configure(self):
+        S3Request.configure(self)
+        if (self.args.get('delete_threads') or 1) < 1:
+            raise ArgumentError(
+                'argument --delete-threads: value must be positive')
 
     def main(self):
-        try:
-            manifest = self.fetch_manifest(self.service)
-        except ServerError as err:
-            if err.status_code == 404 and self.args.get('clear'):
-                try:
-                    # We are supposed to try to delete the bucket even
-                    # if the manifest isn't there.  If it works, the
-                    # bundle is also gone and we can safely return.
-                    #
-                    # https://eucalyptus.atlassian.net/browse/TOOLS-379
+        manifest_name = self.args.get('manifest')
+        if manifest_name and _is_pattern(manifest_name):
+            manifest_s3paths = self.__find_manifests(manifest_name)
+            if not manifest_s3paths:
+                if self.args.get('clear'):
+                    # Just like below, the bucket may be empty anyway
                     self.__delete_bucket()
                     return
-                except ServerError:
-                    # If the bucket wasn't empty then we'll go back to
-                    # complaining about the missing manifest.
-                    self.log.error(
-                        'failed to delete bucket %s after a failed '
-                        'attempt to fetch the bundle manifest',
-                        bucket=self.args['bucket'].split('/')[0],
-                        exc_info=True)
-            raise
-
-        for _, part_s3path in self.map_bundle_parts_to_s3paths(manifest):
-            req = DeleteObject.from_other(self, path=part_s3path)
-            req.main()
-        manifest_s3path = self.get_manifest_s3path()
-        if manifest_s3path:
-            req = DeleteObject.from_other(self, path=manifest_s3path)
-            req.main()
+                raise ValueError("no bundle manifests in '{0}' match '{1}'"
+                                 .format(self.args['bucket'], manifest_name))
+            part_s3paths = []
+            for manifest_s3path in manifest_s3paths:
+                manifest = self.fetch_manifest(
+                    self.service, manifest_s3path=manifest_s3path)
+                # Parts sit next to their manifests
+                part_s3paths.extend(
+                    posixpath.join(posixpath.dirname(manifest_s3path),
+                                   part.filename)
+                    for part in manifest.image_parts)
+        else:
+            try:
+                manifest = self.fetch_manifest(self.service)
+            except ServerError as err:
+                if err.status_code == 404 and self.args.get('clear'):
+                    try:
+                        # We are supposed to try to delete the bucket even
+                        # if the manifest isn't there.  If it works, the
+                        # bundle is also gone and we can safely return.
+                        #
+                        # https://eucalyptus.atlassian.net/browse/TOOLS-379
+                        self.__delete_bucket()
+                        return
+                    except ServerError:
+                        # If the bucket wasn't empty then we'll go back to
+                        # complaining about the missing manifest.
+                        self.log.error(
+                            'failed to delete bucket %s after a failed '
+                            'attempt to fetch the bundle manifest',
+                            bucket=self.args['bucket'].split('/')[0],
+                            exc_info=True)
+                raise
+            part_s3paths = [part_s3path for _, part_s3path in
+                            self.map_bundle_parts_to_s3paths(manifest)]
+            manifest_s3path = self.get_manifest_s3path()
+            manifest_s3paths = [manifest_s3path] if manifest_s3path else []
+
+        # Manifests go last so a bundle that is only partly deleted can
+        # still be found and deleted again.
+        self.__delete_objects(part_s3paths)
+        self.__delete_objects(manifest_s3paths)
 
         if self.args.get('clear'):
             self.__delete_bucket()
 
+    def __find_manifests(self, pattern):
+        bucket, _, prefix = self.args['bucket'].partition('/')
+        prefix = prefix.strip('/')
+        if prefix:
+            list_path = '{0}/{1}/'.format(bucket, prefix)
+        else:
+            list_path = bucket
+        manifest_s3paths = []
+        for obj in ListBucket.from_other(self, paths=[list_path]).main()[
+                'Contents']:
+            name = obj['Key'][len(prefix) + 1:] if prefix else obj['Key']
+            # fnmatch's wildcards match "/" too, so without this a pattern
+            # would reach into every "directory" beneath the prefix.
+            if (name.endswith('.manifest.xml') and '/' not in name and
+                    fnmatch.fnmatchcase(name, pattern)):
+                manifest_s3paths.append('/'.join((bucket, obj['Key'])))
+        self.log.info('found %i bundle manifests matching %s',
+                      len(manifest_s3paths), pattern)
+        return manifest_s3paths
+
+    def __delete_objects(self, s3paths):
+        # Deleting up to DELETE_OBJECTS_MAX_KEYS objects per request saves
+        # thousands of round trips for big bundles, but not every server
+        # supports it.  If the first batch fails we assume it does not and
+        # delete objects one at a time in several threads instead.
+        by_bucket = {}
+        for s3path in s3paths:
+            bucket, _, key = s3path.partition('/')
+            by_bucket.setdefault(bucket, []).append(key)
+        for bucket, keys in sorted(by_bucket.items()):
+            for start in range(0, len(keys), DELETE_OBJECTS_MAX_KEYS):
+                batch = keys[start:start + DELETE_OBJECTS_MAX_KEYS]
+                if self.__can_delete_in_batches is False:
+                    self.__delete_objects_in_threads(bucket, batch)
+                    continue
+                try:
+                    errors = DeleteObjects.from_other(
+                        self, bucket=bucket, keys=batch).main()
+                except ServerError:
+                    if self.__can_delete_in_batches:
+                        raise
+                    self.log.info('failed to delete objects in batches; '
+                                  'deleting them one at a time',
+                                  exc_info=True)
+                    self.__can_delete_in_batches = False
+                    self.__delete_objects_in_threads(bucket, batch)
+                    continue
+                self.__can_delete_in_batches = True
+                for error in errors:
+                    self.log.error('failed to delete %s/%s: %s: %s', bucket,
+                                   error.get('Key'), error.get('Code'),
+                                   error.get('Message'))
+                if errors:
+                    raise RuntimeError(
+                        'failed to delete {0} object(s), such as {1}/{2} '
+                        '({3})'.format(len(errors), bucket,
+                                       errors[0].get('Key'),
+                                       errors[0].get('Message') or
+                                       errors[0].get('Code')))
+
+    def __delete_objects_in_threads(self, bucket, keys):
+        def delete_object(key):
+            DeleteObject.from_other(
+                self, path='/'.join((bucket, key))).main()
+
+        for _ in euca2ools.util.imap_in_threads(
+                delete_object, keys, self.args.get('delete_threads') or
+                _DEFAULT_DELETE_THREADS):
+            pass
+
     def __delete_bucket(self):
         req = DeleteBucket.from_other(self,
                                       bucket=self.args['bucket'].split('/')[0])
         req.main()
+
+
+def _is_pattern(name):
+    return any(char in name for char in '*?[')
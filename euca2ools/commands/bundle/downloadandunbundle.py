@@ -35,13 +35,14 @@ import six
 from euca2ools.bundle.util import open_pipe_fileobjs
 from euca2ools.bundle.util import waitpid_in_thread
 from euca2ools.commands.bundle.downloadbundle import DownloadBundle
-from euca2ools.commands.bundle.mixins import BundleDownloadingMixin
+from euca2ools.commands.bundle.mixins import (BundleDownloadingMixin,
+                                              PipelineStatsMixin)
 from euca2ools.commands.bundle.unbundlestream import UnbundleStream
 from euca2ools.commands.s3 import S3Request
 
 
 class DownloadAndUnbundle(S3Request, FileTransferProgressBarMixin,
-                          BundleDownloadingMixin):
+                          BundleDownloadingMixin, PipelineStatsMixin):
     DESCRIPTION = ('Download and unbundle a bundled image from the cloud\n\n '
                    'The key used to unbundle the image must match a '
                    'certificate that was used to bundle it.')
@@ -51,7 +52,22 @@ class DownloadAndUnbundle(S3Request, FileTransferProgressBarMixin,
             Arg('-k', '--privatekey',
                 help='''file containing the private key to decrypt the bundle
                 with.  This must match a certificate used when bundling the
-                image.''')]
+                image.'''),
+            Arg('--in-process', action='store_true', help='''do all of the
+                unbundling work in a single process instead of a chain of
+                external programs (requires the python cryptography
+                library)'''),
+            Arg('--sparse', action='store_true', help='''do not write
+                blocks of the image that contain only zeroes.  Regular
+                files get holes there instead.  Block devices are assumed
+                to already contain zeroes (e.g. they were just
+                discarded).'''),
+            Arg('--drop-cache', action='store_true', help='''preallocate
+                the image when possible and keep what is written from
+                lingering in the page cache, at some cost in speed'''),
+            Arg('--download-threads', metavar='N', type=int, default=1,
+                help='''number of bundle parts to download at the same time
+                (default: 1)''')]
 
     # noinspection PyExceptionInherit
     def configure(self):
@@ -97,6 +113,7 @@ class DownloadAndUnbundle(S3Request, FileTransferProgressBarMixin,
     def main(self):
         manifest = self.fetch_manifest(
             self.service, privkey_filename=self.args['privatekey'])
+        pipeline_stats = self.get_pipeline_stats()
         download_out_r, download_out_w = open_pipe_fileobjs()
         try:
             self.__create_download_pipeline(download_out_w)
@@ -107,8 +124,13 @@ class DownloadAndUnbundle(S3Request, FileTransferProgressBarMixin,
             self, source=download_out_r, dest=self.args['dest'],
             enc_key=manifest.enc_key, enc_iv=manifest.enc_iv,
             image_size=manifest.image_size, sha1_digest=manifest.image_digest,
-            show_progress=self.args.get('show_progress', False))
+            show_progress=self.args.get('show_progress', False),
+            in_process=self.args.get('in_process'),
+            sparse=self.args.get('sparse'),
+            drop_cache=self.args.get('drop_cache'),
+            pipeline_stats=pipeline_stats)
         unbundlestream.main()
+        self.print_pipeline_stats()
         return image_filename
 
     def __create_download_pipeline(self, outfile):
@@ -116,10 +138,16 @@ class DownloadAndUnbundle(S3Request, FileTransferProgressBarMixin,
             self, dest=outfile, bucket=self.args['bucket'],
             manifest=self.args.get('manifest'),
             local_manifest=self.args.get('local_manifest'),
-            show_progress=False)
+            download_threads=self.args.get('download_threads'),
+            show_progress=False,
+            pipeline_stats=self.args.get('pipeline_stats'))
         downloadbundle_p = multiprocessing.Process(target=downloadbundle.main)
         downloadbundle_p.start()
-        waitpid_in_thread(downloadbundle_p.pid)
+        if self.args.get('pipeline_stats') is not None:
+            self.args['pipeline_stats'].watch_process('download',
+                                                      downloadbundle_p.pid)
+        else:
+            waitpid_in_thread(downloadbundle_p.pid)
         outfile.close()
 
     def print_result(self, image_filename):
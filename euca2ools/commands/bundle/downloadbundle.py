@@ -32,18 +32,23 @@ from requestbuilder.exceptions import ArgumentError
 from requestbuilder.mixins import FileTransferProgressBarMixin
 import six
 
-from euca2ools.commands.bundle.mixins import BundleDownloadingMixin
+from euca2ools.bundle.pipes.stats import finish_stage, start_stage
+from euca2ools.commands.bundle.mixins import (BundleDownloadingMixin,
+                                              PipelineStatsMixin)
 from euca2ools.commands.s3 import S3Request
 
 
 class DownloadBundle(S3Request, FileTransferProgressBarMixin,
-                     BundleDownloadingMixin):
+                     BundleDownloadingMixin, PipelineStatsMixin):
     DESCRIPTION = ('Download a bundled image from the cloud\n\nYou must run '
                    'euca-unbundle-image on the bundle you download to obtain '
                    'the original image.')
     ARGS = [Arg('-d', '--directory', dest='dest', metavar='DIR', default=".",
                 help='''the directory to download the bundle parts to, or "-"
-                to write the bundled image to stdout''')]
+                to write the bundled image to stdout'''),
+            Arg('--download-threads', metavar='N', type=int, default=1,
+                help='''number of bundle parts to download at the same time
+                (default: 1)''')]
 
     # noinspection PyExceptionInherit
     def configure(self):
@@ -65,12 +70,21 @@ class DownloadBundle(S3Request, FileTransferProgressBarMixin,
     # noinspection PyExceptionInherit
     def main(self):
         manifest = self.fetch_manifest(self.service)
+        # When this runs as part of another command this may be in a
+        # different process than the one collecting stats, so this stage
+        # always reports them rather than recording them directly.
+        pipeline_stats = self.get_pipeline_stats()
+        download_stats = start_stage('download', pipeline_stats)
         if isinstance(self.args['dest'], six.string_types):
             manifest_dest = self.download_bundle_to_dir(
-                manifest, self.args['dest'], self.service)
+                manifest, self.args['dest'], self.service,
+                stats=download_stats)
         else:
             manifest_dest = self.download_bundle_to_fileobj(
-                manifest, self.args['dest'], self.service)
+                manifest, self.args['dest'], self.service,
+                stats=download_stats)
+        finish_stage(download_stats, pipeline_stats)
+        self.print_pipeline_stats()
         return manifest, manifest_dest
 
     def print_result(self, result):
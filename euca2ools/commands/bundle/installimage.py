@@ -38,11 +38,12 @@ from euca2ools.commands.bootstrap import BootstrapRequest
 from euca2ools.commands.s3 import S3Request
 from euca2ools.commands.bundle.bundleanduploadimage import BundleAndUploadImage
 from euca2ools.commands.bundle.mixins import BundleCreatingMixin, \
-    BundleUploadingMixin
+    BundleUploadingMixin, PipelineStatsMixin
 
 
 class InstallImage(S3Request, BundleCreatingMixin, BundleUploadingMixin,
-                   FileTransferProgressBarMixin, TabifyingMixin):
+                   FileTransferProgressBarMixin, PipelineStatsMixin,
+                   TabifyingMixin):
     DESCRIPTION = 'Bundle, upload and register an image into the cloud'
     ARGS = [Arg('-n', '--name', route_to=None, required=True,
                 help='name of the new image (required)'),
@@ -51,6 +52,12 @@ class InstallImage(S3Request, BundleCreatingMixin, BundleUploadingMixin,
             Arg('--max-pending-parts', type=int, default=2,
                 help='''pause the bundling process when more than this number
                 of parts are waiting to be uploaded (default: 2)'''),
+            Arg('--stage-parts-in-memory', action='store_true',
+                help='''hold bundle parts in memory until they are uploaded
+                instead of writing them to disk.  Memory for all of them is
+                allocated at the start, so unless --part-size is given,
+                parts are kept small enough for that to stay within 512
+                MiB where possible.'''),
             Arg('--virtualization-type', route_to=None,
                 choices=('paravirtual', 'hvm'),
                 help='virtualization type for the new image'),
@@ -105,13 +112,19 @@ class InstallImage(S3Request, BundleCreatingMixin, BundleUploadingMixin,
             destination=self.args.get("destination"),
             kernel=self.args.get("kernel"), ramdisk=self.args.get("ramdisk"),
             image_type=self.args.get("image_type"),
-            image_size=self.args.get("image_size"), cert=self.args.get("cert"),
+            image_size=self.args.get("image_size"),
+            image_compression=self.args.get("image_compression"),
+            cert=self.args.get("cert"),
             privatekey=self.args.get("privatekey"),
             ec2cert=self.args.get("ec2cert"), user=self.args.get("user"),
             productcodes=self.args.get("productcodes"),
             enc_iv=self.args.get("enc_iv"), enc_key=self.args.get("enc_key"),
             max_pending_parts=self.args.get("max_pending_parts"),
             part_size=self.args.get("part_size"), batch=self.args.get("batch"),
+            in_process=self.args.get("in_process"),
+            upload_threads=self.args.get("upload_threads"),
+            stage_parts_in_memory=self.args.get("stage_parts_in_memory"),
+            show_stats=self.args.get("show_stats"),
             show_progress=self.args.get("show_progress"))
         result_bundle = req.main()
         image_location = result_bundle['manifests'][0]["key"]
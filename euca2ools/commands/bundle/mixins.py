@@ -28,16 +28,24 @@ import atexit
 import base64
 import os.path
 import random
-import subprocess
+import shutil
+import stat
 import sys
 import tempfile
+import threading
+import time
 
 from requestbuilder import Arg, MutuallyExclusiveArgList
 from requestbuilder.exceptions import ArgumentError
 import six
 
 import euca2ools.bundle.manifest
+from euca2ools.bundle.pipes.flowcontrol import ByteBudget
+from euca2ools.bundle.pipes.stats import (instrument_iter, instrument_writer,
+                                          PipelineStats)
 import euca2ools.bundle.util
+import euca2ools.crypto
+import euca2ools.util
 from euca2ools.commands.argtypes import (b64encoded_file_contents,
                                          delimited_list, filesize,
                                          manifest_block_device_mappings)
@@ -46,6 +54,7 @@ from euca2ools.commands.bootstrap.describeservicecertificates import \
 from euca2ools.commands.s3.checkbucket import CheckBucket
 from euca2ools.commands.s3.createbucket import CreateBucket
 from euca2ools.commands.s3.getobject import GetObject
+from euca2ools.commands.s3.headobject import HeadObject
 from euca2ools.commands.s3.postobject import PostObject
 from euca2ools.commands.s3.putobject import PutObject
 from euca2ools.exceptions import AWSError
@@ -53,6 +62,49 @@ from euca2ools.exceptions import AWSError
 
 EC2_BUNDLE_SIZE_LIMIT = 10 * 2 ** 30  # 10 GiB
 
+# Parts that are downloaded ahead of the one a stream is waiting for are
+# kept in memory up to this size and spill over to disk beyond it.
+_PART_SPOOL_MAX_SIZE = 16 * 2 ** 20  # 16 MiB
+# ...and no more than this many bytes of them are kept in all, unless
+# there are enough download threads to need more.
+_MAX_DOWNLOAD_AHEAD_BYTES = 2 ** 30  # 1 GiB
+# Parts staged in memory get all of their buffers up front, so automatic
+# part sizes are kept small enough that those fit in this many bytes.
+_MAX_STAGED_PART_BYTES = 2 ** 29  # 512 MiB
+
+
+class PipelineStatsMixin(object):
+    ARGS = [Arg('--show-stats', nargs='?', const='table',
+                choices=('table', 'json'), help='''when finished, show how
+                much data went through each stage of the process, how long
+                each stage spent waiting to read and write, and how much
+                CPU time it used, on stderr as a table (the default) or as
+                JSON'''),
+            Arg('--pipeline-stats', route_to=None, help=argparse.SUPPRESS)]
+
+    def get_pipeline_stats(self):
+        """
+        Return the PipelineStats this command's stages should report to,
+        or None if nobody asked for stats.  A command that runs another
+        can share its PipelineStats with it as pipeline_stats.
+        """
+        if (self.args.get('pipeline_stats') is None and
+                self.args.get('show_stats')):
+            self.args['pipeline_stats'] = PipelineStats()
+        return self.args.get('pipeline_stats')
+
+    def print_pipeline_stats(self):
+        # Only the command that was asked to show stats prints them.
+        # Commands it shares them with just contribute stages.
+        pipeline_stats = self.args.get('pipeline_stats')
+        if pipeline_stats is None or not self.args.get('show_stats'):
+            return
+        pipeline_stats.collect()
+        if self.args['show_stats'] == 'json':
+            print >> sys.stderr, pipeline_stats.as_json()
+        else:
+            print >> sys.stderr, pipeline_stats.as_table()
+
 
 class BundleCreatingMixin(object):
     ARGS = [Arg('-i', '--image', metavar='FILE', required=True,
@@ -111,10 +163,22 @@ class BundleCreatingMixin(object):
             # When bundling stdin we interpret --prefix as the image's file
             # name.
             Arg('--image-size', type=filesize, help='''the image's size
-                (required when bundling stdin)'''),
+                (required when bundling stdin, and when decompressing a
+                gzip-compressed image or a compressed image that does not
+                record its size)'''),
+            Arg('--image-compression', route_to=None,
+                choices=('auto', 'gzip', 'xz', 'zstd', 'none'),
+                help='''decompress a gzip-, xz-, or zstd-compressed image
+                while bundling it.  "auto" decompresses the image only if
+                it looks compressed.  (default: none)'''),
+
+            Arg('--in-process', action='store_true', help='''do all of the
+                bundling work in a single process instead of a chain of
+                external programs (requires the python cryptography
+                library)'''),
 
             # Overrides for debugging and other entertaining uses
-            Arg('--part-size', type=filesize, default=10485760,  # 10M
+            Arg('--part-size', type=filesize,  # default: automatic
                 help=argparse.SUPPRESS),
             Arg('--enc-key', type=(lambda s: int(s, 16)),
                 help=argparse.SUPPRESS),  # a hex string
@@ -195,7 +259,7 @@ class BundleCreatingMixin(object):
                 # Pay close attention to ordering to ensure all
                 # of this request's dependencies have been fulfilled.
                 try:
-                    fetched_cert = self.__get_bundle_certificate(
+                    fetched_cert = self.fetch_bundle_certificate(
                         self.args['bootstrap_service'],
                         self.args['bootstrap_auth'])
                 except AWSError as err:
@@ -238,13 +302,30 @@ class BundleCreatingMixin(object):
             if not self.args.get('image_size'):
                 raise ArgumentError(
                     'argument --image-size is required when bundling stdin')
+            if self.args.get('image_compression') not in (None, 'none'):
+                raise ArgumentError('argument --image-compression may not '
+                                    'be used when bundling stdin')
+            self.args['image_compression'] = None
         elif isinstance(self.args['image'], six.string_types):
+            self.configure_image_compression()
             if not self.args.get('prefix'):
                 self.args['prefix'] = os.path.basename(self.args['image'])
+                # What we bundle is the decompressed image, so its name
+                # should not claim otherwise.
+                suffix = euca2ools.bundle.util.IMAGE_COMPRESSION_SUFFIXES.get(
+                    self.args.get('image_compression'))
+                if suffix and self.args['prefix'].endswith(suffix):
+                    self.args['prefix'] = self.args['prefix'][:-len(suffix)]
             if not self.args.get('image_size'):
                 self.args['image_size'] = euca2ools.util.get_filesize(
                     self.args['image'])
-            self.args['image'] = open(self.args['image'])
+            image = open(self.args['image'])
+            if (stat.S_ISREG(os.fstat(image.fileno()).st_mode) and
+                    not self.args.get('image_compression')):
+                # Freshly-built images tend to be mostly holes, which we
+                # need not bother reading from disk.
+                image = euca2ools.bundle.util.SparseFileReader(image)
+            self.args['image'] = image
         else:
             # Assume it is already a file object
             if not self.args.get('prefix'):
@@ -253,10 +334,79 @@ class BundleCreatingMixin(object):
             if not self.args.get('image_size'):
                 raise ArgumentError('argument --image-size is required when '
                                     'bundling a file object')
+            if self.args.get('image_compression') == 'auto':
+                raise ArgumentError('argument --image-compression: "auto" '
+                                    'may not be used when bundling a file '
+                                    'object')
+            if self.args.get('image_compression') == 'none':
+                self.args['image_compression'] = None
         if self.args['image_size'] > EC2_BUNDLE_SIZE_LIMIT:
             self.log.warn(
                 'image is incompatible with EC2 due to its size (%i > %i)',
                 self.args['image_size'], EC2_BUNDLE_SIZE_LIMIT)
+        if (self.args.get('in_process') and
+                not euca2ools.crypto.HAVE_CRYPTOGRAPHY):
+            raise ArgumentError('argument --in-process: the python '
+                                'cryptography library is not installed')
+
+    def configure_image_compression(self):
+        # This runs before image_size is filled in from the file's size,
+        # which would be the compressed size.
+        # Decompressing is opt-in because it changes what the bundle
+        # contains, and things like ramdisks are often compressed files
+        # that must be bundled exactly as they are.
+        image = self.args['image']
+        compression = self.args.get('image_compression')
+        if compression in (None, 'none'):
+            self.args['image_compression'] = None
+            return
+        if os.path.isfile(image):
+            detected = euca2ools.bundle.util.detect_image_compression(image)
+        else:
+            detected = None
+        if compression == 'auto':
+            compression = detected
+        elif compression != detected:
+            raise ArgumentError(
+                "argument --image-compression: '{0}' is not a "
+                "{1}-compressed file".format(image, compression))
+        self.args['image_compression'] = compression
+        if compression is None:
+            return
+        self.args['compressed_image_size'] = euca2ools.util.get_filesize(
+            image)
+        if not self.args.get('image_size'):
+            self.args['image_size'] = \
+                euca2ools.bundle.util.get_uncompressed_image_size(
+                    image, compression)
+        if not self.args.get('image_size'):
+            raise ArgumentError(
+                'argument --image-size is required for this {0}-compressed '
+                'image because it does not record its decompressed size'
+                .format(compression))
+        self.log.info('image is %s-compressed; decompressing it to %i '
+                      'bytes while bundling', compression,
+                      self.args['image_size'])
+
+    def configure_part_size(self, rtt=None):
+        # This needs the image's size, so it must run after that is
+        # known.  A part size from the command line or from a bundle
+        # journal stays as it is.
+        if self.args.get('part_size'):
+            return
+        max_size = euca2ools.util.MAX_PART_SIZE
+        if self.args.get('stage_parts_in_memory'):
+            # This is how many buffers the PartBufferRing will allocate
+            slots = max(1, self.args.get('max_pending_parts') or 1,
+                        self.args.get('upload_threads') or 1)
+            max_size = min(max_size, max(
+                euca2ools.util.MIN_PART_SIZE,
+                _MAX_STAGED_PART_BYTES // slots // 2 ** 20 * 2 ** 20))
+        self.args['part_size'] = euca2ools.util.choose_part_size(
+            self.args['image_size'], rtt=rtt,
+            threads=self.args.get('upload_threads') or 1, max_size=max_size)
+        self.log.info('using a bundle part size of %i bytes',
+                      self.args['part_size'])
 
     def configure_bundle_properties(self):
         if self.args.get('kernel') == 'true':
@@ -299,7 +449,12 @@ class BundleCreatingMixin(object):
         self.args['enc_key'] = '{0:0>32x}'.format(enc_key_i)
         self.args['enc_iv'] = '{0:0>32x}'.format(enc_iv_i)
 
-    def __get_bundle_certificate(self, bootstrap_service, bootstrap_auth):
+    def fetch_bundle_certificate(self, bootstrap_service, bootstrap_auth):
+        """
+        Fetch the cloud's image bundling certificate from the bootstrap
+        service and return the name of a temporary file that contains it,
+        or None if the service does not have one.
+        """
         self.log.info('attempting to obtain cloud certificate from '
                       'bootstrap service')
         req = DescribeServiceCertificates(
@@ -313,7 +468,6 @@ class BundleCreatingMixin(object):
                 cert_file = tempfile.NamedTemporaryFile(delete=False)
                 cert_file.write(cert['certificate'])
                 cert_file.file.flush()
-                self.args['ec2cert'] = cert_file.name
                 atexit.register(os.remove, cert_file.name)
                 return cert_file.name
 
@@ -345,8 +499,9 @@ class BundleCreatingMixin(object):
 
     def dump_manifest_to_file(self, manifest, filename, pretty_print=False):
         with open(filename, 'w') as manifest_file:
-            manifest_file.write(self.dump_manifest_to_str(
-                manifest, pretty_print=pretty_print))
+            manifest.dump_to_file(manifest_file, self.args['privatekey'],
+                                  self.args['cert'], self.args['ec2cert'],
+                                  pretty_print=pretty_print)
 
     def dump_manifest_to_str(self, manifest, pretty_print=False):
         return manifest.dump_to_str(self.args['privatekey'], self.args['cert'],
@@ -354,6 +509,52 @@ class BundleCreatingMixin(object):
                                     pretty_print=pretty_print)
 
 
+class BundleDestination(object):
+    """
+    A bucket other than the one given with -b/--bucket to upload a bundle
+    to, possibly in another region.  This has the config, service, auth,
+    and log that requests' from_other methods look for, so requests for
+    the destination can be made from it just like they are made from the
+    command itself.
+
+    A destination in another region gets credentials of its own:  access
+    keys given with -I/-S or in the environment are used everywhere, but
+    otherwise they come from the user the config file names for that
+    region, falling back to the command's own user.
+    """
+
+    def __init__(self, command, bucket, region=None):
+        self.bucket = bucket
+        self.region = region
+        self.log = command.log
+        self.ec2cert = None
+        if region:
+            self.config = command.config.clone(
+                region=region,
+                user=command.config.get_region_option('user', region=region))
+            self.service = command.SERVICE_CLASS(
+                self.config, loglevel=command.log.level, region=region)
+            self.service.configure()
+            # Built the same way from_other builds one, but looking keys
+            # up through this destination's config instead of the
+            # command's
+            self.auth = type(command.auth)(
+                self.config, loglevel=command.log.level,
+                key_id=command.args.get('key_id'),
+                secret_key=command.args.get('secret_key'),
+                security_token=command.args.get('security_token'))
+            self.auth.configure()
+        else:
+            self.config = command.config
+            self.service = command.service
+            self.auth = command.auth
+
+    def __str__(self):
+        if self.region:
+            return '{0}:{1}'.format(self.region, self.bucket)
+        return self.bucket
+
+
 class BundleUploadingMixin(object):
     ARGS = [Arg('-b', '--bucket', metavar='BUCKET[/PREFIX]', required=True,
                 help='bucket to upload the bundle to (required)'),
@@ -376,7 +577,10 @@ class BundleUploadingMixin(object):
                 bucket (default: inferred from s3-location-constraint in
                 configuration, or otherwise none)'''),
             Arg('--retry', dest='retries', action='store_const', const=5,
-                default=0, help='retry failed uploads up to 5 times')]
+                default=0, help='retry failed uploads up to 5 times'),
+            Arg('--upload-threads', metavar='N', type=int, default=1,
+                help='''number of bundle parts to upload at the same time
+                (default: 1)''')]
 
     def configure_bundle_upload_auth(self):
         if self.args.get('upload_policy'):
@@ -389,29 +593,41 @@ class BundleUploadingMixin(object):
             self.auth = None
             self.AUTH_CLASS = None
 
-    def get_bundle_key_prefix(self):
-        (bucket, _, prefix) = self.args['bucket'].partition('/')
+    def get_bundle_key_prefix(self, destination=None):
+        # A destination is a BundleDestination to use instead of the
+        # bucket given with -b/--bucket.  The same goes for the other
+        # methods here that take one.
+        if destination is not None:
+            (bucket, _, prefix) = destination.bucket.partition('/')
+        else:
+            (bucket, _, prefix) = self.args['bucket'].partition('/')
         if prefix and not prefix.endswith('/'):
             prefix += '/'
         return bucket + '/' + prefix
 
-    def ensure_dest_bucket_exists(self):
+    def ensure_dest_bucket_exists(self, destination=None):
         if self.args.get('upload_policy'):
             # We won't have creds to sign our own requests
             self.log.info('using an upload policy; not verifying bucket '
                           'existence')
             return
 
-        bucket = self.args['bucket'].split('/', 1)[0]
+        if destination is not None:
+            bucket = destination.bucket.split('/', 1)[0]
+            location = destination.config.get_region_option(
+                's3-location-constraint')
+        else:
+            bucket = self.args['bucket'].split('/', 1)[0]
+            location = self.args.get('location')
         try:
-            req = CheckBucket.from_other(self, bucket=bucket)
+            req = CheckBucket.from_other(destination or self, bucket=bucket)
             req.main()
         except AWSError as err:
             if err.status_code == 404:
                 # No such bucket
                 self.log.info("creating bucket '%s'", bucket)
                 req = CreateBucket.from_other(
-                    self, bucket=bucket, location=self.args.get('location'))
+                    destination or self, bucket=bucket, location=location)
                 req.main()
             else:
                 raise
@@ -421,11 +637,20 @@ class BundleUploadingMixin(object):
         # proactive about it.
 
     def upload_bundle_file(self, source, dest, show_progress=False,
+                           content_md5=None, size=None, destination=None,
                            **putobj_kwargs):
+        """
+        Upload a file that is part of a bundle and return the ETag the
+        server gave it, if any.  If the file's MD5 digest is already known
+        it can be supplied as content_md5 to save computing it again.
+
+        The source may also be a file object, in which case size must
+        say how much of it to upload.
+        """
+        if not isinstance(source, six.string_types):
+            putobj_kwargs.setdefault('progressbar_label',
+                                     getattr(source, 'name', None))
         if self.args.get('upload_policy'):
-            if show_progress:
-                # PostObject does not yet support show_progress
-                print source, 'uploading...'
             if self.args.get('security_token'):
                 postobj_kwargs = \
                     {'x-amz-security-token': self.args['security_token']}
@@ -437,35 +662,152 @@ class BundleUploadingMixin(object):
                 acl=self.args.get('acl') or 'aws-exec-read',
                 Policy=self.args['upload_policy'],
                 Signature=self.args['upload_policy_signature'],
-                AWSAccessKeyId=self.args['key_id'], **postobj_kwargs)
+                AWSAccessKeyId=self.args['key_id'],
+                retries=self.args.get('retries') or 0,
+                show_progress=show_progress, size=size, **postobj_kwargs)
         else:
             req = PutObject.from_other(
-                self, source=source, dest=dest,
+                destination or self, source=source, dest=dest,
                 acl=self.args.get('acl') or 'aws-exec-read',
                 retries=self.args.get('retries') or 0,
-                show_progress=show_progress, **putobj_kwargs)
+                show_progress=show_progress, content_md5=content_md5,
+                size=size, **putobj_kwargs)
         req.main()
+        if req.response is not None and req.response.headers.get('ETag'):
+            return req.response.headers['ETag'].lower().strip('"')
+        return None
 
     def upload_bundle_parts(self, partinfo_in_mpconn, key_prefix,
-                            partinfo_out_mpconn=None, part_write_sem=None,
-                            **putobj_kwargs):
+                            partinfo_out_mpconn=None, byte_budget=None,
+                            part_buffers=None, journal=None, stats=None,
+                            destinations=None, **putobj_kwargs):
+        # Parts are uploaded concurrently, but they still come out of this
+        # stage in order so the manifest lists them in order.  Anything
+        # that feeds this under a ByteBudget (byte_budget) should allow at
+        # least as many pending parts as there are upload threads.  Each
+        # part's size is released from it once the part is uploaded.
+        #
+        # When given a journal, parts it says were already uploaded are
+        # skipped as long as the server agrees, and parts that get
+        # uploaded are recorded in it.
+        #
+        # Parts that live in slots of part_buffers (a PartBufferRing) are
+        # uploaded straight from memory, and their slots are released
+        # once they are done.
+        #
+        # If stats (a StageStats) is given, the time spent waiting for
+        # parts counts as reading, and the time during which any part is
+        # being uploaded counts as writing.  Uploads overlap, so adding
+        # up how long each took would exceed the time the stage ran.
+        #
+        # Each part also goes to every BundleDestination in destinations
+        # at the same time it goes to key_prefix.
+        upload_threads = max(1, self.args.get('upload_threads') or 1)
+        all_destinations = [(key_prefix, None)]
+        for destination in destinations or ():
+            all_destinations.append(
+                (self.get_bundle_key_prefix(destination), destination))
+        if upload_threads > 1 or len(all_destinations) > 1:
+            # Several progress bars at once would just garble the terminal
+            putobj_kwargs['show_progress'] = False
+
+        def upload_part_to(part, dest_key_prefix, destination):
+            # Returns whether it uploaded anything, and the part's ETag
+            dest = dest_key_prefix + os.path.basename(part.filename)
+            if (journal is not None and self.__is_part_already_uploaded(
+                    part, dest, journal, destination=destination)):
+                self.log.info('skipping already-uploaded part %s', dest)
+                return False, None
+            if part.buffer_slot is not None:
+                etag = self.upload_bundle_file(
+                    part_buffers.open_slot(part.buffer_slot, part.size,
+                                           name=part.filename),
+                    dest, content_md5=part.md5_hexdigest, size=part.size,
+                    destination=destination, **putobj_kwargs)
+            else:
+                etag = self.upload_bundle_file(
+                    part.filename, dest, content_md5=part.md5_hexdigest,
+                    destination=destination, **putobj_kwargs)
+            return True, etag
+
+        busy = {'uploads': 0, 'since': None}
+        busy_lock = threading.Lock()
+
+        def upload_part(part):
+            with busy_lock:
+                if busy['uploads'] == 0:
+                    busy['since'] = time.time()
+                busy['uploads'] += 1
+            try:
+                results = list(euca2ools.util.imap_in_threads(
+                    lambda dest_info: upload_part_to(part, *dest_info),
+                    all_destinations, len(all_destinations)))
+            finally:
+                with busy_lock:
+                    busy['uploads'] -= 1
+                    if busy['uploads'] == 0 and stats is not None:
+                        stats.write_time = ((stats.write_time or 0.0) +
+                                            time.time() - busy['since'])
+            if not any(uploaded for uploaded, _ in results):
+                return part, False
+            if journal is not None:
+                # Identical parts get identical ETags, so any will do
+                etag = next((etag for _, etag in results if etag), None)
+                journal.record_uploaded_part(part, etag)
+            return part, True
+
+        if stats is not None:
+            stats.start()
         try:
-            while True:
-                part = partinfo_in_mpconn.recv()
-                dest = key_prefix + os.path.basename(part.filename)
-                self.upload_bundle_file(part.filename, dest, **putobj_kwargs)
-                if part_write_sem is not None:
+            for part, uploaded in euca2ools.util.imap_in_threads(
+                    upload_part,
+                    instrument_iter(
+                        euca2ools.bundle.util.iter_mpconn(partinfo_in_mpconn),
+                        stats),
+                    upload_threads):
+                if stats is not None:
+                    stats.add_bytes_in(part.size)
+                    if uploaded:
+                        stats.add_bytes_out(part.size)
+                if byte_budget is not None:
                     # Allow something that's waiting for the upload to finish
                     # to continue
-                    part_write_sem.release()
+                    byte_budget.release(part.size)
+                if part.buffer_slot is not None:
+                    part_buffers.release(part.buffer_slot)
                 if partinfo_out_mpconn is not None:
                     partinfo_out_mpconn.send(part)
-        except EOFError:
-            return
         finally:
             partinfo_in_mpconn.close()
             if partinfo_out_mpconn is not None:
                 partinfo_out_mpconn.close()
+            if stats is not None:
+                stats.stop()
+
+    def __is_part_already_uploaded(self, part, dest, journal,
+                                   destination=None):
+        record = journal.get_uploaded_part(part)
+        if record is None:
+            return False
+        if self.args.get('upload_policy'):
+            # We won't have creds to sign our own requests
+            self.log.debug('using an upload policy; trusting the journal '
+                           'for part %s', dest)
+            return True
+        req = HeadObject.from_other(destination or self, path=dest)
+        try:
+            req.main()
+        except AWSError as err:
+            if err.status_code == 404:
+                self.log.info('part %s is in the journal but not on the '
+                              'server', dest)
+                return False
+            raise
+        their_etag = req.response.headers.get('ETag', '').lower().strip('"')
+        if record.get('etag'):
+            return their_etag == record['etag']
+        their_size = req.response.headers.get('Content-Length')
+        return their_size is not None and int(their_size) == part.size
 
 
 class BundleDownloadingMixin(object):
@@ -494,14 +836,19 @@ class BundleDownloadingMixin(object):
                     any that appear on the server'''))
             .required()]
 
-    def fetch_manifest(self, s3_service, privkey_filename=None):
-        if self.args.get('local_manifest'):
-            _assert_is_file(self.args['local_manifest'], 'manifest')
-            return euca2ools.bundle.manifest.BundleManifest.read_from_file(
-                self.args['local_manifest'], privkey_filename=privkey_filename)
+    def fetch_manifest(self, s3_service, privkey_filename=None,
+                       manifest_s3path=None):
+        # Commands that handle several bundles at once can use
+        # manifest_s3path to say which one's manifest to fetch.
+        if manifest_s3path is None:
+            if self.args.get('local_manifest'):
+                _assert_is_file(self.args['local_manifest'], 'manifest')
+                return (euca2ools.bundle.manifest.BundleManifest
+                        .read_from_file(self.args['local_manifest'],
+                                        privkey_filename=privkey_filename))
+            manifest_s3path = self.get_manifest_s3path()
 
         # It's on the server, so do things the hard way
-        manifest_s3path = self.get_manifest_s3path()
         with tempfile.TemporaryFile() as manifest_tempfile:
             self.log.info('reading manifest from %s', manifest_s3path)
             req = GetObject.from_other(
@@ -527,19 +874,32 @@ class BundleDownloadingMixin(object):
             # With a local manifest we can't divine the manifest's key name is
             return None
 
-    def download_bundle_to_dir(self, manifest, dest_dir, s3_service):
+    def download_bundle_to_dir(self, manifest, dest_dir, s3_service,
+                               stats=None):
         parts = self.map_bundle_parts_to_s3paths(manifest)
-        for part, part_s3path in parts:
+        download_threads = max(1, self.args.get('download_threads') or 1)
+        show_progress = (self.args.get('show_progress', False) and
+                         download_threads == 1)
+
+        def download_part(part_and_s3path):
+            part, part_s3path = part_and_s3path
             part.filename = os.path.join(dest_dir,
                                          os.path.basename(part_s3path))
             self.log.info('downloading part %s to %s',
                           part_s3path, part.filename)
-            req = GetObject.from_other(
-                self, service=s3_service, source=part_s3path,
-                dest=part.filename,
-                show_progress=self.args.get('show_progress', False))
-            response = req.main()
+            with open(part.filename, 'w') as part_file:
+                req = GetObject.from_other(
+                    self, service=s3_service, source=part_s3path,
+                    dest=part_file, show_progress=show_progress)
+                response = req.main()
             self.__check_part_sha1(part, part_s3path, response)
+            return response[part_s3path]['size']
+
+        for part_size in euca2ools.util.imap_in_threads(download_part, parts,
+                                                        download_threads):
+            if stats is not None:
+                stats.add_bytes_in(part_size)
+                stats.add_bytes_out(part_size)
 
         manifest_s3path = self.get_manifest_s3path()
         if manifest_s3path:
@@ -556,18 +916,75 @@ class BundleDownloadingMixin(object):
             return manifest_dest
         return None
 
-    def download_bundle_to_fileobj(self, manifest, fileobj, s3_service):
+    def download_bundle_to_fileobj(self, manifest, fileobj, s3_service,
+                                   stats=None):
         # We can skip downloading the manifest since we're just writing all
         # parts to a file object.
+        #
+        # If stats (a StageStats) is given, the time spent writing to
+        # fileobj counts as writing.
         parts = self.map_bundle_parts_to_s3paths(manifest)
-        for part, part_s3path in parts:
+        fileobj = instrument_writer(fileobj, stats)
+        download_threads = max(1, self.args.get('download_threads') or 1)
+        if download_threads == 1:
+            for part, part_s3path in parts:
+                self.log.info('downloading part %s', part_s3path)
+                req = GetObject.from_other(
+                    self, service=s3_service, source=part_s3path,
+                    dest=fileobj,
+                    show_progress=self.args.get('show_progress', False))
+                response = req.main()
+                self.__check_part_sha1(part, part_s3path, response)
+                if stats is not None:
+                    stats.add_bytes_in(response[part_s3path]['size'])
+            return
+
+        # Parts have to reach fileobj in order, so each thread downloads
+        # its part to a buffer of its own, which we then copy to fileobj
+        # when that part's turn comes.  Each part's SHA1 gets checked
+        # before anything gets written.
+        #
+        # Large buffers spill over to disk, so how many bytes of parts may
+        # wait for their turns depends on how fast fileobj takes them and
+        # on how much room there is for them.
+        max_part_size = max([part.size for part, _ in parts] or [0])
+        byte_budget = ByteBudget(
+            download_threads * max_part_size,
+            max_bytes=max(download_threads * max_part_size,
+                          _MAX_DOWNLOAD_AHEAD_BYTES),
+            path=euca2ools.util.get_tempdir_for_large_files())
+
+        def admit_part(part_and_s3path, block):
+            return byte_budget.acquire(part_and_s3path[0].size, block=block)
+
+        def download_part(part_and_s3path):
+            part, part_s3path = part_and_s3path
             self.log.info('downloading part %s', part_s3path)
-            req = GetObject.from_other(
-                self, service=s3_service, source=part_s3path,
-                dest=fileobj,
-                show_progress=self.args.get('show_progress', False))
-            response = req.main()
-            self.__check_part_sha1(part, part_s3path, response)
+            part_buf = euca2ools.util.spooled_tempfile_for_large_files(
+                max_size=_PART_SPOOL_MAX_SIZE, prefix='bundlepart-')
+            try:
+                req = GetObject.from_other(
+                    self, service=s3_service, source=part_s3path,
+                    dest=part_buf, show_progress=False)
+                response = req.main()
+                self.__check_part_sha1(part, part_s3path, response)
+            except Exception:
+                part_buf.close()
+                raise
+            part_buf.seek(0)
+            return part_buf
+
+        for part_buf in euca2ools.util.imap_in_threads(
+                download_part, parts, download_threads, admit=admit_part):
+            with part_buf:
+                part_buf.seek(0, os.SEEK_END)
+                part_size = part_buf.tell()
+                part_buf.seek(0)
+                if stats is not None:
+                    stats.add_bytes_in(part_size)
+                shutil.copyfileobj(part_buf, fileobj, euca2ools.BUFSIZE)
+            byte_budget.release(part_size)
+        fileobj.flush()
 
     def map_bundle_parts_to_s3paths(self, manifest):
         parts = []
@@ -597,6 +1014,6 @@ def _assert_is_file(filename, filetype):
 
 
 def _get_cert_fingerprint(cert_content):
-    popen = subprocess.Popen(('openssl', 'x509', '-fingerprint', '-noout'),
-                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    return popen.communicate(cert_content)[0].strip()
+    fingerprint = euca2ools.crypto.get_cert_content_fingerprint(cert_content)
+    return 'SHA1 Fingerprint={0}'.format(':'.join(
+        fingerprint[i:i + 2] for i in range(0, len(fingerprint), 2)).upper())
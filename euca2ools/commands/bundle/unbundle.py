@@ -36,13 +36,18 @@ from requestbuilder.mixins import (FileTransferProgressBarMixin,
 from euca2ools.commands import Euca2ools
 import euca2ools.bundle.pipes
 from euca2ools.bundle.manifest import BundleManifest
-from euca2ools.bundle.util import (close_all_fds, open_pipe_fileobjs,
-                                   waitpid_in_thread)
+from euca2ools.bundle.pipes.stats import (finish_stage, get_report_mpconn,
+                                          instrument_reader,
+                                          instrument_writer, start_stage)
+from euca2ools.bundle.util import (close_all_fds,
+                                   find_corrupt_bundle_parts,
+                                   open_pipe_fileobjs, waitpid_in_thread)
+from euca2ools.commands.bundle.mixins import PipelineStatsMixin
 from euca2ools.commands.bundle.unbundlestream import UnbundleStream
 
 
 class Unbundle(BaseCommand, FileTransferProgressBarMixin,
-               RegionConfigurableMixin):
+               PipelineStatsMixin, RegionConfigurableMixin):
     DESCRIPTION = ('Recreate an image from its bundled parts\n\nThe key used '
                    'to unbundle the image must match a certificate that was '
                    'used to bundle it.')
@@ -57,7 +62,26 @@ class Unbundle(BaseCommand, FileTransferProgressBarMixin,
                 directory)'''),
             Arg('-k', '--privatekey', metavar='FILE', help='''file containing
                 the private key to decrypt the bundle with.  This must match
-                a certificate used when bundling the image.''')]
+                a certificate used when bundling the image.'''),
+            Arg('--in-process', action='store_true', help='''do all of the
+                unbundling work in a single process instead of a chain of
+                external programs (requires the python cryptography
+                library)'''),
+            Arg('--sparse', action='store_true', help='''do not write
+                blocks of the image that contain only zeroes.  Regular
+                files get holes there instead.  Block devices are assumed
+                to already contain zeroes (e.g. they were just
+                discarded).'''),
+            Arg('--drop-cache', action='store_true', help='''preallocate
+                the image when possible and keep what is written from
+                lingering in the page cache, at some cost in speed'''),
+            Arg('--verify-only', action='store_true', help='''check every
+                bundle part against the manifest and report all of the
+                corrupt ones instead of unbundling the image'''),
+            Arg('--verify-image', action='store_true', help='''also decrypt
+                and decompress the bundle to check the whole image's
+                digest, without writing the image anywhere (implies
+                --verify-only)''')]
 
     # noinspection PyExceptionInherit
     def configure(self):
@@ -101,12 +125,22 @@ class Unbundle(BaseCommand, FileTransferProgressBarMixin,
             raise ArgumentError("argument -d/--destination: '{0}' is not a "
                                 "directory".format(self.args['destination']))
 
-    def __read_bundle_parts(self, manifest, outfile):
-        close_all_fds(except_fds=[outfile])
+    def __read_bundle_parts(self, manifest, outfile, pipeline_stats=None):
+        close_all_fds(except_fds=[outfile, get_report_mpconn(pipeline_stats)])
+        stage = start_stage('part-reader', pipeline_stats)
+        try:
+            self.__read_bundle_parts_to(manifest,
+                                        instrument_writer(outfile, stage),
+                                        stage)
+        finally:
+            finish_stage(stage, pipeline_stats)
+
+    def __read_bundle_parts_to(self, manifest, outfile, stage):
         for part in manifest.image_parts:
             self.log.debug("opening part '%s' for reading", part.filename)
             digest = hashlib.sha1()
             with open(part.filename) as part_file:
+                part_file = instrument_reader(part_file, stage)
                 while True:
                     chunk = part_file.read(euca2ools.BUFSIZE)
                     if chunk:
@@ -130,11 +164,13 @@ class Unbundle(BaseCommand, FileTransferProgressBarMixin,
         manifest = BundleManifest.read_from_fileobj(
             self.args['manifest'], privkey_filename=self.args['privatekey'])
 
+        verify = self.args.get('verify_only') or self.args.get('verify_image')
         for part in manifest.image_parts:
             part_path = os.path.join(self.args['source'], part.filename)
             while part_path.startswith('./'):
                 part_path = part_path[2:]
-            if os.path.exists(part_path):
+            if os.path.exists(part_path) or verify:
+                # Verification reports missing parts along with the rest
                 part.filename = part_path
             else:
                 raise RuntimeError(
@@ -142,14 +178,13 @@ class Unbundle(BaseCommand, FileTransferProgressBarMixin,
                     "-s to specify where to find the bundle's parts"
                     .format(part_path))
 
-        part_reader_out_r, part_reader_out_w = open_pipe_fileobjs()
-        part_reader = multiprocessing.Process(
-            target=self.__read_bundle_parts,
-            args=(manifest, part_reader_out_w))
-        part_reader.start()
-        part_reader_out_w.close()
-        waitpid_in_thread(part_reader.pid)
+        if verify:
+            self.verify_bundle(manifest)
+            self.print_pipeline_stats()
+            return None
 
+        pipeline_stats = self.get_pipeline_stats()
+        part_reader_out_r = self.__open_bundle_part_reader(manifest)
         image_filename = os.path.join(self.args['destination'],
                                       manifest.image_name)
         with open(image_filename, 'w') as image:
@@ -158,11 +193,60 @@ class Unbundle(BaseCommand, FileTransferProgressBarMixin,
                 enc_key=manifest.enc_key, enc_iv=manifest.enc_iv,
                 image_size=manifest.image_size,
                 sha1_digest=manifest.image_digest,
-                show_progress=self.args.get('show_progress', False))
+                show_progress=self.args.get('show_progress', False),
+                in_process=self.args.get('in_process'),
+                sparse=self.args.get('sparse'),
+                drop_cache=self.args.get('drop_cache'),
+                pipeline_stats=pipeline_stats)
             unbundlestream.main()
+        self.print_pipeline_stats()
         return image_filename
 
-    # pylint: disable=no-self-use
+    def verify_bundle(self, manifest):
+        self.log.info('checking %i bundle parts', len(manifest.image_parts))
+        bad_parts = find_corrupt_bundle_parts(manifest.image_parts)
+        for part, problem in bad_parts:
+            self.log.error("bundle part '%s' appears to be corrupt: %s",
+                           part.filename, problem)
+        if bad_parts:
+            raise RuntimeError(
+                '{0} of {1} bundle part(s) appear to be corrupt: {2}'
+                .format(len(bad_parts), len(manifest.image_parts),
+                        ', '.join(part.filename for part, _ in bad_parts)))
+        if self.args.get('verify_image'):
+            self.log.info('checking the unbundled image')
+            pipeline_stats = self.get_pipeline_stats()
+            part_reader_out_r = self.__open_bundle_part_reader(manifest)
+            with open(os.devnull, 'w') as devnull:
+                unbundlestream = UnbundleStream.from_other(
+                    self, source=part_reader_out_r, dest=devnull,
+                    enc_key=manifest.enc_key, enc_iv=manifest.enc_iv,
+                    image_size=manifest.image_size,
+                    sha1_digest=manifest.image_digest,
+                    show_progress=self.args.get('show_progress', False),
+                    in_process=self.args.get('in_process'),
+                    pipeline_stats=pipeline_stats)
+                unbundlestream.main()
+
+    def __open_bundle_part_reader(self, manifest):
+        part_reader_out_r, part_reader_out_w = open_pipe_fileobjs()
+        pipeline_stats = self.args.get('pipeline_stats')
+        part_reader = multiprocessing.Process(
+            target=self.__read_bundle_parts,
+            args=(manifest, part_reader_out_w),
+            kwargs={'pipeline_stats': pipeline_stats})
+        part_reader.start()
+        part_reader_out_w.close()
+        if pipeline_stats is not None:
+            pipeline_stats.watch_process('part-reader', part_reader.pid)
+        else:
+            waitpid_in_thread(part_reader.pid)
+        return part_reader_out_r
+
     def print_result(self, image_filename):
-        print 'Wrote', image_filename
-    # pylint: enable=no-self-use
+        if image_filename:
+            print 'Wrote', image_filename
+        elif self.args.get('verify_image'):
+            print 'Bundle and image are intact'
+        else:
+            print 'Bundle is intact'
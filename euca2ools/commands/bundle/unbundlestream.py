@@ -28,19 +28,22 @@ import sys
 
 from requestbuilder import Arg
 from requestbuilder.command import BaseCommand
+from requestbuilder.exceptions import ArgumentError
 from requestbuilder.mixins import (FileTransferProgressBarMixin,
                                    RegionConfigurableMixin)
 import six
 
 from euca2ools.bundle.pipes.core import (create_unbundle_pipeline,
                                          copy_with_progressbar)
-from euca2ools.bundle.util import open_pipe_fileobjs
+from euca2ools.bundle.util import ImageFileWriter, open_pipe_fileobjs
 from euca2ools.commands import Euca2ools
 from euca2ools.commands.argtypes import filesize
+from euca2ools.commands.bundle.mixins import PipelineStatsMixin
+import euca2ools.crypto
 
 
 class UnbundleStream(BaseCommand, FileTransferProgressBarMixin,
-                     RegionConfigurableMixin):
+                     PipelineStatsMixin, RegionConfigurableMixin):
     DESCRIPTION = ('Recreate an image solely from its combined bundled parts '
                    'without using a manifest\n\nUsually one would want to use '
                    'euca-unbundle instead.')
@@ -57,13 +60,30 @@ class UnbundleStream(BaseCommand, FileTransferProgressBarMixin,
             Arg('--image-size', metavar='BYTES', type=filesize,
                 help='verify the unbundled image is a certain size'),
             Arg('--sha1-digest', metavar='HEX', help='''verify the image's
-                contents against a SHA1 digest from its manifest file''')]
+                contents against a SHA1 digest from its manifest file'''),
+            Arg('--in-process', action='store_true', help='''do all of the
+                unbundling work in a single process instead of a chain of
+                external programs (requires the python cryptography
+                library)'''),
+            Arg('--sparse', action='store_true', help='''do not write
+                blocks of the image that contain only zeroes.  Regular
+                files get holes there instead.  Block devices are assumed
+                to already contain zeroes (e.g. they were just
+                discarded).'''),
+            Arg('--drop-cache', action='store_true', help='''preallocate
+                the image when possible and keep what is written from
+                lingering in the page cache, at some cost in speed''')]
 
     # noinspection PyExceptionInherit
     def configure(self):
         BaseCommand.configure(self)
         self.update_config_view()
 
+        if (self.args.get('in_process') and
+                not euca2ools.crypto.HAVE_CRYPTOGRAPHY):
+            raise ArgumentError('argument --in-process: the python '
+                                'cryptography library is not installed')
+
         if not self.args.get('source') or self.args['source'] == '-':
             # We dup stdin because the multiprocessing lib closes it
             self.args['source'] = os.fdopen(os.dup(sys.stdin.fileno()))
@@ -80,15 +100,33 @@ class UnbundleStream(BaseCommand, FileTransferProgressBarMixin,
 
     def main(self):
         pbar = self.get_progressbar(maxval=self.args.get('image_size'))
+        pipeline_stats = self.get_pipeline_stats()
         unbundle_out_r, unbundle_out_w = open_pipe_fileobjs()
         unbundle_sha1_r = create_unbundle_pipeline(
             self.args['source'], unbundle_out_w, self.args['enc_key'],
-            self.args['enc_iv'], debug=self.debug)
+            self.args['enc_iv'], debug=self.debug,
+            in_process=self.args.get('in_process'),
+            pipeline_stats=pipeline_stats)
         unbundle_out_w.close()
-        actual_size = copy_with_progressbar(unbundle_out_r, self.args['dest'],
-                                            progressbar=pbar)
+        if pipeline_stats is not None:
+            write_stats = pipeline_stats.add_stage('write')
+        else:
+            write_stats = None
+        if self.args.get('sparse') or self.args.get('drop_cache'):
+            dest = ImageFileWriter(
+                self.args['dest'], sparse=self.args.get('sparse'),
+                drop_cache=self.args.get('drop_cache'),
+                size=self.args.get('image_size'))
+        else:
+            dest = self.args['dest']
+        actual_size = copy_with_progressbar(unbundle_out_r, dest,
+                                            progressbar=pbar,
+                                            stats=write_stats)
+        if isinstance(dest, ImageFileWriter):
+            dest.finish()
         actual_sha1 = int(unbundle_sha1_r.recv(), 16)
         unbundle_sha1_r.close()
+        self.print_pipeline_stats()
 
         expected_sha1 = int(self.args.get('sha1_digest') or '0', 16)
         expected_size = self.args.get('image_size')
@@ -31,13 +31,14 @@ from requestbuilder import Arg
 from requestbuilder.mixins import FileTransferProgressBarMixin
 
 from euca2ools.bundle.manifest import BundleManifest
-from euca2ools.commands.bundle.mixins import BundleUploadingMixin
+from euca2ools.commands.bundle.mixins import (BundleUploadingMixin,
+                                              PipelineStatsMixin)
 from euca2ools.commands.s3 import S3Request
 from euca2ools.commands.s3.putobject import PutObject
 
 
 class UploadBundle(S3Request, BundleUploadingMixin,
-                   FileTransferProgressBarMixin):
+                   FileTransferProgressBarMixin, PipelineStatsMixin):
     DESCRIPTION = 'Upload a bundle prepared by euca-bundle-image to the cloud'
     ARGS = [Arg('-m', '--manifest', metavar='FILE', required=True,
                 help='manifest for the bundle to upload (required)'),
@@ -69,6 +70,12 @@ class UploadBundle(S3Request, BundleUploadingMixin,
             if not os.path.isfile(part.filename):
                 raise ValueError("no such part: '{0}'".format(part.filename))
 
+        pipeline_stats = self.get_pipeline_stats()
+        if pipeline_stats is not None:
+            upload_stats = pipeline_stats.add_stage('upload')
+        else:
+            upload_stats = None
+
         # manifest -> upload
         part_out_r, part_out_w = multiprocessing.Pipe(duplex=False)
         part_gen = multiprocessing.Process(target=_generate_bundle_parts,
@@ -77,9 +84,10 @@ class UploadBundle(S3Request, BundleUploadingMixin,
         part_out_w.close()
 
         # Drive the upload process by feeding in part info
-        self.upload_bundle_parts(part_out_r, key_prefix,
+        self.upload_bundle_parts(part_out_r, key_prefix, stats=upload_stats,
                                  show_progress=self.args.get('show_progress'))
         part_gen.join()
+        self.print_pipeline_stats()
 
         # (conditionally) upload the manifest
         if not self.args.get('skipmanifest'):
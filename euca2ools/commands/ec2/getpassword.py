@@ -24,9 +24,12 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import base64
-from euca2ools.commands.ec2.getpassworddata import GetPasswordData
+
 from requestbuilder import Arg
-import subprocess
+import six
+
+from euca2ools.commands.ec2.getpassworddata import GetPasswordData
+import euca2ools.crypto
 
 
 class GetPassword(GetPasswordData):
@@ -44,8 +47,18 @@ class GetPassword(GetPasswordData):
         except AttributeError:
             # The reply didn't contain a passwordData element.
             raise AttributeError('no password data found for this instance')
-        cmd = subprocess.Popen(['openssl', 'rsautl', '-decrypt', '-inkey',
-                                self.args['priv_launch_key']],
-                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        stdout, _ = cmd.communicate(base64.b64decode(pwdata))
-        print stdout
+        if not pwdata:
+            # Instances take a while to make their passwords available
+            raise ValueError('no password data found for this instance')
+        try:
+            password = euca2ools.crypto.rsa_private_decrypt(
+                base64.b64decode(pwdata), self.args['priv_launch_key'])
+            # With the wrong key, newer versions of the cryptography
+            # library return random bytes instead of failing, but the
+            # password is always plain ASCII.
+            password = password.decode('ascii')
+        except ValueError as err:
+            six.raise_from(ValueError(
+                'failed to decrypt the password with private key {0}'
+                .format(self.args['priv_launch_key'])), err)
+        print password
@@ -74,6 +74,9 @@ class ImportInstance(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
             Arg('--no-upload', action='store_true', route_to=None,
                 help='''start the import process, but do not actually upload
                 the volume (see euca-resume-import)'''),
+            Arg('--user-threads', metavar='N', type=int, default=1,
+                route_to=None, help='''number of parts to upload at the
+                same time (default: 1)'''),
             Arg('-d', '--description', dest='Description',
                 help='a description for the import task (not the volume)'),
             Arg('-g', '--group', metavar='GROUP',
@@ -185,6 +188,7 @@ class ImportInstance(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
                 task=result['conversionTask']['conversionTaskId'],
                 s3_service=self.args['s3_service'],
                 s3_auth=self.args['s3_auth'], expires=self.args['expires'],
+                user_threads=self.args.get('user_threads'),
                 show_progress=self.args.get('show_progress', False))
             resume.main()
 
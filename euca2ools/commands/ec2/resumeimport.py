@@ -25,7 +25,10 @@
 
 import argparse
 import os.path
+import sys
 import tempfile
+import threading
+import time
 
 from requestbuilder import Arg
 from requestbuilder.exceptions import ArgumentError, ServerError
@@ -40,6 +43,7 @@ from euca2ools.commands.ec2.structures import ImportManifest, ImportImagePart
 from euca2ools.commands.s3.deleteobject import DeleteObject
 from euca2ools.commands.s3.headobject import HeadObject
 from euca2ools.commands.s3.getobject import GetObject
+from euca2ools.commands.s3.listbucket import ListBucket
 from euca2ools.commands.s3.putobject import PutObject
 from euca2ools.exceptions import AWSError
 import euca2ools.util
@@ -54,11 +58,14 @@ class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
             Arg('-x', '--expires', metavar='DAYS', type=int, default=30,
                 help='''how long the import manifest should remain valid, in
                 days (default: 30 days)'''),
-            # This is documented, but not implemented in ec2-resume-import
-            Arg('--part-size', metavar='MiB', type=int, default=10,
+            # This is documented, but not implemented in ec2-resume-import.
+            # When it is absent the part size is chosen automatically.
+            Arg('--part-size', metavar='MiB', type=int,
                 help=argparse.SUPPRESS),
-            # These are not implemented
-            Arg('--user-threads', type=int, help=argparse.SUPPRESS),
+            Arg('--user-threads', metavar='N', type=int, default=1,
+                help='''number of parts to upload at the same time
+                (default: 1)'''),
+            # This is not implemented
             Arg('--dont-verify-format', action='store_true',
                 help=argparse.SUPPRESS),
             # This does no validation, but it does prevent taking action
@@ -72,6 +79,9 @@ class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
         if self.args['expires'] < 1:
             raise ArgumentError(
                 'argument -x/--expires: value must be positive')
+        if (self.args.get('user_threads') or 1) < 1:
+            raise ArgumentError(
+                'argument --user-threads: value must be positive')
 
     def main(self):
         if self.args.get('dry_run'):
@@ -103,26 +113,125 @@ class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
         # Now we have a manifest; check to see what parts are already uploaded
         _, bucket, _ = self.args['s3_service'].resolve_url_to_location(
             vol_container['image']['importManifestUrl'])
-        pbar_label_template = euca2ools.util.build_progressbar_label_template(
-            [os.path.basename(part.key) for part in manifest.image_parts])
-        for part in manifest.image_parts:
-            part_s3path = '/'.join((bucket, part.key))
-            head_req = HeadObject.from_other(
-                self, service=self.args['s3_service'],
-                auth=self.args['s3_auth'], path=part_s3path)
+        parts = [(part, '/'.join((bucket, part.key)))
+                 for part in manifest.image_parts]
+        uploaded = self.__list_uploaded_parts(bucket, parts)
+        user_threads = self.args.get('user_threads') or 1
+        # Every part is read from the same descriptor, so nothing has to
+        # reopen the file or seek around in it for each part.
+        with euca2ools.util.SharedFileDescriptor(
+                self.args['source']) as source:
+            if user_threads > 1:
+                self.__upload_parts_in_threads(source, parts, uploaded,
+                                               user_threads, file_size)
+            else:
+                pbar_label_template = \
+                    euca2ools.util.build_progressbar_label_template(
+                        [os.path.basename(part.key) for part, _path in parts])
+                for part, part_s3path in parts:
+                    # If it is already there we skip it
+                    if not self.__is_part_uploaded(part, part_s3path,
+                                                   uploaded):
+                        self.__upload_part(
+                            source, part, part_s3path,
+                            pbar_label=pbar_label_template.format(
+                                fname=os.path.basename(part.key),
+                                index=(part.index + 1)),
+                            show_progress=self.args.get('show_progress',
+                                                        False))
+
+    def __upload_parts_in_threads(self, source, parts, uploaded, num_threads,
+                                  file_size):
+        # Several progress bars at once would just garble the terminal, so
+        # there is only one for the whole file.  Parts that are already
+        # there count as done as soon as we find that out.
+        skipped = [0]
+        skipped_lock = threading.Lock()
+
+        def upload_part(part_and_s3path):
+            part, part_s3path = part_and_s3path
+            if self.__is_part_uploaded(part, part_s3path, uploaded):
+                with skipped_lock:
+                    skipped[0] += part.end - part.start + 1
+            else:
+                self.__upload_part(source, part, part_s3path)
+
+        errors = []
+
+        def upload_all_parts():
             try:
-                head_req.main()
-            except AWSError as err:
-                if err.status_code == 404:
-                    self.__upload_part(part, part_s3path, pbar_label_template)
-                else:
-                    raise
-            # If it is already there we skip it
+                for _ in euca2ools.util.imap_in_threads(upload_part, parts,
+                                                        num_threads):
+                    pass
+            except Exception:
+                errors.append(sys.exc_info())
+
+        # The main thread has to drive the progress bar.
+        upload_thread = threading.Thread(target=upload_all_parts)
+        # Daemonic so ^C kills the program cleanly
+        upload_thread.daemon = True
+        upload_thread.start()
+        pbar = self.get_progressbar(
+            label=os.path.basename(self.args['source']), maxval=file_size)
+        pbar.start()
+        while upload_thread.is_alive():
+            with skipped_lock:
+                pbar.update(min(source.bytes_read + skipped[0], file_size))
+            upload_thread.join(0.05)
+        pbar.finish()
+        if errors:
+            six.reraise(*errors[0])
+
+    def __list_uploaded_parts(self, bucket, parts):
+        # One listing of everything under the parts' common prefix tells
+        # us about all of them at once, which is a lot faster than asking
+        # about each one.  Returns a dict that maps keys to their sizes
+        # and ETags, or None if we may not list the bucket.
+        prefix = os.path.commonprefix([part.key for part, _ in parts])
+        list_req = ListBucket.from_other(
+            self, service=self.args['s3_service'],
+            auth=self.args['s3_auth'], paths=['/'.join((bucket, prefix))])
+        uploaded = {}
+        try:
+            for obj in list_req.main()['Contents']:
+                uploaded[obj['Key']] = {
+                    'size': int(obj.get('Size') or 0),
+                    'etag': (obj.get('ETag') or '').lower().strip('"')}
+        except AWSError as err:
+            if err.status_code == 403:
+                self.log.info('not allowed to list bucket %s; checking '
+                              'parts one at a time', bucket)
+                return None
+            raise
+        self.log.debug('found %i objects under %s/%s', len(uploaded),
+                       bucket, prefix)
+        return uploaded
+
+    def __is_part_uploaded(self, part, part_s3path, uploaded=None):
+        # uploaded is what __list_uploaded_parts returned.  We fall back
+        # to asking about the part by itself only when that is None.
+        if uploaded is not None:
+            obj = uploaded.get(part.key)
+            return (obj is not None and
+                    obj['size'] == part.end - part.start + 1)
+        head_req = HeadObject.from_other(
+            self, service=self.args['s3_service'],
+            auth=self.args['s3_auth'], path=part_s3path)
+        try:
+            head_req.main()
+        except AWSError as err:
+            if err.status_code == 404:
+                return False
+            raise
+        return True
 
     def __get_or_create_manifest(self, vol_container, file_size):
         _, bucket, key = self.args['s3_service'].resolve_url_to_location(
             vol_container['image']['importManifestUrl'])
         manifest_s3path = '/'.join((bucket, key))
+        # Looking for the manifest takes about one round trip to the
+        # server, which helps decide how large parts should be.
+        get_start = time.time()
         try:
             with tempfile.SpooledTemporaryFile(max_size=1024000) as \
                     manifest_destfile:
@@ -138,7 +247,8 @@ class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
         except ServerError as err:
             if err.status_code == 404:
                 self.log.info('creating new import manifest')
-                manifest = self.__generate_manifest(vol_container, file_size)
+                manifest = self.__generate_manifest(
+                    vol_container, file_size, rtt=(time.time() - get_start))
                 tempdir = tempfile.mkdtemp()
                 manifest_filename = os.path.join(tempdir,
                                                  os.path.basename(key))
@@ -154,7 +264,7 @@ class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
                 raise
         return manifest
 
-    def __generate_manifest(self, vol_container, file_size):
+    def __generate_manifest(self, vol_container, file_size, rtt=None):
         days = self.args.get('expires') or 30
         timeout = days * 86400  # in seconds
         _, bucket, key = self.args['s3_service'].resolve_url_to_location(
@@ -168,7 +278,13 @@ class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
         manifest.self_destruct_url = delete_req.get_presigned_url2(timeout)
         manifest.image_size = int(vol_container['image']['size'])
         manifest.volume_size = int(vol_container['volume']['size'])
-        part_size = (self.args.get('part_size') or 10) * 2 ** 20  # MiB
+        # The manifest records where each part starts and ends, so this
+        # only needs to be decided once per import.
+        if self.args.get('part_size'):
+            part_size = self.args['part_size'] * 2 ** 20  # MiB
+        else:
+            part_size = euca2ools.util.choose_part_size(file_size, rtt=rtt)
+        self.log.info('using a part size of %i bytes', part_size)
         for index, part_start in enumerate(six.moves.range(0, file_size,
                                                            part_size)):
             part = ImportImagePart()
@@ -187,17 +303,15 @@ class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
             manifest.image_parts.append(part)
         return manifest
 
-    def __upload_part(self, part, part_s3path, pbar_label_template):
+    def __upload_part(self, source, part, part_s3path, pbar_label=None,
+                      show_progress=False):
         self.log.info('Uploading part %s (bytes %i-%i)', part_s3path,
                       part.start, part.end)
-        part_pbar_label = pbar_label_template.format(
-            fname=os.path.basename(part.key), index=(part.index + 1))
-        with open(self.args['source']) as source:
-            source.seek(part.start)
+        size = part.end - part.start + 1
+        with source.open_range(part.start, size) as part_source:
             put_req = PutObject.from_other(
                 self, service=self.args['s3_service'],
-                auth=self.args['s3_auth'], source=source, dest=part_s3path,
-                size=(part.end - part.start + 1),
-                show_progress=self.args.get('show_progress', False),
-                progressbar_label=part_pbar_label)
+                auth=self.args['s3_auth'], source=part_source,
+                dest=part_s3path, size=size, show_progress=show_progress,
+                progressbar_label=pbar_label)
             return put_req.main()
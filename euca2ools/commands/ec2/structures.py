@@ -23,12 +23,15 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import functools
+import io
 import logging
 
 import lxml.etree
 import lxml.objectify
 
 import euca2ools
+import euca2ools.util
 
 
 class ImportManifest(object):
@@ -44,35 +47,52 @@ class ImportManifest(object):
 
     @classmethod
     def read_from_file(cls, manifest_filename):
-        with open(manifest_filename) as manifest_fileobj:
+        with open(manifest_filename, 'rb') as manifest_fileobj:
             return cls.read_from_fileobj(manifest_fileobj)
 
     @classmethod
     def read_from_fileobj(cls, manifest_fileobj):
-        xml = lxml.objectify.parse(manifest_fileobj).getroot()
+        # Parse this as a stream so big imports with lots of parts do not
+        # need the whole tree in memory.
         manifest = cls()
-
-        manifest.file_format = xml['file-format'].text
-        manifest.self_destruct_url = xml['self-destruct-url'].text
-        manifest.image_size = int(xml['import'].size)
-        manifest.volume_size = int(xml['import']['volume-size'])
-        manifest.image_parts = [None] * int(xml['import']['parts']
-                                            .get('count'))
-        for part in xml['import']['parts']['part']:
-            part_index = int(part.get('index'))
-            part_obj = ImportImagePart()
-            part_obj.index = part_index
-            part_obj.start = int(part['byte-range'].get('start'))
-            part_obj.end = int(part['byte-range'].get('end'))
-            part_obj.key = part['key'].text
-            part_obj.head_url = part['head-url'].text
-            part_obj.get_url = part['get-url'].text
-            part_obj.delete_url = part['delete-url'].text
-            manifest.image_parts[part_index] = part_obj
+        part_obj = None
+        for event, path, elem in euca2ools.util.iterparse_with_paths(
+                manifest_fileobj, events=('start', 'end')):
+            path = path[1:]  # Everything is inside <manifest>
+            if event == 'start':
+                if path == ('import', 'parts'):
+                    manifest.image_parts = [None] * int(elem.get('count'))
+                elif path == ('import', 'parts', 'part'):
+                    part_obj = ImportImagePart()
+                    part_obj.index = int(elem.get('index'))
+                continue
+            if path == ('file-format',):
+                manifest.file_format = elem.text
+            elif path == ('self-destruct-url',):
+                manifest.self_destruct_url = elem.text
+            elif path == ('import', 'size'):
+                manifest.image_size = int(elem.text)
+            elif path == ('import', 'volume-size'):
+                manifest.volume_size = int(elem.text)
+            elif path == ('import', 'parts', 'part'):
+                manifest.image_parts[part_obj.index] = part_obj
+            elif path == ('import', 'parts', 'part', 'byte-range'):
+                part_obj.start = int(elem.get('start'))
+                part_obj.end = int(elem.get('end'))
+            elif path[:3] == ('import', 'parts', 'part') and len(path) == 4:
+                if path[3] in _PART_FIELDS:
+                    setattr(part_obj, _PART_FIELDS[path[3]], elem.text)
         assert None not in manifest.image_parts, 'part missing from manifest'
         return manifest
 
     def dump_to_str(self, pretty_print=False):
+        fileobj = io.BytesIO()
+        self.dump_to_fileobj(fileobj, pretty_print=pretty_print)
+        return fileobj.getvalue().strip()
+
+    def dump_to_fileobj(self, fileobj, pretty_print=False):
+        # Everything but the parts is small, so build that the usual way
+        # and then write the parts out one at a time.
         xml = lxml.objectify.Element('manifest')
 
         # Manifest version
@@ -92,27 +112,41 @@ class ImportManifest(object):
         xml['import'] = None
         xml['import']['size'] = self.image_size
         xml['import']['volume-size'] = self.volume_size
-        xml['import']['parts'] = None
-        xml['import']['parts'].set('count', str(len(self.image_parts)))
-        for part in self.image_parts:
-            xml['import']['parts'].append(part.dump_to_xml())
 
         # Cleanup
         lxml.objectify.deannotate(xml, xsi_nil=True)
         lxml.etree.cleanup_namespaces(xml)
-        self.log.debug('-- manifest content --\n', extra={'append': True})
-        pretty_manifest = lxml.etree.tostring(xml, pretty_print=True).strip()
-        self.log.debug('%s', pretty_manifest, extra={'append': True})
-        self.log.debug('-- end of manifest content --')
-        return lxml.etree.tostring(xml, pretty_print=pretty_print,
-                                   encoding='UTF-8', standalone=True,
-                                   xml_declaration=True).strip()
 
-    def dump_to_fileobj(self, fileobj, pretty_print=False):
-        fileobj.write(self.dump_to_str(pretty_print=pretty_print))
+        write = functools.partial(euca2ools.util.write_xml_element,
+                                  pretty_print=pretty_print)
+        with lxml.etree.xmlfile(fileobj, encoding='UTF-8') as xmlfile:
+            xmlfile.write_declaration(standalone=True)
+            with xmlfile.element('manifest'):
+                for elem in xml.iterchildren():
+                    if elem.tag != 'import':
+                        write(xmlfile, elem)
+                euca2ools.util.write_xml_indent(xmlfile, 1, pretty_print)
+                with xmlfile.element('import'):
+                    for elem in xml['import'].iterchildren():
+                        write(xmlfile, elem, level=2)
+                    euca2ools.util.write_xml_indent(xmlfile, 2, pretty_print)
+                    with xmlfile.element(
+                            'parts', count=str(len(self.image_parts))):
+                        for part in self.image_parts:
+                            write(xmlfile, part.dump_to_xml(), level=3)
+                        euca2ools.util.write_xml_indent(xmlfile, 2,
+                                                        pretty_print)
+                    euca2ools.util.write_xml_indent(xmlfile, 1, pretty_print)
+                euca2ools.util.write_xml_indent(xmlfile, 0, pretty_print)
+        self.log.debug('wrote import manifest with %i parts',
+                       len(self.image_parts))
 
 
 class ImportImagePart(object):
+    # Imports can have tens of thousands of parts, so skip the __dict__
+    __slots__ = ('index', 'start', 'end', 'key', 'head_url', 'get_url',
+                 'delete_url')
+
     def __init__(self):
         self.index = None
         self.start = None
@@ -132,3 +166,7 @@ class ImportImagePart(object):
         xml['get-url'] = self.get_url
         xml['delete-url'] = self.delete_url
         return xml
+
+
+_PART_FIELDS = {'key': 'key', 'head-url': 'head_url', 'get-url': 'get_url',
+                'delete-url': 'delete_url'}
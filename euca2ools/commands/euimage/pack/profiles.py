@@ -127,7 +127,7 @@ class InstanceStoreImageProfile(object):
             prefix=image_md.get_nvra(),
             image_type='machine',  # We only support machine images for now
             image_size=image_size, show_progress=args.get('show_progress'),
-            max_pending_parts=2, part_size=10485760, **bundle_args)
+            max_pending_parts=2, **bundle_args)
         try:
             bundle_info = req.main()
         except KeyError as err:
@@ -26,6 +26,7 @@
 import os
 import string
 import sys
+import threading
 import urlparse
 
 from requestbuilder import Arg
@@ -40,6 +41,14 @@ from euca2ools.commands import Euca2ools
 from euca2ools.exceptions import AWSError
 
 
+# Keep-alive connections kept open to each host, which should be at least
+# as many as the most transfers a command runs at once.  This can be
+# changed with the s3-connection-pool-size region option.
+_DEFAULT_CONNECTION_POOL_SIZE = 32
+_SHARED_SESSIONS = {}
+_SHARED_SESSIONS_LOCK = threading.Lock()
+
+
 class S3(requestbuilder.service.BaseService):
     NAME = 's3'
     DESCRIPTION = 'Object storage service'
@@ -49,6 +58,45 @@ class S3(requestbuilder.service.BaseService):
     ARGS = [Arg('-U', '--url', metavar='URL',
                 help='object storage service endpoint URL')]
 
+    @property
+    def session(self):
+        # Requests made from one another already share a service, but
+        # commands also make services from one another.  Sharing one
+        # session, and thus one connection pool, among all of them for
+        # each endpoint lets every part of a bundle or import reuse a
+        # connection instead of paying for new TCP and TLS handshakes.
+        # Forked processes get sessions of their own, since they must not
+        # share sockets with their parents.
+        if self._session is None:
+            key = (os.getpid(), self.endpoint,
+                   repr(sorted(self.session_args.items())))
+            with _SHARED_SESSIONS_LOCK:
+                if key not in _SHARED_SESSIONS:
+                    session = requestbuilder.service.BaseService.session.fget(
+                        self)
+                    # send_request handles retries to allow for re-signing
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_maxsize=self.__get_connection_pool_size(),
+                        max_retries=0)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    _SHARED_SESSIONS[key] = session
+                self._session = _SHARED_SESSIONS[key]
+        return self._session
+
+    def __get_connection_pool_size(self):
+        pool_size = self.config.get_region_option('s3-connection-pool-size')
+        if pool_size is None:
+            return _DEFAULT_CONNECTION_POOL_SIZE
+        try:
+            pool_size = int(pool_size)
+            if pool_size < 1:
+                raise ValueError
+        except ValueError:
+            raise ValueError('s3-connection-pool-size must be a positive '
+                             'integer, not {0}'.format(pool_size))
+        return pool_size
+
     # pylint: disable=no-self-use
     def handle_http_error(self, response):
         raise AWSError(response)
@@ -111,6 +159,44 @@ class S3(requestbuilder.service.BaseService):
         return bucket, key
 
 
+class S3HmacV1Auth(requestbuilder.auth.aws.HmacV1Auth):
+    """
+    requestbuilder's HmacV1Auth signs sub-resources that have no value,
+    such as "uploads", as "uploads=" rather than just "uploads" the way
+    S3 expects, repeats the sub-resources when there is more than one
+    query parameter, and does not know that "delete" is a sub-resource
+    at all.  Requests that use sub-resources need this instead.
+    """
+
+    HASHED_PARAMS = (requestbuilder.auth.aws.HmacV1Auth.HASHED_PARAMS |
+                     set(('delete',)))
+
+    def get_canonicalized_resource(self, req, service):
+        resource = super(S3HmacV1Auth, self).get_canonicalized_resource(
+            req, service)
+        # Keep the path and build the sub-resources ourselves
+        resource = resource.split('?', 1)[0]
+        if getattr(req, 'params', None):
+            # A regular Request
+            params = req.params
+        else:
+            # A PreparedRequest
+            params = dict(six.moves.urllib.parse.parse_qsl(
+                six.moves.urllib.parse.urlparse(req.url).query,
+                keep_blank_values=True))
+        subresources = []
+        for key, val in sorted(six.iteritems(params)):
+            if key in self.HASHED_PARAMS:
+                if val is None or val == '':
+                    subresources.append(key)
+                else:
+                    subresources.append(key + '=' + val)
+        if subresources:
+            resource += '?' + '&'.join(subresources)
+        self.log.debug('canonicalized resource: %s', repr(resource))
+        return resource
+
+
 class S3Request(requestbuilder.request.BaseRequest):
     SUITE = Euca2ools
     SERVICE_CLASS = S3
@@ -130,10 +216,41 @@ class S3Request(requestbuilder.request.BaseRequest):
             auth.configure()
             self.auth = auth
 
+    def configure_s3_hmacv1_auth(self):
+        """
+        Switch to S3HmacV1Auth if this request would otherwise use plain
+        HmacV1Auth.  Requests that use sub-resources must call this from
+        configure.
+        """
+        if type(self.auth) is requestbuilder.auth.aws.HmacV1Auth:
+            # pylint: disable=access-member-before-definition
+            auth = S3HmacV1Auth.from_other(self.auth)
+            # pylint: enable=access-member-before-definition
+            auth.configure()
+            self.auth = auth
+
     def __should_use_sigv4(self):
         return self.config.convert_to_bool(
             self.config.get_region_option('s3-force-sigv4'))
 
+    def send(self):
+        result = requestbuilder.request.BaseRequest.send(self)
+        response = self.response
+        # Responses are streamed, so a connection goes back to its pool
+        # only once its response has been read to the end.  Most callers
+        # never read responses that have no content, which would leave
+        # the next request to open a new connection.
+        if response is not None and (
+                self.method.upper() == 'HEAD' or
+                response.status_code == 204 or
+                response.headers.get('Content-Length') == '0'):
+            try:
+                response.content
+            except RuntimeError:
+                # The content was already consumed
+                pass
+        return result
+
     def get_presigned_url2(self, timeout):
         """
         Get a pre-signed URL for this request that expires after a given
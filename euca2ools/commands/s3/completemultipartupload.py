@@ -0,0 +1,72 @@
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import xml.etree.ElementTree as ET
+
+from requestbuilder import Arg
+from requestbuilder.xmlparse import parse_aws_xml
+import six
+
+from euca2ools.commands.s3 import S3Request
+from euca2ools.exceptions import AWSError
+
+
+class CompleteMultipartUpload(S3Request):
+    DESCRIPTION = ('Finish a multipart upload by assembling its parts into '
+                   'an object')
+    ARGS = [Arg('path', metavar='BUCKET/KEY', route_to=None),
+            Arg('--upload-id', route_to=None, required=True),
+            # A list of (part number, ETag) pairs
+            Arg('--parts', route_to=None, required=True)]
+    METHOD = 'POST'
+
+    def configure(self):
+        S3Request.configure(self)
+        self.configure_s3_hmacv1_auth()
+
+    def preprocess(self):
+        self.path = self.args['path']
+        self.params['uploadId'] = self.args['upload_id']
+        complete = ET.Element('CompleteMultipartUpload')
+        for part_number, etag in sorted(self.args['parts']):
+            part = ET.SubElement(complete, 'Part')
+            ET.SubElement(part, 'PartNumber').text = str(part_number)
+            ET.SubElement(part, 'ETag').text = '"{0}"'.format(etag)
+        self.body = ET.tostring(complete)
+
+    def parse_response(self, response):
+        # This can fail after the server has already said 200 OK, in which
+        # case the error is in the response body.
+        response_dict = parse_aws_xml(io.StringIO(
+            six.text_type(response.text)))
+        if 'Error' in response_dict:
+            raise AWSError(response)
+        return response_dict['CompleteMultipartUploadResult']
+
+    # pylint: disable=no-self-use
+    def print_result(self, result):
+        print result.get('ETag')
+    # pylint: enable=no-self-use
@@ -0,0 +1,87 @@
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import base64
+import hashlib
+import io
+import xml.etree.ElementTree as ET
+
+from requestbuilder import Arg
+from requestbuilder.exceptions import ArgumentError
+from requestbuilder.xmlparse import parse_aws_xml
+import six
+
+from euca2ools.commands.s3 import S3Request
+from euca2ools.exceptions import AWSError
+
+
+# S3 deletes no more than this many objects per request
+DELETE_OBJECTS_MAX_KEYS = 1000
+
+
+class DeleteObjects(S3Request):
+    DESCRIPTION = 'Delete several objects from a bucket with one request'
+    ARGS = [Arg('bucket', metavar='BUCKET', route_to=None),
+            # The key names of the objects to delete
+            Arg('--keys', route_to=None, required=True)]
+    METHOD = 'POST'
+
+    # noinspection PyExceptionInherit
+    def configure(self):
+        S3Request.configure(self)
+        if len(self.args['keys']) > DELETE_OBJECTS_MAX_KEYS:
+            raise ArgumentError('cannot delete more than {0} objects at '
+                                'once'.format(DELETE_OBJECTS_MAX_KEYS))
+        self.configure_s3_hmacv1_auth()
+
+    def preprocess(self):
+        self.path = self.args['bucket']
+        self.params['delete'] = ''
+        delete = ET.Element('Delete')
+        # Only report objects that could not be deleted
+        ET.SubElement(delete, 'Quiet').text = 'true'
+        for key in self.args['keys']:
+            obj = ET.SubElement(delete, 'Object')
+            ET.SubElement(obj, 'Key').text = key
+        self.body = ET.tostring(delete)
+        # S3 requires this for multi-object deletes
+        self.headers['Content-MD5'] = base64.b64encode(
+            hashlib.md5(self.body).digest())
+
+    def parse_response(self, response):
+        response_dict = parse_aws_xml(
+            io.StringIO(six.text_type(response.text)),
+            list_item_tags=('Deleted', 'Error'))
+        if 'DeleteResult' not in response_dict:
+            raise AWSError(response)
+        return response_dict['DeleteResult'] or {}
+
+    def main(self):
+        """
+        Return a list of dicts with the Key, Code, and Message of each
+        object that could not be deleted.
+        """
+        self.preprocess()
+        return self.send().get('Error') or []
@@ -23,17 +23,34 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import hashlib
+import argparse
+import json
 import os.path
 import sys
+import threading
 
 from requestbuilder import Arg
+import requestbuilder.exceptions
 from requestbuilder.exceptions import ArgumentError
 from requestbuilder.mixins import FileTransferProgressBarMixin
+import requests.exceptions
 import six
 
+from euca2ools.commands.argtypes import filesize
 from euca2ools.commands.s3 import S3Request
 import euca2ools.bundle.pipes
+import euca2ools.bundle.util
+import euca2ools.util
+
+
+# Objects at least this large are downloaded as several ranges at once
+# unless told otherwise.
+RANGED_THRESHOLD = 256 * 2 ** 20  # 256 MiB
+_DEFAULT_DOWNLOAD_THREADS = 4
+# Ranges bound for destinations that we cannot write out of order are
+# kept in buffers that stay in memory up to this size and spill over to
+# disk beyond it.
+_RANGE_SPOOL_MAX_SIZE = 16 * 2 ** 20  # 16 MiB
 
 
 class GetObject(S3Request, FileTransferProgressBarMixin):
@@ -45,7 +62,28 @@ class GetObject(S3Request, FileTransferProgressBarMixin):
                 directory the object will be written to a file inside of that
                 directory.  If this is is "-" the object will be written to
                 stdout.  Otherwise it will be written to a file with the name
-                given.  (default:  current directory)''')]
+                given.  (default:  current directory)'''),
+            Arg('--resume', action='store_true', route_to=None,
+                help='''continue an interrupted download of a large object
+                to a file, fetching only the ranges that did not finish'''),
+            Arg('--retry', dest='retries', action='store_const', const=5,
+                default=0, route_to=None, help='''retry each interrupted
+                range of a large object up to 5 times'''),
+            Arg('--range-threshold', metavar='BYTES', type=filesize,
+                route_to=None, help='''download objects at least this
+                large as several ranges at once.  Use 0 to always download
+                objects whole.  (default: 256M)'''),
+            Arg('--range-size', metavar='BYTES', type=filesize,
+                route_to=None, help='''size of each range of a large
+                object (default: chosen based on the object's size)'''),
+            Arg('--download-threads', metavar='N', type=int, route_to=None,
+                help='''number of ranges of a large object to download at
+                the same time (default: 4)'''),
+            # The first and last byte of the object to download, which is
+            # how we fetch each range of a large object
+            Arg('--byte-range', route_to=None, help=argparse.SUPPRESS),
+            # Only download the object if it has this ETag
+            Arg('--if-match', route_to=None, help=argparse.SUPPRESS)]
 
     def configure(self):
         S3Request.configure(self)
@@ -56,31 +94,63 @@ class GetObject(S3Request, FileTransferProgressBarMixin):
         if not key:
             raise ArgumentError('source must contain a key name')
 
+        # Only a file we opened ourselves is ours to write anywhere in.
+        # Anything else just gets written to from where it is now.
+        self.__dest_path = None
         if isinstance(self.args.get('dest'), six.string_types):
             # If it is not a string we assume it is a file-like object
             if self.args['dest'] == '-':
                 self.args['dest'] = sys.stdout
-            elif os.path.isdir(self.args['dest']):
-                basename = os.path.basename(key)
-                if not basename:
-                    raise ArgumentError("specify a complete file path with -o "
-                                        "to download objects that end in '/'")
-                dest_path = os.path.join(self.args['dest'], basename)
-                self.args['dest'] = open(dest_path, 'w')
             else:
-                self.args['dest'] = open(self.args['dest'], 'w')
+                if os.path.isdir(self.args['dest']):
+                    basename = os.path.basename(key)
+                    if not basename:
+                        raise ArgumentError(
+                            "specify a complete file path with -o to "
+                            "download objects that end in '/'")
+                    dest_path = os.path.join(self.args['dest'], basename)
+                else:
+                    dest_path = self.args['dest']
+                self.args['dest'] = _open_dest(dest_path,
+                                               self.args.get('resume'))
+                self.__dest_path = dest_path
+
+        if (self.args.get('range_size') is not None and
+                self.args['range_size'] < 1):
+            raise ArgumentError(
+                'argument --range-size: value must be positive')
+        if (self.args.get('download_threads') or 1) < 1:
+            raise ArgumentError(
+                'argument --download-threads: value must be positive')
 
     def preprocess(self):
         self.path = self.args['source']
+        if self.args.get('byte_range'):
+            self.headers['Range'] = 'bytes={0}-{1}'.format(
+                *self.args['byte_range'])
+        if self.args.get('if_match'):
+            self.headers['If-Match'] = self.args['if_match']
 
     def main(self):
         # Note that this method does not close self.args['dest']
         self.preprocess()
         bytes_written = 0
-        md5_digest = hashlib.md5()
-        sha_digest = hashlib.sha1()
+        digest = euca2ools.util.MultiDigest('md5', 'sha1')
         response = self.send()
         content_length = response.headers.get('Content-Length')
+        etag = response.headers.get('ETag', '').lower().strip('"')
+        if self.args.get('byte_range') and response.status_code != 206:
+            # We would get the whole object instead of part of it
+            raise RuntimeError('server ignored the requested byte range')
+        if content_length and not self.args.get('byte_range'):
+            threshold = self.args.get('range_threshold')
+            if threshold is None:
+                threshold = RANGED_THRESHOLD
+            if threshold and int(content_length) >= threshold:
+                # Hanging up now costs us little more than the headers
+                # since responses are streamed.
+                response.close()
+                return self.__download_ranges(int(content_length), etag)
         if content_length:
             pbar = self.get_progressbar(label=self.args['source'],
                                         maxval=int(content_length))
@@ -90,11 +160,15 @@ class GetObject(S3Request, FileTransferProgressBarMixin):
         for chunk in response.iter_content(chunk_size=euca2ools.BUFSIZE):
             self.args['dest'].write(chunk)
             bytes_written += len(chunk)
-            md5_digest.update(chunk)
-            sha_digest.update(chunk)
+            digest.update(chunk)
             if pbar is not None:
                 pbar.update(bytes_written)
         self.args['dest'].flush()
+        if (self.args.get('resume') and not self.args.get('byte_range') and
+                self.__dest_path is not None):
+            # A file being resumed was opened without truncating it, and
+            # it may be longer than this object, so drop the rest.
+            self.args['dest'].truncate(bytes_written)
         pbar.finish()
 
         # Integrity checks
@@ -105,18 +179,286 @@ class GetObject(S3Request, FileTransferProgressBarMixin):
             raise RuntimeError('downloaded file appears to be corrupt '
                                '(expected size: {0}, actual: {1})'
                                .format(content_length, bytes_written))
-        etag = response.headers.get('ETag', '').lower().strip('"')
+        if not self.args.get('byte_range'):
+            # The ETag describes the whole object, not a range of it
+            self.__check_etag(etag, digest.hexdigest('md5'))
+
+        return {self.args['source']: {'md5': digest.hexdigest('md5'),
+                                      'sha1': digest.hexdigest('sha1'),
+                                      'size': bytes_written}}
+
+    def __check_etag(self, etag, md5):
         if (len(etag) == 32 and
                 all(char in '0123456789abcdef' for char in etag)):
             # It looks like an MD5 hash
-            if md5_digest.hexdigest() != etag:
+            if md5 != etag:
                 self.log.error('rejecting download due to ETag MD5 mismatch '
-                               '(expected: %s, actual: %s)',
-                               etag, md5_digest.hexdigest())
+                               '(expected: %s, actual: %s)', etag, md5)
                 raise RuntimeError('downloaded file appears to be corrupt '
                                    '(expected MD5: {0}, actual: {1})'
-                                   .format(etag, md5_digest.hexdigest()))
+                                   .format(etag, md5))
 
-        return {self.args['source']: {'md5': md5_digest.hexdigest(),
-                                      'sha1': sha_digest.hexdigest(),
-                                      'size': bytes_written}}
+    # RANGED DOWNLOADS #
+
+    def __download_ranges(self, size, etag):
+        range_size = self.args.get('range_size')
+        if not range_size:
+            range_size = euca2ools.util.choose_part_size(
+                size, max_size=euca2ools.util.MAX_PUT_OBJECT_SIZE)
+        num_threads = (self.args.get('download_threads') or
+                       _DEFAULT_DOWNLOAD_THREADS)
+        if (self.__dest_path is not None and
+                os.path.isfile(self.__dest_path)):
+            return self.__download_ranges_to_file(
+                self.__dest_path, size, etag, range_size, num_threads)
+        if self.args.get('resume'):
+            self.log.notice('only downloads to files can be resumed')
+        return self.__download_ranges_to_stream(
+            self.args['dest'], size, etag, range_size, num_threads)
+
+    def __download_ranges_to_file(self, dest_path, size, etag, range_size,
+                                  num_threads):
+        # Each range is written straight to its place in the file, and a
+        # journal next to it records which ones are done so an
+        # interrupted download can pick up where it left off.
+        journal = _RangeJournal(dest_path + '.download.json')
+        if self.args.get('resume') and journal.load(etag, size, range_size):
+            self.log.info('resuming download of %s (%i of %i ranges done)',
+                          self.args['source'], len(journal.done),
+                          -(-size // range_size))
+            range_size = journal.range_size
+        else:
+            journal.start(etag, size, range_size)
+        ranges = [(start, rsize) for start, rsize in
+                  _iter_ranges(size, range_size)
+                  if start not in journal.done]
+        self.log.info('downloading %s in %i ranges of %i bytes',
+                      self.args['source'], len(ranges), range_size)
+
+        shared_fd = euca2ools.util.SharedFileDescriptor(dest_path,
+                                                        writable=True)
+        try:
+            _preallocate(shared_fd.fd, size)
+
+            def fetch_range(byte_range):
+                start, rsize = byte_range
+                self.__fetch_range(
+                    start, rsize, etag,
+                    lambda: shared_fd.open_range(start, rsize))
+                journal.record_done(start)
+
+            self.__run_with_progressbar(
+                lambda: list(euca2ools.util.imap_in_threads(
+                    fetch_range, ranges, num_threads)),
+                size, size - sum(rsize for _, rsize in ranges))
+        finally:
+            shared_fd.close()
+
+        # Ranges finish out of order and some of them may come from an
+        # earlier run, so the only way to check the whole thing is to
+        # read it back.
+        digest = euca2ools.util.MultiDigest('md5', 'sha1')
+        bytes_read = 0
+        with open(dest_path, 'rb') as dest_file:
+            chunk = dest_file.read(euca2ools.BUFSIZE)
+            while chunk and bytes_read < size:
+                digest.update(chunk[:size - bytes_read])
+                bytes_read += len(chunk)
+                chunk = dest_file.read(euca2ools.BUFSIZE)
+        if bytes_read < size:
+            raise RuntimeError('downloaded file appears to be corrupt '
+                               '(expected size: {0}, actual: {1})'
+                               .format(size, bytes_read))
+        self.__check_etag(etag, digest.hexdigest('md5'))
+        journal.delete()
+        return {self.args['source']: {'md5': digest.hexdigest('md5'),
+                                      'sha1': digest.hexdigest('sha1'),
+                                      'size': size}}
+
+    def __download_ranges_to_stream(self, dest, size, etag, range_size,
+                                    num_threads):
+        # Ranges are fetched into buffers of their own and written out
+        # in order as they come up, so no more than num_threads of them
+        # are buffered at once.
+        def fetch_range(byte_range):
+            start, rsize = byte_range
+            range_buf = euca2ools.util.spooled_tempfile_for_large_files(
+                max_size=_RANGE_SPOOL_MAX_SIZE, prefix='getobject-')
+
+            def open_range_buf():
+                range_buf.seek(0)
+                range_buf.truncate()
+                return range_buf
+            try:
+                self.__fetch_range(start, rsize, etag, open_range_buf)
+            except BaseException:
+                range_buf.close()
+                raise
+            range_buf.seek(0)
+            return range_buf
+
+        digest = euca2ools.util.MultiDigest('md5', 'sha1')
+
+        def fetch_all_ranges():
+            for range_buf in euca2ools.util.imap_in_threads(
+                    fetch_range, _iter_ranges(size, range_size),
+                    num_threads):
+                with range_buf:
+                    chunk = range_buf.read(euca2ools.BUFSIZE)
+                    while chunk:
+                        dest.write(chunk)
+                        digest.update(chunk)
+                        chunk = range_buf.read(euca2ools.BUFSIZE)
+            dest.flush()
+
+        self.__run_with_progressbar(fetch_all_ranges, size, 0)
+        self.__check_etag(etag, digest.hexdigest('md5'))
+        return {self.args['source']: {'md5': digest.hexdigest('md5'),
+                                      'sha1': digest.hexdigest('sha1'),
+                                      'size': size}}
+
+    def __fetch_range(self, start, size, etag, open_range_file):
+        # open_range_file returns a file object to write the range to,
+        # starting over from the beginning each time it is called.
+        retries = self.args.get('retries') or 0
+        for retries_left in six.moves.range(retries, -1, -1):
+            range_file = open_range_file()
+            with self._progress_lock:
+                self._progress['active'].add(range_file)
+            try:
+                # If-Match makes sure every range comes from the same
+                # version of the object.
+                GetObject.from_other(
+                    self, source=self.args['source'], dest=range_file,
+                    byte_range=(start, start + size - 1),
+                    if_match='"{0}"'.format(etag) if etag else None).main()
+                with self._progress_lock:
+                    self._progress['done'] += size
+                return
+            except (requestbuilder.exceptions.ClientError,
+                    requests.exceptions.RequestException):
+                if retries_left <= 0:
+                    raise
+                self.log.info('retrying download of bytes %i-%i (%i retry '
+                              'attempt(s) remaining)', start,
+                              start + size - 1, retries_left, exc_info=True)
+            finally:
+                with self._progress_lock:
+                    self._progress['active'].discard(range_file)
+
+    def __run_with_progressbar(self, func, size, already_done):
+        # Several ranges are in flight at once, so they share one progress
+        # bar, which counts how much of each range has arrived so far.
+        self._progress = {'done': already_done, 'active': set()}
+        self._progress_lock = threading.Lock()
+        errors = []
+
+        def run():
+            try:
+                func()
+            except Exception:
+                errors.append(sys.exc_info())
+
+        # The download runs in another thread so the main thread can show
+        # a progress bar.
+        download_thread = threading.Thread(target=run)
+        download_thread.daemon = True
+        download_thread.start()
+        pbar = self.get_progressbar(label=self.args['source'], maxval=size)
+        pbar.start()
+        while download_thread.is_alive():
+            with self._progress_lock:
+                pbar.update(self._progress['done'] + sum(
+                    range_file.tell()
+                    for range_file in self._progress['active']))
+            download_thread.join(0.05)
+        pbar.finish()
+        if errors:
+            six.reraise(*errors[0])
+
+
+class _RangeJournal(object):
+    """
+    An on-disk record of which ranges of a large object have been
+    written to a file so far.  It is only good for the same version of
+    the object, which its ETag and size identify.
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.etag = None
+        self.size = None
+        self.range_size = None
+        self.done = set()  # start offsets of finished ranges
+        self._lock = threading.Lock()
+
+    def load(self, etag, size, range_size):
+        """
+        Read the journal and return True if it is for the same object.
+        Otherwise, return False.
+        """
+        try:
+            with open(self.filename) as journal_file:
+                data = json.load(journal_file)
+        except (IOError, ValueError):
+            return False
+        if (data.get('version') != self.VERSION or not etag or
+                data.get('etag') != etag or data.get('size') != size):
+            return False
+        self.etag = etag
+        self.size = size
+        self.range_size = data.get('range_size') or range_size
+        self.done = set(data.get('done') or ())
+        return True
+
+    def start(self, etag, size, range_size):
+        with self._lock:
+            self.etag = etag
+            self.size = size
+            self.range_size = range_size
+            self.done = set()
+            self.__save()
+
+    def record_done(self, start):
+        with self._lock:
+            self.done.add(start)
+            self.__save()
+
+    def delete(self):
+        with self._lock:
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+
+    def __save(self):
+        data = {'version': self.VERSION, 'etag': self.etag,
+                'size': self.size, 'range_size': self.range_size,
+                'done': sorted(self.done)}
+        # Write a new file and move it into place so a crash can never
+        # leave a journal half-written.
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as journal_file:
+            json.dump(data, journal_file, sort_keys=True)
+        os.rename(tmp_filename, self.filename)
+
+
+def _open_dest(dest_path, resume=False):
+    if resume and os.path.isfile(dest_path):
+        # Keep what an earlier download already wrote
+        return open(dest_path, 'r+')
+    return open(dest_path, 'w')
+
+
+def _preallocate(fd, size):
+    # Reserving the space up front keeps the file from fragmenting as
+    # ranges land in it out of order.  Not every file system supports
+    # that, but the truncate suffices.
+    if os.fstat(fd).st_size != size:
+        os.ftruncate(fd, size)
+    euca2ools.bundle.util.fallocate(fd, 0, size)
+
+
+def _iter_ranges(total_size, range_size):
+    for start in six.moves.range(0, total_size, range_size):
+        yield start, min(range_size, total_size - start)
@@ -24,19 +24,30 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
+import functools
 
 from requestbuilder import Arg
 from requestbuilder.exceptions import ArgumentError
 from requestbuilder.mixins import TabifyingMixin
-from requestbuilder.response import PaginatedResponse
 from requestbuilder.xmlparse import parse_aws_xml
 
 from euca2ools.commands.s3 import S3Request, validate_generic_bucket_name
+import euca2ools.util
+
+
+_DEFAULT_LIST_THREADS = 4
 
 
 class ListBucket(S3Request, TabifyingMixin):
     DESCRIPTION = 'List keys in one or more buckets'
     ARGS = [Arg('paths', metavar='BUCKET[/KEY]', nargs='+', route_to=None),
+            Arg('--list-threads', metavar='N', type=int, route_to=None,
+                help='''number of listings to run at the same time
+                (default: {0})'''.format(_DEFAULT_LIST_THREADS)),
+            Arg('--shard-delimiter', metavar='DELIM', route_to=None,
+                help='''split each path into the prefixes beneath it that
+                end with DELIM and list them at the same time.  Keys
+                are still listed in order.'''),
             Arg('--max-keys-per-request', dest='max-keys', type=int,
                 default=argparse.SUPPRESS, help=argparse.SUPPRESS)]
 
@@ -54,28 +65,66 @@ class ListBucket(S3Request, TabifyingMixin):
             except ValueError as err:
                 raise ArgumentError(
                     'bucket "{0}": {1}'.format(bucket, err.message))
+        if (self.args.get('list_threads') is not None and
+                self.args['list_threads'] < 1):
+            raise ArgumentError(
+                'argument --list-threads: value must be at least 1')
 
     def main(self):
-        self.method = 'GET'
-        pages = [(path, {}) for path in self.args['paths']]
-        return PaginatedResponse(self, pages, ('Contents',))
-
-    def get_next_page(self, response):
-        if response.get('IsTruncated') == 'true':
-            return self.path, {'marker': response['Contents'][-1]['Key']}
-
-    def prepare_for_page(self, page):
-        bucket, _, prefix = page[0].partition('/')
-        markers = page[1]
-        self.path = bucket
-        if prefix:
-            self.params['prefix'] = prefix
-        elif 'prefix' in self.params:
-            del self.params['prefix']
-        if markers is not None and markers.get('marker'):
-            self.params['marker'] = markers['marker']
-        elif 'marker' in self.params:
-            del self.params['marker']
+        # Keys are fetched lazily as the caller iterates over them, so
+        # memory use stays the same no matter how large the bucket is.
+        return {'Contents': self.__iter_objects()}
+
+    def __iter_objects(self):
+        num_threads = self.args.get('list_threads') or _DEFAULT_LIST_THREADS
+        delimiter = self.args.get('shard_delimiter')
+        if delimiter:
+            listings = (listing for path in self.args['paths'] for listing
+                        in self.__iter_shard_listings(path, delimiter))
+        else:
+            listings = (self.__get_listing(path)
+                        for path in self.args['paths'])
+        for objects in euca2ools.util.chain_in_threads(listings,
+                                                       num_threads):
+            for obj in objects:
+                yield obj
+
+    def __get_listing(self, path):
+        return functools.partial(_iter_page_contents,
+                                 self.__get_request_for_path(path), path)
+
+    def __get_request_for_path(self, path):
+        # Each listing has a request of its own so they can run at the
+        # same time.  Create it here, and not in the thread that runs it.
+        req_kwargs = {'paths': [path]}
+        if 'max-keys' in self.args:
+            req_kwargs['max-keys'] = self.args['max-keys']
+        return ListBucket.from_other(self, **req_kwargs)
+
+    def __iter_shard_listings(self, path, delimiter):
+        # A listing with a delimiter yields the keys directly beneath
+        # the path and the prefixes that all of the other keys fall
+        # under.  Each prefix gets a listing of its own, and the keys
+        # directly beneath the path go between them where they sort.
+        bucket = path.split('/', 1)[0]
+        req = self.__get_request_for_path(path)
+        top_keys = []
+        for page in _iter_pages(req, path, delimiter=delimiter):
+            entries = ([(obj['Key'], obj) for obj in
+                        page.get('Contents') or []] +
+                       [(prefix['Prefix'], None) for prefix in
+                        page.get('CommonPrefixes') or []])
+            entries.sort(key=lambda entry: entry[0])
+            for name, obj in entries:
+                if obj is not None:
+                    top_keys.append(obj)
+                    continue
+                if top_keys:
+                    yield functools.partial(list, [top_keys])
+                    top_keys = []
+                yield self.__get_listing('/'.join((bucket, name)))
+        if top_keys:
+            yield functools.partial(list, [top_keys])
 
     def parse_response(self, response):
         response_dict = self.log_and_parse_response(
@@ -88,3 +137,48 @@ class ListBucket(S3Request, TabifyingMixin):
         for obj in result.get('Contents', []):
             print obj.get('Key')
     # pylint: enable=no-self-use
+
+
+def _iter_pages(req, path, delimiter=None):
+    """
+    Send a ListBucket request for a BUCKET[/KEY] path as many times as
+    it takes to list everything under it, yielding each page of results
+    as it arrives
+    """
+    bucket, _, prefix = path.partition('/')
+    req.method = 'GET'
+    req.path = bucket
+    req.params.pop('marker', None)
+    if prefix:
+        req.params['prefix'] = prefix
+    else:
+        req.params.pop('prefix', None)
+    if delimiter:
+        req.params['delimiter'] = delimiter
+    else:
+        req.params.pop('delimiter', None)
+    while True:
+        page = req.send()
+        yield page
+        marker = _get_next_marker(page)
+        if page.get('IsTruncated') != 'true' or not marker:
+            return
+        req.params['marker'] = marker
+
+
+def _iter_page_contents(req, path):
+    for page in _iter_pages(req, path):
+        yield page.get('Contents') or []
+
+
+def _get_next_marker(page):
+    # Servers only have to return NextMarker when there is a delimiter.
+    # Otherwise the next page starts after the last thing in this one.
+    if page.get('NextMarker'):
+        return page['NextMarker']
+    names = []
+    if page.get('Contents'):
+        names.append(page['Contents'][-1]['Key'])
+    if page.get('CommonPrefixes'):
+        names.append(page['CommonPrefixes'][-1]['Prefix'])
+    return max(names) if names else None
@@ -25,17 +25,34 @@
 
 import argparse
 import base64
+import binascii
+import os
+import os.path
+import shutil
+import stat
 import sys
+import threading
 
 from requestbuilder import Arg, MutuallyExclusiveArgList
 from requestbuilder.exceptions import ArgumentError
+import requestbuilder.exceptions
+from requestbuilder.mixins import FileTransferProgressBarMixin
 import six
 
+import euca2ools
 from euca2ools.commands.argtypes import b64encoded_file_contents
 from euca2ools.commands.s3 import S3Request
+import euca2ools.util
+from euca2ools.util import FileObjectExtent
 
 
-class PostObject(S3Request):
+# Sources whose size we cannot tell without reading them are copied to a
+# buffer first that is kept in memory up to this size and spills over to
+# disk beyond it.
+_SOURCE_SPOOL_MAX_SIZE = 16 * 2 ** 20  # 16 MiB
+
+
+class PostObject(S3Request, FileTransferProgressBarMixin):
     DESCRIPTION = ('Upload an object to the server using an upload policy\n\n'
                    'Note that uploading a large file to a region other than '
                    'the one the bucket is may result in "Broken pipe" errors '
@@ -73,7 +90,15 @@ class PostObject(S3Request):
                 once uploaded.  Take care to ensure this satisfies any
                 restrictions the upload policy may contain.'''),
             Arg('--mime-type', dest='Content-Type', default=argparse.SUPPRESS,
-                help='MIME type for the file being uploaded')]
+                help='MIME type for the file being uploaded'),
+            Arg('--size', type=int, route_to=None, help='''the number of
+                bytes to upload (default: the size of the file.  Reading
+                from stdin without this buffers it all first.)'''),
+            Arg('--retry', dest='retries', action='store_const', const=5,
+                default=0, route_to=None,
+                help='retry interrupted uploads up to 5 times'),
+            Arg('--progressbar-label', route_to=None,
+                help=argparse.SUPPRESS)]
     METHOD = 'POST'
 
     # noinspection PyExceptionInherit
@@ -81,29 +106,185 @@ class PostObject(S3Request):
         S3Request.configure(self)
 
         if self.args['source'] == '-':
-            self.files['file'] = sys.stdin
+            self.args['source'] = self.__get_extent_for_fileobj(sys.stdin)
         elif isinstance(self.args['source'], six.string_types):
-            self.files['file'] = open(self.args['source'])
+            self.args['source'] = FileObjectExtent.from_filename(
+                self.args['source'], size=self.args.get('size'))
         else:
-            self.files['file'] = self.args['source']
+            self.args['source'] = self.__get_extent_for_fileobj(
+                self.args['source'])
         bucket, _, key = self.args['dest'].partition('/')
         if not bucket:
             raise ArgumentError('destination bucket name must be non-empty')
         if not key:
             raise ArgumentError('destination key name must be non-empty')
 
-    # noinspection PyExceptionInherit
+    def __get_extent_for_fileobj(self, fileobj):
+        filename = getattr(fileobj, 'name', None)
+        if (not isinstance(filename, six.string_types) or
+                filename.startswith('<')):
+            # Not a real file name, e.g. "<stdin>"
+            filename = None
+        size = self.args.get('size')
+        if size is None:
+            try:
+                fstat = os.fstat(fileobj.fileno())
+                if stat.S_ISREG(fstat.st_mode):
+                    size = fstat.st_size - fileobj.tell()
+            except (AttributeError, EnvironmentError, ValueError):
+                pass
+        if size is None:
+            # The body's length has to be known before any of it is sent
+            spool = euca2ools.util.spooled_tempfile_for_large_files(
+                max_size=_SOURCE_SPOOL_MAX_SIZE, prefix='postobject-')
+            shutil.copyfileobj(fileobj, spool, euca2ools.BUFSIZE)
+            size = spool.tell()
+            spool.seek(0)
+            fileobj = spool
+        return FileObjectExtent(fileobj, size, filename=filename)
+
     def preprocess(self):
-        # FIXME:  This should really stream the contents of the source rather
-        # than reading it all into memory at once, but at the moment doing so
-        # would require me to write a multipart MIME encoder that supports
-        # both streaming and file rewinding.  Patches that do that are very
-        # welcome.
-        #
-        # FIXME:  While you're in there, would you mind adding progress bar
-        # support?  8^)
         # pylint: disable=access-member-before-definition
-        self.path, _, self.params['key'] = self.args['dest'].partition('/')
-        self.body = self.params
+        self.path, _, key = self.args['dest'].partition('/')
+        fields = [('key', key)] + sorted(six.iteritems(self.params or {}))
         # pylint: enable=access-member-before-definition
         self.params = None
+        self.body = _MultipartFormBody(fields, self.args['source'])
+        self.headers['Content-Type'] = self.body.content_type
+        self.headers['Content-Length'] = str(len(self.body))
+
+    def main(self):
+        self.preprocess()
+        source = self.args['source']
+        errors = []
+
+        def send_body():
+            try:
+                self.__send_with_retries()
+            except Exception:
+                errors.append(sys.exc_info())
+
+        # We do the upload in another thread so the main thread can show a
+        # progress bar.
+        upload_thread = threading.Thread(target=send_body)
+        # The upload thread is daemonic so ^C will kill the program more
+        # cleanly.
+        upload_thread.daemon = True
+        upload_thread.start()
+        pbar_label = self.args.get('progressbar_label') or source.filename
+        pbar = self.get_progressbar(label=pbar_label, maxval=source.size)
+        pbar.start()
+        while upload_thread.is_alive():
+            pbar.update(source.tell())
+            upload_thread.join(0.05)
+        pbar.finish()
+        source.close()
+        if errors:
+            six.reraise(*errors[0])
+        return self.response
+
+    def __send_with_retries(self):
+        retries_left = self.args.get('retries') or 0
+        if retries_left > 0 and not self.body.can_rewind:
+            self.log.notice('source cannot rewind, so requested retries will '
+                            'not be attempted')
+            retries_left = 0
+        while True:
+            try:
+                response = self.send()
+                break
+            except requestbuilder.exceptions.TimeoutError:
+                if retries_left <= 0:
+                    raise
+                self.log.info('retrying upload (%i retry attempt(s) '
+                              'remaining)', retries_left)
+                retries_left -= 1
+                self.body.rewind()
+        our_md5 = self.body.read_hexdigest
+        their_md5 = response.headers.get('ETag', '').lower().strip('"')
+        if their_md5 and their_md5 != our_md5:
+            self.log.error('corrupt upload (our MD5: %s, their MD5: %s',
+                           our_md5, their_md5)
+            raise requestbuilder.exceptions.ClientError(
+                'upload was corrupted during transit')
+
+
+class _MultipartFormBody(object):
+    """
+    A multipart/form-data request body whose last field is a file.  The
+    file is read only as the body itself is, so it never has to fit in
+    memory, but the body's length is still known before it is sent.
+    """
+    # Like FileObjectExtent this must not be iterable, or requests will
+    # attempt to use chunked transfer-encoding, which S3 does not support.
+
+    def __init__(self, fields, source):
+        self.source = source
+        boundary = binascii.hexlify(os.urandom(16))
+        self.content_type = 'multipart/form-data; boundary={0}'.format(
+            str(boundary.decode('ascii')))
+        head = []
+        for name, value in fields:
+            head.extend((b'--', boundary, b'\r\n',
+                         b'Content-Disposition: form-data; name="',
+                         _to_bytes(name), b'"\r\n\r\n', _to_bytes(value),
+                         b'\r\n'))
+        # S3 ignores everything after the file, so it has to come last.
+        filename = os.path.basename(source.filename or 'file')
+        head.extend((b'--', boundary, b'\r\n',
+                     b'Content-Disposition: form-data; name="file"; '
+                     b'filename="', _to_bytes(filename), b'"\r\n',
+                     b'Content-Type: application/octet-stream\r\n\r\n'))
+        self.__head = b''.join(head)
+        self.__tail = b''.join((b'\r\n--', boundary, b'--\r\n'))
+        self.__pos = 0
+
+    def __len__(self):
+        return len(self.__head) + self.source.size + len(self.__tail)
+
+    @property
+    def can_rewind(self):
+        return self.source.can_rewind
+
+    @property
+    def read_hexdigest(self):
+        return self.source.read_hexdigest
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self) - self.__pos
+        chunks = []
+        while size > 0:
+            chunk = self.__read_some(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self.__pos += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def __read_some(self, size):
+        if self.__pos < len(self.__head):
+            return self.__head[self.__pos:self.__pos + size]
+        source_end = len(self.__head) + self.source.size
+        if self.__pos < source_end:
+            chunk = self.source.read(min(size, source_end - self.__pos))
+            if not chunk:
+                raise IOError('source ended {0} bytes short of its expected '
+                              'size'.format(source_end - self.__pos))
+            return chunk
+        tail_pos = self.__pos - source_end
+        return self.__tail[tail_pos:tail_pos + size]
+
+    def rewind(self):
+        self.source.rewind()
+        self.__pos = 0
+
+    def tell(self):
+        return self.__pos
+
+
+def _to_bytes(value):
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
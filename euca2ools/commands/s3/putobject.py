@@ -24,7 +24,10 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
+import base64
+import binascii
 import hashlib
+import os.path
 import sys
 import threading
 import time
@@ -34,8 +37,28 @@ import requestbuilder.exceptions
 from requestbuilder.mixins import FileTransferProgressBarMixin
 import six
 
+import euca2ools
+from euca2ools.commands.argtypes import filesize
 from euca2ools.commands.s3 import S3Request
+from euca2ools.commands.s3.abortmultipartupload import AbortMultipartUpload
+from euca2ools.commands.s3.completemultipartupload import \
+    CompleteMultipartUpload
+from euca2ools.commands.s3.initiatemultipartupload import \
+    InitiateMultipartUpload
+from euca2ools.commands.s3.uploadpart import UploadPart
 import euca2ools.util
+from euca2ools.util import FileObjectExtent
+
+
+# Objects at least this large are uploaded in parts unless told otherwise.
+# This is larger than any bundle or import part we choose on our own.
+MULTIPART_THRESHOLD = 256 * 2 ** 20  # 256 MiB
+MULTIPART_MIN_PART_SIZE = 5 * 2 ** 20  # 5 MiB, except for the last part
+MULTIPART_MAX_PARTS = 10000
+_DEFAULT_MULTIPART_THREADS = 4
+# Parts of sources that we cannot read out of order are copied to buffers
+# that are kept in memory up to this size and spill over to disk beyond it.
+_MULTIPART_SPOOL_MAX_SIZE = 16 * 2 ** 20  # 16 MiB
 
 
 class PutObject(S3Request, FileTransferProgressBarMixin):
@@ -58,7 +81,21 @@ class PutObject(S3Request, FileTransferProgressBarMixin):
             Arg('--retry', dest='retries', action='store_const', const=5,
                 default=0, route_to=None,
                 help='retry interrupted uploads up to 5 times'),
-            Arg('--progressbar-label', help=argparse.SUPPRESS)]
+            Arg('--multipart-threshold', metavar='BYTES', type=filesize,
+                route_to=None, help='''upload objects at least this large
+                in parts, several at a time, each of which is retried on
+                its own when --retry is used.  Use 0 to always upload
+                objects whole.  (default: 256M)'''),
+            Arg('--multipart-part-size', metavar='BYTES', type=filesize,
+                route_to=None, help='''size of each part of a multipart
+                upload (default: chosen based on the object's size)'''),
+            Arg('--multipart-threads', metavar='N', type=int, route_to=None,
+                help='''number of parts of a multipart upload to upload at
+                the same time (default: 4)'''),
+            Arg('--progressbar-label', help=argparse.SUPPRESS),
+            # The MD5 digest of the data to upload, in hex form, when the
+            # caller already knows it
+            Arg('--content-md5', route_to=None, help=argparse.SUPPRESS)]
     METHOD = 'PUT'
 
     def __init__(self, **kwargs):
@@ -73,15 +110,20 @@ class PutObject(S3Request, FileTransferProgressBarMixin):
             if self.args.get('size') is None:
                 raise requestbuilder.exceptions.ArgumentError(
                     "argument --size is required when uploading stdin")
-            source = _FileObjectExtent(sys.stdin, self.args['size'])
+            source = FileObjectExtent(
+                sys.stdin, self.args['size'],
+                hexdigest=self.args.get('content_md5'))
         elif isinstance(self.args['source'], six.string_types):
-            source = _FileObjectExtent.from_filename(
-                self.args['source'], size=self.args.get('size'))
+            source = FileObjectExtent.from_filename(
+                self.args['source'], size=self.args.get('size'),
+                hexdigest=self.args.get('content_md5'))
         else:
             if self.args.get('size') is None:
                 raise requestbuilder.exceptions.ArgumentError(
                     "argument --size is required when uploading a file object")
-            source = _FileObjectExtent(self.args['source'], self.args['size'])
+            source = FileObjectExtent(
+                self.args['source'], self.args['size'],
+                hexdigest=self.args.get('content_md5'))
         self.args['source'] = source
         bucket, _, key = self.args['dest'].partition('/')
         if not bucket:
@@ -90,6 +132,14 @@ class PutObject(S3Request, FileTransferProgressBarMixin):
         if not key:
             raise requestbuilder.exceptions.ArgumentError(
                 'destination key name must be non-empty')
+        part_size = self.args.get('multipart_part_size')
+        if part_size is not None and part_size < MULTIPART_MIN_PART_SIZE:
+            raise requestbuilder.exceptions.ArgumentError(
+                'argument --multipart-part-size: must be at least {0}'
+                .format(MULTIPART_MIN_PART_SIZE))
+        if (self.args.get('multipart_threads') or 1) < 1:
+            raise requestbuilder.exceptions.ArgumentError(
+                'argument --multipart-threads: value must be positive')
 
     def preprocess(self):
         self.path = self.args['dest']
@@ -97,11 +147,20 @@ class PutObject(S3Request, FileTransferProgressBarMixin):
             self.headers['x-amz-acl'] = self.args['acl']
         if self.args.get('mime_type'):
             self.headers['Content-Type'] = self.args['mime_type']
+        if self.args.get('content_md5'):
+            # This lets the server check the data's integrity for us
+            self.headers['Content-MD5'] = base64.b64encode(
+                binascii.unhexlify(self.args['content_md5']))
 
     # noinspection PyExceptionInherit
     def main(self):
         self.preprocess()
         source = self.args['source']
+        threshold = self.args.get('multipart_threshold')
+        if threshold is None:
+            threshold = MULTIPART_THRESHOLD
+        if threshold and source.size >= threshold:
+            return self.__upload_multipart(source)
 
         # For requests >=2.11.0 it requires headers to be either str or bytes
         self.headers['Content-Length'] = bytes(source.size)
@@ -162,73 +221,176 @@ class PutObject(S3Request, FileTransferProgressBarMixin):
                 self.last_upload_error = err
             return
 
+    # MULTIPART UPLOADS #
+
+    def __upload_multipart(self, source):
+        part_size = self.args.get('multipart_part_size')
+        if not part_size:
+            part_size = euca2ools.util.choose_part_size(
+                source.size, min_size=MULTIPART_MIN_PART_SIZE,
+                max_size=euca2ools.util.MAX_PUT_OBJECT_SIZE)
+        # S3 allows only so many parts
+        part_size = max(part_size,
+                        -(-source.size // MULTIPART_MAX_PARTS))
+        num_threads = (self.args.get('multipart_threads') or
+                       _DEFAULT_MULTIPART_THREADS)
+        initiate_req = InitiateMultipartUpload.from_other(
+            self, path=self.args['dest'], acl=self.args.get('acl'),
+            mime_type=self.args.get('mime_type'))
+        upload_id = initiate_req.main()['UploadId']
+        self.log.info('uploading %s in parts of %i bytes (upload ID %s)',
+                      self.args['dest'], part_size, upload_id)
+        try:
+            etags = self.__upload_parts(source, upload_id, part_size,
+                                        num_threads)
+            complete_req = CompleteMultipartUpload.from_other(
+                self, path=self.args['dest'], upload_id=upload_id,
+                parts=etags)
+            complete_req.main()
+            self.response = complete_req.response
+        except (Exception, KeyboardInterrupt):
+            exc_info = sys.exc_info()
+            # Don't leave the parts behind for the owner to pay for
+            try:
+                AbortMultipartUpload.from_other(
+                    self, path=self.args['dest'], upload_id=upload_id).main()
+            except Exception:
+                self.log.warn('failed to abort multipart upload %s',
+                              upload_id, exc_info=True)
+            six.reraise(*exc_info)
+        finally:
+            source.close()
 
-class _FileObjectExtent(object):
-    # By rights this class should be iterable, but if we do that then requests
-    # will attempt to use chunked transfer-encoding, which S3 does not
-    # support.
-
-    def __init__(self, fileobj, size, filename=None):
-        self.closed = False
-        self.filename = filename
-        self.fileobj = fileobj
-        self.size = size
-        self.__bytes_read = 0
-        self.__md5 = hashlib.md5()
-        if hasattr(self.fileobj, 'tell'):
-            self.__initial_pos = self.fileobj.tell()
+    def __upload_parts(self, source, upload_id, part_size, num_threads):
+        # Parts of a file we can open ourselves are read straight from it
+        # at the same time.  Anything else has to be read in order, so
+        # each part gets copied to a buffer of its own first.
+        if (source.filename is not None and
+                os.path.isfile(source.filename)):
+            shared_fd = euca2ools.util.SharedFileDescriptor(source.filename)
+            part_files = ((shared_fd.open_range(start, size), size)
+                          for start, size in _iter_part_ranges(source.size,
+                                                               part_size))
         else:
-            self.__initial_pos = None
-
-    def __len__(self):
-        return self.size
-
-    @classmethod
-    def from_filename(cls, filename, size=None):
-        if size is None:
-            size = euca2ools.util.get_filesize(filename)
-        return cls(open(filename), size, filename=filename)
-
-    @property
-    def can_rewind(self):
-        return hasattr(self.fileobj, 'seek') and self.__initial_pos is not None
-
-    def close(self):
-        self.fileobj.close()
-        self.closed = True
-
-    def next(self):
-        remaining = self.size - self.__bytes_read
-        if remaining <= 0:
-            raise StopIteration()
-        chunk = next(self.fileobj)  # might raise StopIteration, which is good
-        chunk = chunk[:remaining]  # throw away data that are off the end
-        self.__bytes_read += len(chunk)
-        self.__md5.update(chunk)
-        return chunk
-
-    def read(self, size=-1):
-        remaining = self.size - self.__bytes_read
-        if size < 0:
-            chunk_len = remaining
+            shared_fd = None
+            part_files = self.__iter_buffered_parts(source, part_size)
+        if self.args.get('content_md5'):
+            # Parts are handed out in order, so digesting each one as it
+            # is handed out digests the whole object.
+            object_md5 = hashlib.md5()
+            part_files = _iter_digested_parts(part_files, object_md5)
         else:
-            chunk_len = min(remaining, size)
-        chunk = self.fileobj.read(chunk_len)
-        self.__bytes_read += len(chunk)
-        self.__md5.update(chunk)
-        return chunk
-
-    @property
-    def read_hexdigest(self):
-        return self.__md5.hexdigest()
-
-    def rewind(self):
-        if not hasattr(self.fileobj, 'seek'):
-            raise TypeError('file object is not seekable')
-        assert self.__initial_pos is not None
-        self.fileobj.seek(self.__initial_pos)
-        self.__bytes_read = 0
-        self.__md5 = hashlib.md5()
-
-    def tell(self):
-        return self.__bytes_read
+            object_md5 = None
+
+        # Several parts are in flight at once, so they share one progress
+        # bar, which counts how much of each part has been sent so far.
+        progress = {'done': 0, 'active': set()}
+        progress_lock = threading.Lock()
+        retries = self.args.get('retries') or 0
+
+        def upload_part(numbered_part_file):
+            part_number, (part_file, size) = numbered_part_file
+            with part_file:
+                for retries_left in six.moves.range(retries, -1, -1):
+                    part_file.seek(0)
+                    extent = FileObjectExtent(part_file, size)
+                    with progress_lock:
+                        progress['active'].add(extent)
+                    try:
+                        etag = UploadPart.from_other(
+                            self, path=self.args['dest'],
+                            upload_id=upload_id, part_number=part_number,
+                            source=extent).main()
+                        if etag != extent.read_hexdigest:
+                            self.log.error(
+                                'corrupt upload of part %i (our MD5: %s, '
+                                'their MD5: %s)', part_number,
+                                extent.read_hexdigest, etag)
+                            raise requestbuilder.exceptions.ClientError(
+                                'upload was corrupted during transit')
+                        with progress_lock:
+                            progress['done'] += size
+                        return part_number, etag
+                    except (requestbuilder.exceptions.ClientError,
+                            requestbuilder.exceptions.ServerError):
+                        if retries_left <= 0:
+                            raise
+                        self.log.info('retrying upload of part %i (%i retry '
+                                      'attempt(s) remaining)', part_number,
+                                      retries_left, exc_info=True)
+                    finally:
+                        with progress_lock:
+                            progress['active'].discard(extent)
+
+        etags = []
+        errors = []
+
+        def upload_all_parts():
+            try:
+                etags.extend(euca2ools.util.imap_in_threads(
+                    upload_part, enumerate(part_files, 1), num_threads))
+            except Exception:
+                errors.append(sys.exc_info())
+
+        # The upload runs in another thread so the main thread can show
+        # a progress bar.
+        upload_thread = threading.Thread(target=upload_all_parts)
+        upload_thread.daemon = True
+        upload_thread.start()
+        pbar_label = self.args.get('progressbar_label') or source.filename
+        pbar = self.get_progressbar(label=pbar_label, maxval=source.size)
+        pbar.start()
+        try:
+            while upload_thread.is_alive():
+                with progress_lock:
+                    pbar.update(progress['done'] + sum(
+                        extent.tell() for extent in progress['active']))
+                upload_thread.join(0.05)
+            pbar.finish()
+        finally:
+            if shared_fd is not None:
+                shared_fd.close()
+        if errors:
+            six.reraise(*errors[0])
+        if (object_md5 is not None and
+                object_md5.hexdigest() != self.args['content_md5'].lower()):
+            self.log.error('source does not match the expected MD5 digest '
+                           '(expected: %s, actual: %s)',
+                           self.args['content_md5'], object_md5.hexdigest())
+            raise requestbuilder.exceptions.ClientError(
+                'source does not match the expected MD5 digest')
+        return etags
+
+    def __iter_buffered_parts(self, source, part_size):
+        while True:
+            part_buf = euca2ools.util.spooled_tempfile_for_large_files(
+                max_size=_MULTIPART_SPOOL_MAX_SIZE, prefix='putobject-')
+            bytes_to_read = part_size
+            while bytes_to_read > 0:
+                chunk = source.read(min(bytes_to_read, euca2ools.BUFSIZE))
+                if not chunk:
+                    break
+                part_buf.write(chunk)
+                bytes_to_read -= len(chunk)
+            if bytes_to_read == part_size:
+                part_buf.close()
+                return
+            yield part_buf, part_size - bytes_to_read
+            if bytes_to_read > 0:
+                return
+
+
+def _iter_digested_parts(part_files, digest):
+    for part_file, size in part_files:
+        part_file.seek(0)
+        while True:
+            chunk = part_file.read(euca2ools.BUFSIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+        yield part_file, size
+
+
+def _iter_part_ranges(total_size, part_size):
+    for start in six.moves.range(0, total_size, part_size):
+        yield start, min(part_size, total_size - start)
@@ -0,0 +1,66 @@
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import base64
+import binascii
+
+from requestbuilder import Arg
+
+from euca2ools.commands.s3 import S3Request
+
+
+class UploadPart(S3Request):
+    DESCRIPTION = ('Upload one part of an object as part of a multipart '
+                   'upload and return its ETag')
+    ARGS = [Arg('path', metavar='BUCKET/KEY', route_to=None),
+            Arg('--upload-id', route_to=None, required=True),
+            Arg('--part-number', type=int, route_to=None, required=True),
+            # A file object with the part's data and a known length, such
+            # as a euca2ools.util.FileObjectExtent
+            Arg('--source', route_to=None, required=True),
+            Arg('--content-md5', route_to=None)]
+    METHOD = 'PUT'
+
+    def configure(self):
+        S3Request.configure(self)
+        self.configure_s3_hmacv1_auth()
+
+    def preprocess(self):
+        self.path = self.args['path']
+        self.params['uploadId'] = self.args['upload_id']
+        self.params['partNumber'] = str(self.args['part_number'])
+        self.headers['Content-Length'] = str(len(self.args['source']))
+        if self.args.get('content_md5'):
+            self.headers['Content-MD5'] = base64.b64encode(
+                binascii.unhexlify(self.args['content_md5']))
+        self.body = self.args['source']
+
+    def parse_response(self, response):
+        return response.headers.get('ETag', '').lower().strip('"')
+
+    # pylint: disable=no-self-use
+    def print_result(self, result):
+        print result
+    # pylint: enable=no-self-use
@@ -0,0 +1,261 @@
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Thin wrappers around the optional python cryptography library, which
+lets us use the same OpenSSL primitives the openssl executable does
+without having to shuttle data to and from a subprocess.  The RSA
+functions fall back to the openssl executable when the library is
+missing.
+"""
+
+import binascii
+import hashlib
+import os.path
+import subprocess
+import threading
+
+import six
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import (
+        padding as asym_padding)
+    from cryptography.hazmat.primitives.asymmetric import (
+        utils as asym_utils)
+    from cryptography.hazmat.primitives.ciphers import (algorithms, Cipher,
+                                                        modes)
+    HAVE_CRYPTOGRAPHY = True
+except ImportError:
+    HAVE_CRYPTOGRAPHY = False
+
+
+def require_cryptography(feature):
+    """
+    Raise a RuntimeError that names a feature if the cryptography
+    library is unavailable.
+    """
+    if not HAVE_CRYPTOGRAPHY:
+        raise RuntimeError('{0} requires the python cryptography library'
+                           .format(feature))
+
+
+class AESCBCEncryptor(object):
+    """
+    An incremental AES-CBC encryptor with PKCS#7 padding, which is what
+    ``openssl enc -e -aes-128-cbc -K KEY -iv IV`` produces.
+
+    :param enc_key: the key as a hex string
+    :param enc_iv: the initialization vector as a hex string
+    """
+
+    def __init__(self, enc_key, enc_iv):
+        require_cryptography('in-process encryption')
+        cipher = Cipher(algorithms.AES(binascii.unhexlify(enc_key)),
+                        modes.CBC(binascii.unhexlify(enc_iv)),
+                        backend=default_backend())
+        self.__encryptor = cipher.encryptor()
+        self.__padder = padding.PKCS7(algorithms.AES.block_size).padder()
+
+    def update(self, data):
+        return self.__encryptor.update(self.__padder.update(data))
+
+    def finalize(self):
+        return (self.__encryptor.update(self.__padder.finalize()) +
+                self.__encryptor.finalize())
+
+
+class AESCBCDecryptor(object):
+    """
+    An incremental AES-CBC decryptor that removes PKCS#7 padding, which is
+    what ``openssl enc -d -aes-128-cbc -K KEY -iv IV`` does.
+
+    :param enc_key: the key as a hex string
+    :param enc_iv: the initialization vector as a hex string
+    """
+
+    def __init__(self, enc_key, enc_iv):
+        require_cryptography('in-process decryption')
+        cipher = Cipher(algorithms.AES(binascii.unhexlify(enc_key)),
+                        modes.CBC(binascii.unhexlify(enc_iv)),
+                        backend=default_backend())
+        self.__decryptor = cipher.decryptor()
+        self.__unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+
+    def update(self, data):
+        return self.__unpadder.update(self.__decryptor.update(data))
+
+    def finalize(self):
+        try:
+            return (self.__unpadder.update(self.__decryptor.finalize()) +
+                    self.__unpadder.finalize())
+        except ValueError as err:
+            raise ValueError('bad decrypt: {0}'.format(err))
+
+
+# RSA operations for bundle manifests and the like.  These use the
+# cryptography library when it is available and fall back to running
+# openssl otherwise.  Certificates and keys are parsed only once per
+# file, which matters when handling many manifests in one process.
+
+_PEM_CACHE = {}
+_PEM_CACHE_LOCK = threading.Lock()
+
+
+def load_certificate(cert_filename):
+    """
+    Load and cache an X.509 certificate from a PEM file
+    """
+    require_cryptography('loading certificates in-process')
+    return _load_cached(cert_filename, _load_certificate_from_str)
+
+
+def load_private_key(privkey_filename):
+    """
+    Load and cache an unencrypted private key from a PEM file
+    """
+    require_cryptography('loading private keys in-process')
+    return _load_cached(privkey_filename, _load_private_key_from_str)
+
+
+def get_cert_fingerprint(cert_filename):
+    """
+    Return the SHA1 fingerprint of a PEM certificate file as a lowercase
+    hex string
+    """
+    if HAVE_CRYPTOGRAPHY:
+        cert = load_certificate(cert_filename)
+        return binascii.hexlify(cert.fingerprint(hashes.SHA1())).decode()
+    stdout = _run_openssl(('x509', '-in', cert_filename, '-fingerprint',
+                           '-sha1', '-noout'))
+    return _parse_openssl_fingerprint(stdout)
+
+
+def get_cert_content_fingerprint(cert_content):
+    """
+    Return the SHA1 fingerprint of a PEM certificate given as a string as
+    a lowercase hex string
+    """
+    if HAVE_CRYPTOGRAPHY:
+        cert = _load_certificate_from_str(cert_content)
+        return binascii.hexlify(cert.fingerprint(hashes.SHA1())).decode()
+    stdout = _run_openssl(('x509', '-fingerprint', '-sha1', '-noout'),
+                          stdin=cert_content)
+    return _parse_openssl_fingerprint(stdout)
+
+
+def rsa_public_encrypt(data, cert_filename):
+    """
+    Encrypt data with PKCS#1 v1.5 padding using the public key in a PEM
+    certificate file, as ``openssl rsautl -encrypt -pkcs -certin`` does
+    """
+    if HAVE_CRYPTOGRAPHY:
+        return load_certificate(cert_filename).public_key().encrypt(
+            _to_bytes(data), asym_padding.PKCS1v15())
+    return _run_openssl(('rsautl', '-encrypt', '-pkcs', '-inkey',
+                         cert_filename, '-certin'), stdin=data)
+
+
+def rsa_private_decrypt(data, privkey_filename):
+    """
+    Decrypt data with PKCS#1 v1.5 padding using a PEM private key file,
+    as ``openssl rsautl -decrypt -pkcs`` does.  Raise ValueError if it
+    cannot be decrypted.
+    """
+    if HAVE_CRYPTOGRAPHY:
+        return load_private_key(privkey_filename).decrypt(
+            _to_bytes(data), asym_padding.PKCS1v15())
+    stdout = _run_openssl(('rsautl', '-decrypt', '-pkcs', '-inkey',
+                           privkey_filename), stdin=data)
+    if not stdout:
+        raise ValueError('decryption failed')
+    return stdout
+
+
+def rsa_sha1_sign(data, privkey_filename):
+    """
+    Return a PKCS#1 v1.5 signature of the SHA1 digest of data using a PEM
+    private key file
+    """
+    return rsa_sign_sha1_digest(hashlib.sha1(_to_bytes(data)).digest(),
+                                privkey_filename)
+
+
+def rsa_sign_sha1_digest(digest, privkey_filename):
+    """
+    Like rsa_sha1_sign, but for data whose SHA1 digest is already known
+    """
+    if HAVE_CRYPTOGRAPHY:
+        return load_private_key(privkey_filename).sign(
+            digest, asym_padding.PKCS1v15(),
+            asym_utils.Prehashed(hashes.SHA1()))
+    return _run_openssl(('pkeyutl', '-sign', '-inkey', privkey_filename,
+                         '-pkeyopt', 'digest:sha1'), stdin=digest)
+
+
+def _load_cached(filename, loader):
+    # Keying on mtime as well as the name lets a file that changes
+    # underneath a long-running process get picked up again.
+    filename = os.path.abspath(filename)
+    key = (filename, os.path.getmtime(filename), loader)
+    with _PEM_CACHE_LOCK:
+        if key in _PEM_CACHE:
+            return _PEM_CACHE[key]
+    with open(filename, 'rb') as pem_file:
+        obj = loader(pem_file.read())
+    with _PEM_CACHE_LOCK:
+        _PEM_CACHE[key] = obj
+    return obj
+
+
+def _load_certificate_from_str(pem):
+    return x509.load_pem_x509_certificate(_to_bytes(pem), default_backend())
+
+
+def _load_private_key_from_str(pem):
+    return serialization.load_pem_private_key(_to_bytes(pem), None,
+                                              default_backend())
+
+
+def _run_openssl(args, stdin=None):
+    popen = subprocess.Popen(('openssl',) + tuple(args),
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    (stdout, _) = popen.communicate(stdin)
+    return stdout
+
+
+def _parse_openssl_fingerprint(stdout):
+    return (stdout.decode().strip().rsplit('=', 1)[-1].replace(':', '')
+            .lower())
+
+
+def _to_bytes(data):
+    if isinstance(data, six.text_type):
+        return data.encode('utf-8')
+    return data
@@ -23,8 +23,10 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import collections
 import datetime
 import getpass
+import hashlib
 import inspect
 import os.path
 import pkgutil
@@ -32,13 +34,236 @@ import stat
 import struct
 import sys
 import tempfile
+import threading
 
+import lxml.etree
+import lxml.objectify
 import requestbuilder.service
 import six
 
 import euca2ools.commands
 
 
+# Bounds for automatically chosen upload part sizes
+MIN_PART_SIZE = 10 * 2 ** 20  # 10 MiB
+MAX_PART_SIZE = 128 * 2 ** 20  # 128 MiB
+MAX_PUT_OBJECT_SIZE = 5 * 2 ** 30  # 5 GiB, the most S3 takes in one PUT
+_TARGET_PART_COUNT = 256
+_PART_LATENCY_BUDGET = 60  # seconds of request latency per upload thread
+
+
+class MultiDigest(object):
+    """
+    Several named digests (e.g. sha1 and md5) computed over the same data
+    in one pass, so whatever produces the data need only go through it
+    once.
+    """
+
+    def __init__(self, *algorithms):
+        self.digests = dict((algorithm, hashlib.new(algorithm))
+                            for algorithm in algorithms)
+
+    def update(self, data):
+        for digest in self.digests.values():
+            digest.update(data)
+
+    def hexdigest(self, algorithm):
+        return self.digests[algorithm].hexdigest()
+
+
+class SharedFileDescriptor(object):
+    """
+    A file descriptor that several threads can read from (or, if it is
+    writable, write to) at once, each at offsets of its own.  This uses
+    os.pread and os.pwrite where they exist and seeks and reads or writes
+    under a lock where they do not.
+
+    open_range returns file objects for pieces of the file that can be
+    handed to things like PutObject and GetObject.  Closing them leaves
+    the descriptor open; closing this closes it.
+    """
+
+    def __init__(self, filename, writable=False):
+        self.filename = filename
+        if writable:
+            self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+        else:
+            self.fd = os.open(filename, os.O_RDONLY)
+        self.bytes_read = 0  # by all readers, which is handy for progress
+        self.__lock = threading.Lock()
+
+    def pread(self, size, offset):
+        if hasattr(os, 'pread'):
+            data = os.pread(self.fd, size, offset)
+            with self.__lock:
+                self.bytes_read += len(data)
+            return data
+        with self.__lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            data = os.read(self.fd, size)
+            self.bytes_read += len(data)
+            return data
+
+    def pwrite(self, data, offset):
+        if hasattr(os, 'pwrite'):
+            while data:
+                written = os.pwrite(self.fd, data, offset)
+                data = data[written:]
+                offset += written
+            return
+        with self.__lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(self.fd, data):]
+
+    def open_range(self, start, size):
+        return _FileRange(self, start, size)
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _FileRange(object):
+    def __init__(self, shared_fd, start, size):
+        self.shared_fd = shared_fd
+        self.name = shared_fd.filename
+        self.start = start
+        self.size = size
+        self.closed = False
+        self.__pos = 0
+
+    def read(self, size=-1):
+        remaining = self.size - self.__pos
+        if size < 0 or size > remaining:
+            size = remaining
+        chunks = []
+        while size > 0:
+            chunk = self.shared_fd.pread(size, self.start + self.__pos)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self.__pos += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.__pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.__pos = max(0, min(offset, self.size))
+
+    def write(self, data):
+        if self.__pos + len(data) > self.size:
+            raise ValueError('write past the end of the file range')
+        self.shared_fd.pwrite(data, self.start + self.__pos)
+        self.__pos += len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.__pos
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FileObjectExtent(object):
+    # By rights this class should be iterable, but if we do that then requests
+    # will attempt to use chunked transfer-encoding, which S3 does not
+    # support.
+
+    def __init__(self, fileobj, size, filename=None, hexdigest=None):
+        # If the caller already knows the data's MD5 digest it can pass it
+        # as hexdigest so we needn't compute it ourselves.
+        self.closed = False
+        self.filename = filename
+        self.fileobj = fileobj
+        self.size = size
+        self.__bytes_read = 0
+        self.__known_hexdigest = hexdigest
+        if hexdigest is None:
+            self.__md5 = hashlib.md5()
+        else:
+            self.__md5 = None
+        if hasattr(self.fileobj, 'tell'):
+            self.__initial_pos = self.fileobj.tell()
+        else:
+            self.__initial_pos = None
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_filename(cls, filename, size=None, hexdigest=None):
+        if size is None:
+            size = get_filesize(filename)
+        return cls(open(filename), size, filename=filename,
+                   hexdigest=hexdigest)
+
+    @property
+    def can_rewind(self):
+        return hasattr(self.fileobj, 'seek') and self.__initial_pos is not None
+
+    def close(self):
+        self.fileobj.close()
+        self.closed = True
+
+    def next(self):
+        remaining = self.size - self.__bytes_read
+        if remaining <= 0:
+            raise StopIteration()
+        chunk = next(self.fileobj)  # might raise StopIteration, which is good
+        chunk = chunk[:remaining]  # throw away data that are off the end
+        self.__bytes_read += len(chunk)
+        if self.__md5 is not None:
+            self.__md5.update(chunk)
+        return chunk
+
+    def read(self, size=-1):
+        remaining = self.size - self.__bytes_read
+        if size < 0:
+            chunk_len = remaining
+        else:
+            chunk_len = min(remaining, size)
+        chunk = self.fileobj.read(chunk_len)
+        self.__bytes_read += len(chunk)
+        if self.__md5 is not None:
+            self.__md5.update(chunk)
+        return chunk
+
+    @property
+    def read_hexdigest(self):
+        if self.__known_hexdigest is not None:
+            return self.__known_hexdigest
+        return self.__md5.hexdigest()
+
+    def rewind(self):
+        if not hasattr(self.fileobj, 'seek'):
+            raise TypeError('file object is not seekable')
+        assert self.__initial_pos is not None
+        self.fileobj.seek(self.__initial_pos)
+        self.__bytes_read = 0
+        if self.__known_hexdigest is None:
+            self.__md5 = hashlib.md5()
+
+    def tell(self):
+        return self.__bytes_read
+
+
 def build_progressbar_label_template(fnames):
     if len(fnames) == 0:
         return None
@@ -62,12 +287,33 @@ def mkdtemp_for_large_files(suffix='', prefix='tmp', dir=None):
     """
 
     if dir is None:
-        dir = (os.getenv('TMPDIR') or os.getenv('TEMP') or os.getenv('TMP') or
-               '/var/tmp')
+        dir = get_tempdir_for_large_files()
     return tempfile.mkdtemp(suffix=suffix, prefix=prefix, dir=dir)
+
+
+def spooled_tempfile_for_large_files(max_size=0, suffix='', prefix='tmp',
+                                     dir=None):
+    """
+    Like tempfile.SpooledTemporaryFile, but using /var/tmp as a last resort
+    instead of /tmp when the data outgrow memory.
+    """
+
+    if dir is None:
+        dir = get_tempdir_for_large_files()
+    return tempfile.SpooledTemporaryFile(max_size=max_size, suffix=suffix,
+                                         prefix=prefix, dir=dir)
 # pylint: enable=W0622
 
 
+def get_tempdir_for_large_files():
+    """
+    Return the directory that the functions above put temporary files in
+    when they are not told otherwise
+    """
+    return (os.getenv('TMPDIR') or os.getenv('TEMP') or os.getenv('TMP') or
+            '/var/tmp')
+
+
 def prompt_for_password():
     pass1 = getpass.getpass(prompt='New password: ')
     pass2 = getpass.getpass(prompt='Retype new password: ')
@@ -146,6 +392,29 @@ def get_vmdk_image_size(filename):
     return 512 * data[3]
 
 
+def choose_part_size(image_size, rtt=None, threads=1,
+                     min_size=MIN_PART_SIZE, max_size=MAX_PART_SIZE):
+    """
+    Choose the size of the parts to split an image of image_size bytes
+    into for uploading.
+
+    Every part costs a request and a manifest entry, so parts are made
+    large enough that there are no more than a few hundred of them.  If
+    rtt, the number of seconds it takes a request to the server to come
+    back, says that waiting on that many requests would add more than a
+    minute per upload thread, they are made larger still.  The result is
+    a whole number of MiB, no smaller than min_size, and no larger than
+    max_size or the most the server accepts in one PUT request.
+    """
+    max_count = _TARGET_PART_COUNT
+    if rtt:
+        max_count = min(max_count, max(1, int(_PART_LATENCY_BUDGET *
+                                              max(threads, 1) / rtt)))
+    size = -(-(image_size or 0) // max_count)
+    size = -(-size // 2 ** 20) * 2 ** 20  # round up to a whole MiB
+    return int(max(min_size, min(size, max_size, MAX_PUT_OBJECT_SIZE)))
+
+
 def check_dict_whitelist(dict_, err_context, whitelist=None):
     if not isinstance(dict_, dict):
         raise ValueError('{0} must be a dict'.format(err_context))
@@ -197,3 +466,247 @@ def generate_service_names():
                     issubclass(obj, requestbuilder.service.BaseService)):
                 services[obj.NAME] = obj.URL_ENVVAR
     return services
+
+
+def iterparse_with_paths(fileobj, events=('end',)):
+    """
+    Parse an XML document incrementally, yielding (event, path, element)
+    tuples, where path is a tuple of the tags from the root element down
+    to the element.  Each element is cleared once it has been yielded at
+    its end event, so memory use does not grow with the size of the
+    document.  Handle anything an element contains at the end events of
+    its children, since they are gone by the time its own end event
+    comes around.
+    """
+    path = []
+    events = set(events)
+    for event, elem in lxml.etree.iterparse(fileobj,
+                                            events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            if 'start' in events:
+                yield event, tuple(path), elem
+        else:
+            if 'end' in events:
+                yield event, tuple(path), elem
+            path.pop()
+            elem.clear()
+            # Elements we are done with still hang off their parents
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+def write_xml_element(xmlfile, elem, level=1, pretty_print=False):
+    """
+    Write a complete element to an lxml.etree.xmlfile, indenting it as
+    lxml's pretty_print would if it is nested level elements deep.
+    Return the element serialized without any indentation, which is
+    handy for computing signatures.
+
+    If elem came from a larger objectified tree, deannotate that tree
+    and clean up its namespaces first so their declarations do not
+    show up here.
+    """
+    lxml.objectify.deannotate(elem, xsi_nil=True)
+    lxml.etree.cleanup_namespaces(elem)
+    serialized = lxml.etree.tostring(elem)
+    if pretty_print:
+        write_xml_indent(xmlfile, level)
+        # Objectified elements' text is read-only, so indent a plain copy
+        elem = lxml.etree.fromstring(serialized)
+        _indent_xml_element(elem, level)
+    xmlfile.write(elem)
+    return serialized
+
+
+def write_xml_indent(xmlfile, level, pretty_print=True):
+    """
+    Write the whitespace that goes before a tag nested level elements
+    deep when pretty-printing an lxml.etree.xmlfile
+    """
+    if pretty_print:
+        xmlfile.write('\n' + '  ' * level)
+
+
+def _indent_xml_element(elem, level):
+    if len(elem):
+        elem.text = '\n' + '  ' * (level + 1)
+        for child in elem:
+            _indent_xml_element(child, level + 1)
+            child.tail = '\n' + '  ' * (level + 1)
+        child.tail = '\n' + '  ' * level
+
+
+def imap_in_threads(func, iterable, num_threads=1, admit=None):
+    """
+    Like itertools.imap, but run func on up to num_threads items at a
+    time using a pool of worker threads.  Results are yielded in the same
+    order as the items they came from, and no more than num_threads items
+    are pulled from iterable ahead of the result the caller is waiting
+    on.  If func raises an exception it is re-raised here when that
+    item's turn comes, and work on any items after it is abandoned.
+
+    If admit is given, each item is passed to admit(item, block) before
+    any work starts on it.  When that returns False the item waits until
+    the result the caller is waiting on has been yielded.  block is True
+    only when nothing else is in progress, in which case admit should
+    wait for as long as it has to and then return True.
+    """
+    if num_threads <= 1:
+        for item in iterable:
+            if admit is not None:
+                admit(item, True)
+            yield func(item)
+        return
+    work_queue = six.moves.queue.Queue()
+    workers = []
+    for _ in range(num_threads):
+        worker = threading.Thread(target=_run_thread_work_queue,
+                                  args=(work_queue,))
+        # Daemonic so ^C kills the program cleanly
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    pending = collections.deque()
+    held = []  # an item that admit has not let in yet
+    items = iter(iterable)
+    try:
+        while True:
+            while len(pending) < num_threads:
+                if held:
+                    item = held.pop()
+                else:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+                if admit is not None and not admit(item, not pending):
+                    held.append(item)
+                    break
+                result = _ThreadResult()
+                work_queue.put((func, item, result))
+                pending.append(result)
+            if not pending:
+                return
+            yield pending.popleft().get()
+    finally:
+        for result in pending:
+            result.cancelled = True
+        for _ in workers:
+            work_queue.put(None)
+
+
+def chain_in_threads(funcs, num_threads=1, buffer_size=2):
+    """
+    Like itertools.chain.from_iterable(func() for func in funcs), but
+    run up to num_threads of the funcs at a time in worker threads.
+    Items are yielded in the same order chain would yield them, and no
+    worker gets more than buffer_size items ahead of the caller, so a
+    func may yield any number of items.  If a func raises an exception
+    it is re-raised here when that func's turn comes, and work on any
+    funcs after it is abandoned.
+    """
+    if num_threads <= 1:
+        for func in funcs:
+            for item in func():
+                yield item
+        return
+    pending = collections.deque()
+    funcs = iter(funcs)
+    try:
+        while True:
+            while len(pending) < num_threads:
+                try:
+                    func = next(funcs)
+                except StopIteration:
+                    break
+                pending.append(_ThreadStream(func, buffer_size))
+            if not pending:
+                return
+            for item in pending[0]:
+                yield item
+            pending.popleft()
+    finally:
+        for stream in pending:
+            stream.stop()
+
+
+class _ThreadStream(object):
+    def __init__(self, func, buffer_size):
+        self.__queue = six.moves.queue.Queue(maxsize=buffer_size)
+        self.__stopped = threading.Event()
+        thread = threading.Thread(target=self.__run, args=(func,))
+        # Daemonic so ^C kills the program cleanly
+        thread.daemon = True
+        thread.start()
+
+    def __iter__(self):
+        while True:
+            # Waiting with a timeout keeps this interruptible with ^C
+            try:
+                done, item, exc_info = self.__queue.get(timeout=0.1)
+            except six.moves.queue.Empty:
+                continue
+            if exc_info is not None:
+                six.reraise(*exc_info)
+            if done:
+                return
+            yield item
+
+    def stop(self):
+        self.__stopped.set()
+
+    def __run(self, func):
+        try:
+            for item in func():
+                if not self.__put((False, item, None)):
+                    return
+            self.__put((True, None, None))
+        except Exception:
+            self.__put((True, None, sys.exc_info()))
+
+    def __put(self, entry):
+        # Give up once the caller stops listening rather than blocking
+        # on a full queue forever
+        while not self.__stopped.is_set():
+            try:
+                self.__queue.put(entry, timeout=0.1)
+                return True
+            except six.moves.queue.Full:
+                pass
+        return False
+
+
+class _ThreadResult(object):
+    def __init__(self):
+        self.cancelled = False
+        self.__done = threading.Event()
+        self.__value = None
+        self.__exc_info = None
+
+    def set(self, value=None, exc_info=None):
+        self.__value = value
+        self.__exc_info = exc_info
+        self.__done.set()
+
+    def get(self):
+        # Waiting with a timeout keeps this interruptible with ^C
+        while not self.__done.is_set():
+            self.__done.wait(0.1)
+        if self.__exc_info is not None:
+            six.reraise(*self.__exc_info)
+        return self.__value
+
+
+def _run_thread_work_queue(work_queue):
+    while True:
+        work = work_queue.get()
+        if work is None:
+            return
+        func, item, result = work
+        if result.cancelled:
+            continue
+        try:
+            result.set(value=func(item))
+        except Exception:
+            result.set(exc_info=sys.exc_info())